@@ -0,0 +1,207 @@
+"""
+benchmark.py: Measures City.run throughput and writes the results as JSON.
+
+Every case (model x car count x with/without a lead velocity profile x
+engine) is warmed up and then timed for at least min_time seconds. A case
+reports steps/s and car-steps/s, the time per step spent in
+driver_decision, move_forward (without collisions), handle_collisions and
+the rest of City.run (recording and gap statistics), and, from a separate
+short run under tracemalloc, the peak and net memory allocated per step.
+
+    python benchmark.py --out bench.json
+    python benchmark.py --out new.json --baseline bench.json
+
+With --baseline the run is compared against an earlier result file, and the
+exit code is 1 when any case or phase got slower by more than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+from city import City
+from kernels import HAVE_NUMBA
+
+MODELS = ('ACC', 'BCC', 'ACC+BCC')
+CAR_COUNTS = (10, 100, 1000, 10000)
+PHASES = ('driver_decision', 'move_forward', 'handle_collisions', 'other')
+
+PARAMS = {"kd": 0.9, "kv": 0.6, "kc": 0.4, "v_des": 30.0, "max_v": 50.0, "min_v": 0.0, "min_dis": 6.0,
+          "reaction_time": 0.8, "headway_time": 2.0, "max_a": 4.0, "min_a": -5.0, "min_gap": 2.0}
+DT = 0.1
+# Ring metres per car, so large platoons have the same density as cruising traffic
+METRES_PER_CAR = 30
+
+
+def lead_profile(duration=600.0):
+    # Stop-and-go lead profile, so the followers keep reacting during the timed steps
+    times = np.arange(0.0, duration + 1.0)
+    return np.column_stack([times, 20.0 + 8.0 * np.sin(2 * np.pi * times / 30.0)])
+
+
+def build(model, car_count, profile, engine):
+    city = City()
+    city.init(car_count, *PARAMS.values(), dt=DT, model=model, engine=engine,
+              road_length=max(1000, METRES_PER_CAR * car_count))
+    city.lead_velocity_profile = lead_profile() if profile else []
+    city.follower_velocity_profile = []
+    return city
+
+
+class PhaseTimer:
+    """Wraps the phase methods of one City (and its engine) to accumulate their time."""
+
+    def __init__(self, city):
+        self.seconds = dict.fromkeys(PHASES[:-1], 0.0)
+        target = city.engine if city.engine is not None else city
+        for name in self.seconds:
+            setattr(target, name, self.timed(name, getattr(target, name)))
+
+    def timed(self, name, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.perf_counter() - start
+        return wrapper
+
+
+def time_case(city, warmup_steps, min_time, min_steps):
+    for _ in range(warmup_steps):
+        city.run()
+    timer = PhaseTimer(city)
+    steps = 0
+    start = time.perf_counter()
+    while steps < min_steps or time.perf_counter() - start < min_time:
+        city.run()
+        steps += 1
+    elapsed = time.perf_counter() - start
+    phases = dict(timer.seconds)
+    # move_forward calls handle_collisions, so its own time excludes it
+    phases['move_forward'] -= phases['handle_collisions']
+    phases['other'] = elapsed - sum(phases.values())
+    return steps, elapsed, {name: seconds / steps for name, seconds in phases.items()}
+
+
+def measure_memory(city, steps):
+    # Peak memory allocated during a step (above what was live before it) and net growth per step
+    tracemalloc.start()
+    try:
+        peaks = []
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start_blocks = sys.getallocatedblocks()
+        for _ in range(steps):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            city.run()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        net_memory = tracemalloc.get_traced_memory()[0] - start_memory
+        net_blocks = sys.getallocatedblocks() - start_blocks
+    finally:
+        tracemalloc.stop()
+    return {"peak_bytes_per_step": max(peaks), "mean_peak_bytes_per_step": float(np.mean(peaks)),
+            "net_bytes_per_step": net_memory / steps, "net_blocks_per_step": net_blocks / steps}
+
+
+def case_key(result):
+    return f"{result['model']}/{result['cars']}/{'profile' if result['profile'] else 'no-profile'}/{result['engine']}"
+
+
+def run_benchmark(models=MODELS, car_counts=CAR_COUNTS, profiles=(False, True), engines=('object',),
+                  warmup_steps=5, min_time=1.0, min_steps=5, memory_steps=5, verbose=True):
+    """Runs every case and returns the result document (see write_results)."""
+    results = []
+    for engine in engines:
+        for model in models:
+            for car_count in car_counts:
+                for profile in profiles:
+                    city = build(model, car_count, profile, engine)
+                    steps, elapsed, phases = time_case(city, warmup_steps, min_time, min_steps)
+                    result = {"model": model, "cars": car_count, "profile": profile, "engine": engine,
+                              "steps": steps, "seconds": elapsed, "steps_per_second": steps / elapsed,
+                              "car_steps_per_second": steps * car_count / elapsed,
+                              "phase_seconds_per_step": phases,
+                              "memory": measure_memory(city, memory_steps) if memory_steps else None}
+                    results.append(result)
+                    if verbose:
+                        print(f"  {case_key(result):32s} {result['steps_per_second']:10.1f} steps/s "
+                              f"{result['car_steps_per_second']:12.0f} car-steps/s")
+    return {"meta": environment(), "results": results}
+
+
+def environment():
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "numba": HAVE_NUMBA, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            # Peak resident memory of the whole benchmark process (ru_maxrss is in KiB on Linux)
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "dt": DT}
+
+
+def write_results(document, path):
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(document, baseline, tolerance=0.2):
+    """
+    Compares a result document with a baseline document. Returns a list of
+    regressions (case, metric, baseline value, new value): cases whose
+    steps/s dropped or whose time per step in a phase grew by more than
+    tolerance (a fraction). Cases missing from either side are skipped.
+    """
+    old = {case_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in document["results"]:
+        key = case_key(result)
+        if key not in old:
+            continue
+        before = old[key]
+        if result["steps_per_second"] < before["steps_per_second"] * (1 - tolerance):
+            regressions.append((key, "steps_per_second", before["steps_per_second"], result["steps_per_second"]))
+        for phase, seconds in result["phase_seconds_per_step"].items():
+            previous = before["phase_seconds_per_step"].get(phase)
+            # Phases that take almost no time are too noisy to compare
+            if previous and previous > 1e-5 and seconds > previous * (1 + tolerance):
+                regressions.append((key, phase, previous, seconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="City.run throughput benchmark")
+    parser.add_argument("--out", default="benchmark.json", help="result file to write")
+    parser.add_argument("--baseline", help="earlier result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown as a fraction")
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=MODELS)
+    parser.add_argument("--cars", nargs="+", type=int, default=list(CAR_COUNTS))
+    parser.add_argument("--engines", nargs="+", default=["object"], choices=["object", "vector"])
+    parser.add_argument("--no-profile", action="store_true", help="only run without velocity profiles")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to time each case for")
+    args = parser.parse_args(argv)
+
+    profiles = (False,) if args.no_profile else (False, True)
+    document = run_benchmark(args.models, args.cars, profiles, args.engines, min_time=args.min_time)
+    write_results(document, args.out)
+    print(f"Results written to {args.out}")
+    if args.baseline:
+        regressions = compare(document, load_results(args.baseline), args.tolerance)
+        for key, metric, before, after in regressions:
+            print(f"  REGRESSION {key} {metric}: {before:.6g} -> {after:.6g}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,8 @@
 car.py: Contains the Car class for the traffic simulation.
 """
 
+import numpy as np
+
 class Car:
     def __init__(self, length, color, pos,min_dis, velocity, acceleration, current_road):
         self.length = length
@@ -14,16 +16,20 @@ class Car:
         self.headway_time = 2
         self.mode = 'VEL' 
         self.energy_used = 0.0
+        self.energy_recovered = 0.0
         self.mass = 1800
         self.frontal_area = 2.2
         self.CoR = 0.2 # Coefficient of Restitution
         self.Cr = 0.015  # Rolling resistance coefficient
         self.Cd = 0.29 # Drag coefficient
+        # Controller gains, set from the City's fleet (see fleet.py)
+        self.kd = None
+        self.kv = None
+        self.powertrain = None  # energy.Powertrain; None is a lossless drive without regeneration
         self.integration_factor = 1
-        self.pos_history = [self.pos]
-        self.vel_history = [self.velocity]
-        self.acc_history = [self.acceleration]
-        self.gap_history = []
+        # Histories live in the City's TrajectoryRecorder, in column `slot`
+        self.recorder = None
+        self.slot = 0
         self.x_history = []
         self.switch_events = []
 
@@ -48,6 +54,31 @@ class Car:
     def get_pos_history(self):
         return self.pos_history
 
+    def attach_recorder(self, recorder, slot):
+        self.recorder = recorder
+        self.slot = slot
+
+    def history(self, channel):
+        if self.recorder is None:
+            return np.empty(0)
+        return self.recorder.channel(channel)[:, self.slot]
+
+    @property
+    def pos_history(self):
+        return self.history('position')
+
+    @property
+    def vel_history(self):
+        return self.history('velocity')
+
+    @property
+    def acc_history(self):
+        return self.history('acceleration')
+
+    @property
+    def gap_history(self):
+        return self.history('gap')
+
     def update(self, dt):
         # Invert position update for inverted mapping (move right as forward)
         # S = ut + 0.5at^2
@@ -63,29 +94,5 @@ class Car:
             self.pos += road_length
         elif self.pos >= road_length:
             self.pos -= road_length
-        self.pos_history.append(self.pos)
-        self.vel_history.append(self.velocity)
-        self.acc_history.append(self.acceleration)
-
-
-        # Energy calculation
-        gravity = 9.8
-        mass = self.mass
-        frontal_area = self.frontal_area
-        velocity = self.velocity
-        acceleration = self.acceleration
-        cr = self.Cr
-        Cd = self.Cd
-        air_density = 1.225
-       
-        F_inertia = mass * acceleration
-        F_roll = cr * mass * gravity
-        F_drag = 0.5 * Cd * air_density * frontal_area * velocity**2
-        F_total = F_inertia + F_roll + F_drag
-
-        Power = F_total * velocity
-
-        Energy = Power * dt 
-        Energy = Energy / 3600000  # Convert to kWh
-        if Energy > 0:
-            self.energy_used += Energy
+
+        # Energy is computed for the whole fleet by the City's energy model (see energy.py)
@@ -0,0 +1,215 @@
+"""
+checkpoint.py: Saves and restores the full state of a City as one compressed .npz file.
+
+A checkpoint holds the roads, every car, the ring order, the collision log,
+the gains and flags, the velocity profiles, the recorded histories and the
+gap statistics accumulators. Continuing a restored City gives the same results, bit for bit,
+as a run that was never interrupted.
+"""
+
+import json
+import os
+import numpy as np
+from car import Car
+from energy import EfficiencyMap, FleetEnergy, Powertrain
+from events import Collision
+from fleet import Fleet
+from gap_statistics import GapStatistics, Moments
+from neighbor_index import NeighborIndex
+from recorder import CHANNELS, TrajectoryRecorder
+from road import Road
+from vector_engine import VectorEngine
+
+VERSION = 1
+
+CITY_FIELDS = ('step_count', 'model', 'mode', 'dt', 'kd', 'kv', 'kc', 'v_des', 'initial_v_des', 'max_v', 'min_v',
+               'reaction_time', 'headway_time', 'max_a', 'min_a', 'min_dis', 'min_gap', 'overall_min_gap',
+               'overall_max_gap', 'collision_count', 'kernel', 'leader_stop', 'follower_stop', 'integrator',
+               'max_substeps', 'substep_count', 'max_substeps_used', 'fast_forward_steps')
+CAR_FIELDS = ('length', 'pos', 'min_dis', 'velocity', 'acceleration', 'headway_time', 'energy_used',
+              'energy_recovered', 'mass', 'frontal_area', 'CoR', 'Cr', 'Cd', 'integration_factor', 'collision_timer', 'kd', 'kv')
+POWERTRAIN_FIELDS = ('wheel_radius', 'gear_ratio', 'max_regen_power')
+CAR_TEXT_FIELDS = ('color', 'original_color', 'mode')
+MOMENT_FIELDS = ('count', 'mean', 'm2', 'min', 'max')
+
+
+def plain(value):
+    # NumPy scalars -> Python scalars for the JSON header
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def save_checkpoint(city, path, history=True):
+    """
+    Writes the state of city to path (atomically, so a crash never leaves a
+    half-written checkpoint). With history=False only the last two recorded
+    rows are kept, which is enough to continue the run (e.g. after a warm-up;
+    the adaptive integrator reads the jerk from them).
+    """
+    cars = city.cars
+    roads = city.roads
+    meta = {name: plain(getattr(city, name)) for name in CITY_FIELDS if hasattr(city, name)}
+    meta["version"] = VERSION
+    meta["engine"] = 'vector' if isinstance(city.engine, VectorEngine) else 'object'
+    arrays = {
+        "roads": np.array([[r.length, r.x, r.y, r.dir_x, r.dir_y] for r in roads], dtype=float).reshape(-1, 5),
+        "car_road": np.array([roads.index(c.current_road) for c in cars], dtype=np.int64),
+        "road_cars": np.array([cars.index(c) for r in roads for c in r.cars_on_road], dtype=np.int64),
+        "road_car_count": np.array([len(r.cars_on_road) for r in roads], dtype=np.int64),
+        "ring_order": np.array(city.neighbors.order, dtype=np.int64),
+        "collisions": np.array([[c.step, c.time, c.front, c.follower, c.closing_speed, c.energy_lost]
+                                for c in getattr(city, 'collisions', [])], dtype=float).reshape(-1, 6),
+    }
+    for name in CAR_FIELDS:
+        arrays["car_" + name] = np.array([getattr(c, name, 0) for c in cars])
+    for name in CAR_TEXT_FIELDS:
+        arrays["car_" + name] = np.array([str(getattr(c, name, '')) for c in cars])
+
+    # Vehicle classes of the fleet (the per-car values are among the car fields)
+    arrays["car_vehicle_class"] = np.asarray(city.fleet.vehicle_class, dtype=np.int64)
+    meta["vehicle_classes"] = list(city.fleet.class_names)
+    arrays["car_controller"] = np.asarray(city.controllers, dtype=np.int8)
+
+    # Powertrains are stored once each (efficiency maps as arrays), cars refer to them by index; -1 is None
+    powertrains = []
+    for car in cars:
+        powertrain = getattr(car, 'powertrain', None)
+        if powertrain is not None and powertrain not in powertrains:
+            powertrains.append(powertrain)
+    arrays["car_powertrain"] = np.array([powertrains.index(c.powertrain) if getattr(c, 'powertrain', None) else -1
+                                         for c in cars], dtype=np.int64)
+    meta["powertrains"] = [{name: getattr(p, name) for name in POWERTRAIN_FIELDS} for p in powertrains]
+    for k, powertrain in enumerate(powertrains):
+        for kind in ('motor', 'regen'):
+            efficiency_map = getattr(powertrain, kind + '_map')
+            if efficiency_map is not None:
+                arrays[f"powertrain{k}_{kind}_speed"] = efficiency_map.speeds
+                arrays[f"powertrain{k}_{kind}_torque"] = efficiency_map.torques
+                arrays[f"powertrain{k}_{kind}_efficiency"] = efficiency_map.efficiency
+
+    for name in ('lead_velocity_profile', 'follower_velocity_profile'):
+        profile = getattr(city, name)
+        arrays[name] = np.column_stack([profile.times, profile.velocities])
+        meta[name + "_cursor"] = profile.cursor
+
+    recorder = city.recorder
+    if recorder is not None:
+        rows = slice(None) if history else slice(-2, None)
+        for name in CHANNELS:
+            arrays["history_" + name] = recorder.channel(name)[rows]
+        meta["history_dtype"] = recorder.dtype.str
+        meta["history_chunk_steps"] = recorder.chunk_steps
+
+    stats = city.gap_stats
+    meta["gap_stats"] = {"max_gap": stats.max_gap, "bin_width": stats.bin_width, "window_steps": stats.window_steps,
+                         "window_steps_done": stats.window_steps_done, "windows": stats.windows,
+                         "bins": len(stats.bins)}
+    # The histogram is mostly empty, so only the occupied bins are stored
+    occupied = np.flatnonzero(stats.bins)
+    arrays["gap_bins_index"] = occupied
+    arrays["gap_bins_count"] = stats.bins[occupied]
+    moments = {"moments": stats.moments, "window": stats.window, "car_moments": stats.car_moments}
+    for prefix, moment in moments.items():
+        if moment is not None:
+            for name in MOMENT_FIELDS:
+                arrays[f"gap_{prefix}_{name}"] = np.asarray(getattr(moment, name))
+
+    arrays["meta"] = np.array(json.dumps(meta))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_moments(data, prefix):
+    moment = Moments()
+    for name in MOMENT_FIELDS:
+        setattr(moment, name, data[f"gap_{prefix}_{name}"])
+    return moment
+
+
+def load_checkpoint(city, path):
+    """Replaces the state of city (a City, e.g. a fresh City()) with the checkpoint at path."""
+    with np.load(path) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta.get("version") != VERSION:
+            raise ValueError(f"Unsupported checkpoint version: {meta.get('version')}")
+        for name in CITY_FIELDS:
+            if name in meta:
+                setattr(city, name, meta[name])
+
+        city.roads[:] = [Road(*[v.item() for v in row]) for row in data["roads"]]
+        city.cars[:] = []
+        # Fields added after a checkpoint was written keep the Car defaults
+        columns = {name: data["car_" + name].tolist() for name in CAR_FIELDS + CAR_TEXT_FIELDS if "car_" + name in data}
+        for i, road_index in enumerate(data["car_road"].tolist()):
+            road = city.roads[road_index]
+            car = Car(length=columns["length"][i], color=columns["color"][i], pos=columns["pos"][i],
+                      min_dis=columns["min_dis"][i], velocity=columns["velocity"][i],
+                      acceleration=columns["acceleration"][i], current_road=road)
+            # Checkpoints from before per-car gains ran every car with the city-wide ones
+            car.kd, car.kv = city.kd, city.kv
+            for name in columns:
+                setattr(car, name, columns[name][i])
+            city.cars.append(car)
+        city.fleet = Fleet.from_cars(city.cars)
+        if "car_vehicle_class" in data:
+            city.fleet.vehicle_class = data["car_vehicle_class"]
+            city.fleet.class_names = meta["vehicle_classes"]
+        # Checkpoints from before per-car controllers ran every car with the city's model
+        if "car_controller" in data:
+            city.fleet.controller = data["car_controller"].astype(np.int8)
+        city.controllers = city.fleet.controllers_for(city.model)
+        powertrains = []
+        for k, info in enumerate(meta.get("powertrains", [])):
+            maps = {}
+            for kind in ('motor', 'regen'):
+                if f"powertrain{k}_{kind}_speed" in data:
+                    maps[kind + '_map'] = EfficiencyMap(*(data[f"powertrain{k}_{kind}_{name}"]
+                                                          for name in ('speed', 'torque', 'efficiency')))
+            powertrains.append(Powertrain(**maps, **info))
+        if "car_powertrain" in data:
+            for car, k in zip(city.cars, data["car_powertrain"].tolist()):
+                car.powertrain = powertrains[k] if k >= 0 else None
+        city.energy_model = FleetEnergy.from_cars(city.cars)
+
+        start = 0
+        for road, count in zip(city.roads, data["road_car_count"].tolist()):
+            road.cars_on_road = [city.cars[i] for i in data["road_cars"][start:start + count].tolist()]
+            start += count
+
+        road_length = city.roads[0].length if city.roads else 1000
+        city.neighbors = NeighborIndex(city.cars, road_length)
+        city.neighbors.order = data["ring_order"].tolist()
+        city.neighbors.link()
+        log = data["collisions"].tolist() if "collisions" in data else []
+        city.collisions = [Collision(int(step), time, int(front), int(follower), closing_speed, energy_lost)
+                           for step, time, front, follower, closing_speed, energy_lost in log]
+
+        for name in ('lead_velocity_profile', 'follower_velocity_profile'):
+            setattr(city, name, data[name])
+            getattr(city, name).cursor = meta[name + "_cursor"]
+
+        if "history_position" in data:
+            channels = {name: data["history_" + name] for name in CHANNELS}
+            recorder = TrajectoryRecorder(len(city.cars), dtype=np.dtype(meta["history_dtype"]),
+                                          chunk_steps=meta["history_chunk_steps"])
+            recorder.record(*(channels[name] for name in CHANNELS))
+            city.recorder = recorder
+            for slot, car in enumerate(city.cars):
+                car.attach_recorder(recorder, slot)
+        else:
+            city.recorder = None
+
+        info = meta["gap_stats"]
+        stats = GapStatistics(max_gap=info["max_gap"], bin_width=info["bin_width"], window_steps=info["window_steps"])
+        stats.bins = np.zeros(info["bins"], dtype=np.int64)
+        stats.bins[data["gap_bins_index"]] = data["gap_bins_count"]
+        stats.moments = load_moments(data, "moments")
+        stats.window = load_moments(data, "window")
+        stats.car_moments = load_moments(data, "car_moments") if "gap_car_moments_count" in data else None
+        stats.window_steps_done = info["window_steps_done"]
+        stats.windows = info["windows"]
+        city.gap_stats = stats
+
+    city.engine = VectorEngine([city]) if meta["engine"] == 'vector' else None
+    return city
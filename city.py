@@ -4,11 +4,26 @@ City .py: Contains the City class for managing the traffic simulation.
 
 from car import Car
 from road import Road
+from neighbor_index import NeighborIndex
+from velocity_profile import VelocityProfile
+from recorder import TrajectoryRecorder
+from gap_statistics import GapStatistics
+from vector_engine import IDM_DECELERATION, IDM_DELTA, IDM_MIN_GAP, MODES, VectorEngine, resolve_collisions
+from energy import FleetEnergy
+from fleet import (ACC_CONTROL, BCC_CONTROL, CONTROLLERS, INTEGRATED_CONTROL, LEAD, Fleet,
+                   start_positions)
+from events import Collision, Event
+from profiler import PhaseProfiler
+import kernels
+import integration
+import checkpoint
 import numpy as np
 import math as math
 
 class City:
     def __init__(self):
+        # Set first: assigning the velocity profiles below checks it
+        self.profiler = None
         self.cars = []
         self.roads = []
         self.step_count = 0
@@ -18,10 +33,53 @@ class City:
         self.dt = 0.1 
         self.overall_min_gap = float('inf')
         self.overall_max_gap = 0
-        self.all_gaps = []
-
-    def init(self, car_number, kd, kv, kc, v_des, max_v, min_v, min_dis, reaction_time, headway_time, max_a, min_a, min_gap=5.0, dt=0.1, model='ACC'):
+        self.gap_stats = GapStatistics()
+        self.collision_count = 0
+        self.engine = None
+        self.recorder = None
+        self.neighbors = NeighborIndex(self.cars, 1000)
+        self.energy_model = FleetEnergy.from_cars(self.cars)
+        self.fleet = Fleet(0)
+        self.controllers = np.zeros(0, dtype=np.int8)
+        self.lead_velocity_profile = []
+        self.follower_velocity_profile = []
+        self.checkpoint_path = None
+        self.checkpoint_steps = None
+        self.integrator = 'fixed'
+        self.max_substeps = 10
+        self.substep_offset = 0.0
+        self.substep_count = 0
+        self.max_substeps_used = 0
+        self.fast_forward_steps = 0
+        self.detectors = []
+        self.events = []
+        self.collisions = []
+        self.stop_action = None
+
+    # Velocity profiles are compiled into sorted arrays when they are assigned
+    @property
+    def lead_velocity_profile(self):
+        return self._lead_velocity_profile
+
+    @lead_velocity_profile.setter
+    def lead_velocity_profile(self, profile):
+        self._lead_velocity_profile = VelocityProfile(profile)
+        if self.profiler is not None:
+            self.profiler.attach(self)
+
+    @property
+    def follower_velocity_profile(self):
+        return self._follower_velocity_profile
+
+    @follower_velocity_profile.setter
+    def follower_velocity_profile(self, profile):
+        self._follower_velocity_profile = VelocityProfile(profile)
+        if self.profiler is not None:
+            self.profiler.attach(self)
+
+    def init(self, car_number, kd, kv, kc, v_des, max_v, min_v, min_dis, reaction_time, headway_time, max_a, min_a, min_gap=5.0, dt=0.1, model='ACC', engine='object', kernel='python', integrator='fixed', max_substeps=10, history_dtype=np.float64, gap_per_car=False, gap_window_steps=None, road_length=1000, powertrain=None, fleet=None):
         # Reset simulation state
+        self.engine = None
         self.cars.clear()
         self.roads.clear()
         self.step_count = 0
@@ -29,19 +87,33 @@ class City:
         self.dt = dt
         self.overall_min_gap = float('inf')
         self.overall_max_gap = 0
-        self.all_gaps = []
-
-        # Create a single straight road for simplicity
-        road = Road(1000, 0, 0, 1, 0)
+        self.collision_count = 0
+        self.detectors = []
+        self.events = []
+        self.collisions = []
+        self.stop_action = None
+
+        # Create a single straight road for simplicity (a ring of road_length metres)
+        road = Road(road_length, 0, 0, 1, 0)
         self.roads.append(road)
 
+        # Gap statistics are accumulated online instead of keeping every gap
+        self.gap_stats = GapStatistics(max_gap=road.length, car_count=int(car_number), per_car=gap_per_car, window_steps=gap_window_steps)
+
+        # Per-vehicle parameters (see fleet.py); gains and headway times not given by the fleet are the city-wide ones
+        fleet = fleet if fleet is not None else Fleet(int(car_number))
+        if len(fleet) != int(car_number):
+            raise ValueError(f"The fleet has {len(fleet)} vehicles for {int(car_number)} cars")
+        self.fleet = fleet.resolved(kd, kv, headway_time)
+        # Initial velocity and spacing of the cars
+        velocity = 0
+        headway = min_dis + velocity * reaction_time
+        positions = start_positions(self.fleet.length, headway, road_length)
+
         # Place cars at intervals along the road
         for i in range(int(car_number)):
-            # Initial velocity, position, and sizeof each car
-            velocity = 0
-            car_length = 4
-            headway = min_dis + velocity * reaction_time
-            pos = 1000 - (car_number - 1 -i) * (car_length + headway) 
+            car_length = self.fleet.length[i].item()
+            pos = positions[i]
             if i == 0:
                 color = 'red'  
             elif i == car_number - 1:
@@ -53,6 +125,12 @@ class City:
             car.collision_timer = 0
             self.cars.append(car)
             road.enter_road(car)
+        self.fleet.apply(self.cars)
+        # Controller of every car (fleet.CONTROLLERS index, LEAD for car 0): the fleet's choice or `model`
+        self.controllers = self.fleet.controllers_for(model)
+
+        # One energy.Powertrain for every car or a sequence with one per car; None is a lossless drive
+        self.set_powertrain(powertrain)
 
         # Store model parameters
         self.kd = kd
@@ -69,42 +147,343 @@ class City:
         self.min_dis = min_dis
         self.min_gap = min_gap
 
+        # Ring order of the cars, kept up to date after every move
+        self.neighbors = NeighborIndex(self.cars, road.length)
+
+        # Step x car histories, starting with the initial state
+        self.recorder = TrajectoryRecorder(len(self.cars), dtype=history_dtype)
+        for slot, car in enumerate(self.cars):
+            car.attach_recorder(self.recorder, slot)
+        self.recorder.record([c.pos for c in self.cars], [c.velocity for c in self.cars],
+                             [c.acceleration for c in self.cars], self.front_gaps(),
+                             [c.energy_used for c in self.cars], [c.integration_factor for c in self.cars],
+                             [MODES.index(c.mode) for c in self.cars])
+
+        # 'python' uses calculate_integration_factor, 'compiled' the kernels module (Numba when installed)
+        if kernel not in ('python', 'compiled'):
+            raise ValueError(f"Unknown kernel: {kernel}")
+        self.kernel = kernel
+
+        # 'fixed' takes one step of dt per run(), 'adaptive' splits it into up to max_substeps (see integration.py)
+        if integrator not in ('fixed', 'adaptive'):
+            raise ValueError(f"Unknown integrator: {integrator}")
+        self.integrator = integrator
+        self.max_substeps = int(max_substeps)
+        self.substep_offset = 0.0
+        self.substep_count = 0
+        self.max_substeps_used = 0
+        self.fast_forward_steps = 0
+
+        # 'object' steps every Car in Python, 'vector' steps the whole platoon with NumPy arrays
+        if engine == 'vector':
+            self.engine = VectorEngine([self])
+        elif engine == 'object':
+            self.engine = None
+        else:
+            raise ValueError(f"Unknown engine: {engine}")
+        # The engine, recorder and neighbour index are new objects, so a profiler has to wrap them again
+        if self.profiler is not None:
+            self.profiler.attach(self)
+
     def run(self, dt=None):
         # Run one simulation step with real dt
         if dt is None:
             dt = self.dt
-        self.driver_decision()
-        self.move_forward(dt)
-        self.step_count += 1
-        # Calculate and store inter-vehicular distances for final analysis
-        gaps = []
-        road_length = self.roads[0].length if self.roads else 1000
-        for idx, car in enumerate(self.cars):
-            if idx ==0:
-                continue
-            cars_same_road = [c for c in self.cars if c.current_road == car.current_road and c != car]
+        substeps = self.choose_substeps(dt) if self.integrator == 'adaptive' else 1
+        step = dt / substeps
+        # Only the state at the end of the last substep is recorded, so rows stay on the grid of dt
+        for k in range(substeps - 1):
+            self.substep_offset = k * step
+            self.advance(step)
+        self.substep_offset = (substeps - 1) * step
+        self.substep_count += substeps
+        self.max_substeps_used = max(self.max_substeps_used, substeps)
+        if self.engine is not None:
+            gap_row = self.engine.step(step)[0]
+            self.substep_offset = 0.0
+            self.step_count += 1
+            self.record_gaps(gap_row)
+        else:
+            self.driver_decision(step)
+            positions, velocities = self.move_forward(step)
+            self.substep_offset = 0.0
+            self.step_count += 1
+            # Calculate and store inter-vehicular distances for final analysis
+            gap_row = self.front_gaps()
+            self.record_gaps(gap_row)
+            self.recorder.record(positions, velocities, [c.acceleration for c in self.cars], gap_row,
+                                 [c.energy_used for c in self.cars], [c.integration_factor for c in self.cars],
+                                 [MODES.index(c.mode) for c in self.cars])
+        if self.detectors:
+            self.check_detectors()
+        if self.checkpoint_steps and self.step_count % self.checkpoint_steps == 0:
+            self.save_checkpoint(self.checkpoint_path)
+
+    def advance(self, dt):
+        # One unrecorded (sub)step
+        if self.engine is not None:
+            self.engine.advance(dt)
+        else:
+            self.driver_decision(dt)
+            self.move_forward(dt)
 
-            def gap_to(other):
-                gap = (car.pos - other.pos ) % road_length
-                return gap if gap > 0 else float('inf')
-            
-            front_car = min(cars_same_road, key=gap_to, default=None) if cars_same_road else None
-            gap = ((car.pos - front_car.pos - car.length) % road_length)
-            if idx == 0: 
-                print(gap)
-            if gap > 0:
-                gaps.append(gap)
-    
-        if gaps:
-            current_min_gap = min(gaps)
-            current_max_gap = max(gaps)
+    def choose_substeps(self, dt):
+        # Substeps for the next adaptive step, from the state at its start
+        if self.engine is not None:
+            gaps, vel, front = self.engine.front_gaps()[0], self.engine.vel[0], self.engine.front[0]
+        else:
+            gaps = np.array(self.front_gaps())
+            vel = np.array([c.velocity for c in self.cars])
+            front = self.neighbors.front
+        jerk = np.zeros(0)
+        if self.recorder is not None and self.recorder.steps >= 2:
+            last_acc = self.recorder.channel('acceleration')[-2:]
+            jerk = (last_acc[1] - last_acc[0]) / dt
+        # The lead car does not follow anyone, so only the followers' gaps count
+        return integration.substep_count(gaps[1:], vel[1:], vel[front][1:], jerk, dt, self.min_dis,
+                                         self.reaction_time, self.max_substeps)
+
+    def set_powertrain(self, powertrain):
+        """
+        Assigns energy.Powertrain objects (one for all cars or one per car) and
+        rebuilds the fleet energy arrays; call it with the current powertrains
+        (or None) after changing the mass, Cr, Cd or frontal_area of cars.
+        """
+        if powertrain is None or not isinstance(powertrain, (list, tuple)):
+            powertrain = [powertrain] * len(self.cars)
+        if len(powertrain) != len(self.cars):
+            raise ValueError(f"Got {len(powertrain)} powertrains for {len(self.cars)} cars")
+        for car, car_powertrain in zip(self.cars, powertrain):
+            car.powertrain = car_powertrain
+        self.energy_model = FleetEnergy.from_cars(self.cars)
+        if self.engine is not None:
+            self.engine.load()
+
+    def set_fleet(self, fleet):
+        """
+        Replaces the per-vehicle parameters (a fleet.Fleet with one vehicle per
+        car) and updates the cars, the fleet energy arrays and the engine.
+        """
+        if len(fleet) != len(self.cars):
+            raise ValueError(f"The fleet has {len(fleet)} vehicles for {len(self.cars)} cars")
+        self.fleet = fleet.resolved(self.kd, self.kv, self.headway_time)
+        self.fleet.apply(self.cars)
+        self.controllers = self.fleet.controllers_for(self.model)
+        self.set_powertrain([car.powertrain for car in self.cars])
+
+    def energy_summary(self):
+        # Fleet totals in kWh: consumed from and recovered into the batteries, and the net energy
+        if self.engine is not None:
+            consumed, recovered = float(self.engine.energy.sum()), float(self.engine.recovered.sum())
+        else:
+            consumed = sum(car.energy_used for car in self.cars)
+            recovered = sum(car.energy_recovered for car in self.cars)
+        return {"consumed": consumed, "recovered": recovered, "net": consumed - recovered}
+
+    def controller_groups(self):
+        # Car indices per controller name ('lead' for car 0), in CONTROLLERS order
+        groups = {'lead': np.flatnonzero(self.controllers == LEAD)}
+        for k, name in enumerate(CONTROLLERS):
+            cars = np.flatnonzero(self.controllers == k)
+            if len(cars):
+                groups[name] = cars
+        return {name: cars for name, cars in groups.items() if len(cars)}
+
+    def group_summary(self):
+        """
+        Per controller group: number of cars, energy consumed and recovered
+        (kWh) and the mean and smallest recorded front gap (m) of its cars.
+        """
+        if self.engine is not None:
+            consumed, recovered = self.engine.energy[0], self.engine.recovered[0]
+        else:
+            consumed = np.array([car.energy_used for car in self.cars])
+            recovered = np.array([car.energy_recovered for car in self.cars])
+        gaps = self.recorder.gap
+        summary = {}
+        for name, cars in self.controller_groups().items():
+            group_gaps = gaps[:, cars] if len(gaps) else np.full((1, len(cars)), np.nan)
+            summary[name] = {"cars": len(cars), "consumed": float(consumed[cars].sum()),
+                             "recovered": float(recovered[cars].sum()),
+                             "mean_gap": float(np.mean(group_gaps)), "min_gap": float(np.min(group_gaps))}
+        return summary
+
+    def enable_profiling(self):
+        """Starts timing the phases of run() (see profiler.py); returns the PhaseProfiler."""
+        if self.profiler is None:
+            self.profiler = PhaseProfiler()
+        self.profiler.attach(self)
+        return self.profiler
+
+    def disable_profiling(self):
+        # Removes the timers; the returned profiler keeps the results collected so far
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.detach()
+        self.profiler = None
+        return profiler
+
+    def add_detector(self, detector):
+        """Attaches an events.Detector, checked after every step; returns it."""
+        detector.attach(self)
+        self.detectors.append(detector)
+        return detector
+
+    @property
+    def stopped(self):
+        # True once a detector with a 'stop' or 'fast_forward' action has fired
+        return self.stop_action is not None
+
+    def inputs_steady(self):
+        """
+        True once nothing outside the cars will change their driving: no
+        velocity profile has samples left after the current time and neither
+        the leader nor the follower stop is set.
+        """
+        if getattr(self, 'leader_stop', False) or getattr(self, 'follower_stop', False):
+            return False
+        time = self.step_count * self.dt + self.substep_offset
+        return all(not len(profile) or profile.times[-1] <= time
+                   for profile in (self.lead_velocity_profile, self.follower_velocity_profile))
+
+    def check_detectors(self):
+        for detector in self.detectors:
+            if detector.fired:
+                continue
+            detail = detector.check(self)
+            if detail is None:
+                continue
+            detector.fired = True
+            event = Event(detector.name, self.step_count, self.step_count * self.dt, detail)
+            self.events.append(event)
+            if detector.callback is not None:
+                detector.callback(self, event)
+            if detector.action != 'continue' and self.stop_action is None:
+                self.stop_action = detector.action
+
+    def run_steps(self, steps, dt=None):
+        """
+        Runs until step_count reaches steps or a detector stops the run, and
+        fast-forwards the remaining steps after a 'fast_forward' stop.
+        Returns the number of steps actually integrated.
+        """
+        start = self.step_count
+        while self.step_count < steps and not self.stopped:
+            self.run(dt)
+        integrated = self.step_count - start
+        if self.stop_action == 'fast_forward':
+            self.fast_forward(steps - self.step_count, dt)
+        return integrated
+
+    def fast_forward(self, steps, dt=None, chunk_steps=4096):
+        """
+        Records `steps` more steps without integrating them: every car keeps its
+        current velocity with zero acceleration, which is exact for the steady
+        state found by events.SteadyState (only once inputs_steady(): a velocity
+        profile that is still playing or a stop would change the speeds).
+        Positions, gaps and energy are extrapolated onto the regular grid and
+        the gap statistics updated.
+        """
+        if dt is None:
+            dt = self.dt
+        if steps <= 0 or not self.cars:
+            return
+        if not self.inputs_steady():
+            raise ValueError("Cannot fast-forward while a velocity profile is playing or a stop is set")
+        cars = self.cars
+        road_length = self.roads[0].length if self.roads else 1000
+        # The ring order of the engine that moved the cars (self.neighbors is only kept up to date without one)
+        front = np.array(self.engine.front[0] if self.engine is not None else self.neighbors.front)
+        pos = np.array([c.pos for c in cars])
+        vel = np.array([c.velocity for c in cars])
+        length = np.array([c.length for c in cars])
+        energy = np.array([c.energy_used for c in cars])
+        step_energy, step_recovered = self.energy_model.step(vel, 0.0, dt)
+        iF = np.array([c.integration_factor for c in cars], dtype=float)
+        mode = np.array([MODES.index(c.mode) for c in cars])
+
+        for start in range(0, steps, chunk_steps):
+            k = np.arange(start + 1, min(start + chunk_steps, steps) + 1)[:, None]
+            positions = (pos - vel * dt * k) % road_length
+            gap_rows = (positions - positions[:, front] - length[front]) % road_length
+            energies = energy + step_energy * k
+            if self.recorder is not None:
+                rows = (len(k), len(cars))
+                self.recorder.record(positions, np.broadcast_to(vel, rows), np.zeros(rows), gap_rows, energies,
+                                     np.broadcast_to(iF, rows), np.broadcast_to(mode, rows))
+            self.record_gaps(gap_rows)
+
+        for car, p, e, r in zip(cars, positions[-1].tolist(), energies[-1].tolist(), (step_recovered * steps).tolist()):
+            car.pos = p
+            car.acceleration = 0.0
+            car.energy_used = e
+            car.energy_recovered += r
+        self.step_count += steps
+        self.fast_forward_steps += steps
+        self.neighbors.update()
+        if self.engine is not None:
+            self.engine.load()
+
+    def integration_summary(self):
+        """
+        Steps on the grid of dt, integration steps actually taken, and their mean
+        and peak number per integrated step (fast-forwarded steps are not integrated).
+        """
+        integrated = self.step_count - self.fast_forward_steps
+        return {"steps": self.step_count, "substeps": self.substep_count,
+                "mean_substeps": self.substep_count / integrated if integrated else 0.0,
+                "max_substeps": self.max_substeps_used, "fast_forward_steps": self.fast_forward_steps}
+
+    def save_checkpoint(self, path, history=True):
+        """Writes the full simulation state to path (see checkpoint.py)."""
+        checkpoint.save_checkpoint(self, path, history)
+
+    def load_checkpoint(self, path):
+        """Restores the state written by save_checkpoint; running on gives the same results as the original run."""
+        checkpoint.load_checkpoint(self, path)
+        if self.profiler is not None:
+            self.profiler.attach(self)
+
+    def enable_checkpoints(self, path, every_steps):
+        # Overwrite path with a checkpoint every every_steps steps (None disables)
+        self.checkpoint_path = path
+        self.checkpoint_steps = every_steps
+
+    def front_gaps(self):
+        # Gap from every car to the rear of the car in front of it
+        road_length = self.roads[0].length if self.roads else 1000
+        cars = self.cars
+        front = self.neighbors.front
+        return [((car.pos - cars[f].pos - cars[f].length) % road_length) for car, f in zip(cars, front)]
+
+    def record_gaps(self, gap_rows):
+        # Front gaps of one step (one per car) or a block of steps (step x car)
+        gap_rows = np.asarray(gap_rows, dtype=float)
+        if gap_rows.ndim == 1:
+            gap_rows = gap_rows[None, :]
+        window_steps = self.gap_stats.window_steps
+        start = 0
+        while start < len(gap_rows):
+            # Split blocks at window boundaries so every window gets its own steps
+            end = len(gap_rows)
+            if window_steps:
+                end = min(end, start + window_steps - self.gap_stats.window_steps_done)
+            self.record_gap_block(gap_rows[start:end])
+            start = end
+
+    def record_gap_block(self, gap_rows):
+        # Only the followers' positive gaps count towards the statistics
+        gaps = gap_rows[:, 1:]
+        steps, followers = np.nonzero(gaps > 0)
+        gaps = gaps[steps, followers]
+        if gaps.size:
+            current_min_gap = float(gaps.min())
+            current_max_gap = float(gaps.max())
             if current_min_gap < self.overall_min_gap:
                 self.overall_min_gap = current_min_gap
             if current_max_gap > self.overall_max_gap:
                 self.overall_max_gap = current_max_gap
-
-            
-            self.all_gaps.extend(gaps)
+        self.gap_stats.add(gaps, followers + 1, steps=len(gap_rows))
 
     def set_leader_stop(self, leader_stop):
         self.leader_stop = leader_stop
@@ -113,76 +492,19 @@ class City:
         self.follower_stop = follower_stop
 
     # Main code to calculate acclerattion
-    def driver_decision(self):
+    def driver_decision(self, dt=None):
         road_length = self.roads[0].length if self.roads else 1000
-        dt = self.dt
+        if dt is None:
+            dt = self.dt
         car_states = [(c.pos, c.velocity) for c in self.cars]
+        controllers = self.controllers.tolist()
+        first_integrated = controllers.index(INTEGRATED_CONTROL) if INTEGRATED_CONTROL in controllers else -1
 
         for idx, car in enumerate(self.cars):
             # self.v_des = 0 if (getattr(self, 'follower_stop', False) and idx == 2) else self.initial_v_des
 
             if idx == 0:
-                if getattr(self, 'leader_stop', False):
-                    acc = self.kc * (0 - car.velocity)
-                    acc = max(self.min_a, min(self.max_a, acc))
-                    last_acc = car.acceleration
-                    jerk  = (acc - last_acc) / dt
-                    max_jerk = 5
-                    if jerk > max_jerk:
-                        acc = last_acc + max_jerk * dt
-                    elif jerk < -max_jerk:
-                        acc = last_acc - max_jerk * dt
-                    car.acceleration = acc
-                    continue
-
-                if hasattr(self, 'lead_velocity_profile') and self.lead_velocity_profile:
-                    time = round(self.step_count * dt, 3)
-                    for i in range(len(self.lead_velocity_profile)-1):
-                        t1,v1 = self.lead_velocity_profile[i]
-                        t2, v2 = self.lead_velocity_profile[i+1]
-                        if t1 <= time <= t2:
-                            alpha = (time - t1) / (t2 - t1)
-                            target_velocity = v1 + alpha * (v2 - v1)
-                            acc = self.kc * (target_velocity - car.velocity)
-                            acc = (target_velocity - car.velocity) / dt
-                            acc = max(self.min_a, min(self.max_a, acc))
-                            last_acc = car.acceleration
-                            jerk  = (acc - last_acc) / dt
-                            max_jerk = 5
-                            if jerk > max_jerk:
-                                acc = last_acc + max_jerk * dt
-                            elif jerk < -max_jerk:
-                                acc = last_acc - max_jerk * dt
-                            car.acceleration = acc
-                            break
-                    else:
-                        # If time exceeds profile, maintain last velocity
-                        t1, v1 = self.lead_velocity_profile[-1]
-                        target_velocity = v1
-                        acc = self.kc * (target_velocity - car.velocity)
-                        # acc = (target_velocity - car.velocity) / dt
-                        acc = max(self.min_a, min(self.max_a, acc))
-                        last_acc = car.acceleration
-                        jerk  = (acc - last_acc) / dt
-                        max_jerk = 5
-                        if jerk > max_jerk:
-                            acc = last_acc + max_jerk * dt
-                        elif jerk < -max_jerk:
-                            acc = last_acc - max_jerk * dt
-                        car.acceleration = acc
-                else:
-                    # Try to reach v_des if no velocity profile
-                    acc = self.kc * (self.v_des - car.velocity)
-                    acc = max(self.min_a, min(self.max_a, acc))
-                    last_acc = car.acceleration
-                    jerk  = (acc - last_acc) / dt
-                    max_jerk = 5
-                    if jerk > max_jerk:
-                        acc = last_acc + max_jerk * dt
-                    elif jerk < -max_jerk:
-                        acc = last_acc - max_jerk * dt
-                    car.acceleration = acc
-                    continue
+                car.acceleration = self.lead_acceleration(car.velocity, car.acceleration, dt)
                 continue
             # if idx == 2:
             #     if getattr(self, 'follower_stop', False):
@@ -239,97 +561,167 @@ class City:
             #         continue
 
     
-            # Find the car ahead and behind on the same road (circular road)
-            
-            cars_same_road = [c for c in self.cars if c.current_road == car.current_road and c != car]
-
-            def gap_to(other):
-                gap = (car.pos - other.pos ) % road_length
-                return gap if gap > 0 else float('inf')
+            # Find the car ahead and behind on the same road (circular road) from the ring order
             
-            front_car = min(cars_same_road, key=gap_to, default=None) if cars_same_road else None
-
-            def gap_from(other):
-                gap = (other.pos - car.pos) % road_length
-                return gap if gap > 0 else float('inf')
-            
-            back_car = min(cars_same_road, key=gap_from, default=None) if cars_same_road else None
-
-            if self.model == 'ACC' or ((self.model == 'BCC' or self.model=="ACC+BCC") and idx == len(self.cars) - 1):
-                car.mode = 'ACC'
-                car_pos, car_vel = car_states[idx]
-                front_idx = self.cars.index(front_car)
-                front_car_pos, front_car_vel = car_states[front_idx]
-                gap = (car_pos - front_car_pos - car.length ) % road_length
-                
-                rel_v = front_car_vel - car_vel
-                desired_gap = self.min_dis + car_vel * self.reaction_time
-                acc = self.kd * (gap - desired_gap) +  self.kv * rel_v
-                acc = max(self.min_a, min(self.max_a, acc))
-            elif self.model == 'BCC':        
-                car.mode = 'BCC'        
-                car_pos, car_vel = car_states[idx]
-                front_idx = self.cars.index(front_car)
-                front_car_pos, front_car_vel = car_states[front_idx]
-                back_idx = self.cars.index(back_car)
-                back_car_pos, back_car_vel = car_states[back_idx]
-                desired_gap = self.min_dis + car_vel * self.reaction_time
-                front_gap = abs((car_pos - front_car_pos - front_car.length) % road_length)
-                back_gap = abs((back_car_pos - car_pos - car.length) % road_length)
-                gap_factor = self.kd * (front_gap - desired_gap) + self.kd * (desired_gap - back_gap)
-                velocity_factor =  self.kv * (front_car_vel - car_vel) + self.kv * (back_car_vel - car_vel)
-                d_vel_factor = 0
-                acc = velocity_factor + gap_factor + d_vel_factor
-                acc = max(self.min_a, min(self.max_a, acc))
-
-            elif self.model == 'ACC+BCC':
+            front_idx = self.neighbors.front[idx]
+            back_idx = self.neighbors.back[idx]
+            front_car = self.cars[front_idx]
+            back_car = self.cars[back_idx]
+
+            # Each car runs its own controller (fleet.CONTROLLERS), looked up by index instead of by model name
+            controller = controllers[idx]
+            if controller == ACC_CONTROL:
+                acc = self.acc_decision(car, car_states, idx, front_idx, road_length)
+            elif controller == BCC_CONTROL:
+                acc = self.bcc_decision(car, front_car, car_states, idx, front_idx, back_idx, road_length)
+
+            elif controller == INTEGRATED_CONTROL and self.kernel == 'compiled':
+                # All ACC+BCC cars are handled in one kernel call when the loop reaches the first of them
                 self.mode = "INTEGRATED"
-                ve = car.velocity
-                vl = front_car.velocity
-                vf = back_car.velocity
-                ae = abs(self.min_a)
-                af = ae * 0.7  
-                Tr = self.reaction_time
-                Le = car.length
-                Lb = self.min_gap
-
-                Gfront_min = ve * Tr + ((vl - ve) ** 2) / (2 * ae) + Lb
-                Grear_min = vf * Tr + ((vf - ve) ** 2) / (2 * af) + Lb
-
-                X = Gfront_min + Le + Grear_min
-
-                car_pos, car_vel = car_states[idx]
-                front_idx = self.cars.index(front_car)
-                front_car_pos, front_car_vel = car_states[front_idx]
-                back_idx = self.cars.index(back_car)
-                back_car_pos, back_car_vel = car_states[back_idx]
-
-                front_gap = abs((car_pos - front_car_pos - front_car.length) % road_length)
-                back_gap = abs((back_car_pos - car_pos - car.length) % road_length)
-
-                car.integration_factor = self.calculate_integration_factor(front_gap, back_gap, X, car, front_car, back_car, idx)
-                iF = car.integration_factor
-                desired_gap = self.min_dis + car_vel * self.reaction_time
-
-                front_gap = abs((car_pos - front_car_pos - front_car.length) % road_length)
-                back_gap = abs((back_car_pos - car_pos - car.length) % road_length)
-
-                gap_factor = self.kd * (front_gap - desired_gap) + iF  * self.kd * (desired_gap - back_gap)
-                velocity_factor =  self.kv * (front_car_vel - car_vel) + iF *  self.kv * (back_car_vel - car_vel)
-                d_vel_factor = 0
-                # d_vel_factor = self.kc *(self.v_des - car_vel)
-                acc = velocity_factor + gap_factor + d_vel_factor
-                acc = max(self.min_a, min(self.max_a, acc))
+                if idx == first_integrated:
+                    self.integrated_decisions(car_states, road_length, dt)
+                continue
+
+            elif controller == INTEGRATED_CONTROL:
+                acc = self.integrated_decision(car, front_car, back_car, car_states, idx, front_idx, back_idx, road_length)
+            else:
+                acc = self.idm_decision(car, car_states, idx, front_idx, road_length)
 
             # Add some hysterises to accleration
-            last_acc = car.acceleration
-            jerk  = (acc - last_acc) / dt
-            max_jerk = 5
-            if jerk > max_jerk:
-                acc = last_acc + max_jerk * dt
-            elif jerk < -max_jerk:
-                acc = last_acc - max_jerk * dt
-            car.acceleration = acc
+            car.acceleration = self.limit_jerk(acc, car.acceleration, dt)
+
+    def acc_decision(self, car, car_states, idx, front_idx, road_length):
+        # ACC law: keep the desired gap to the front car
+        car.mode = 'ACC'
+        car_pos, car_vel = car_states[idx]
+        front_car_pos, front_car_vel = car_states[front_idx]
+        gap = (car_pos - front_car_pos - self.cars[front_idx].length) % road_length
+
+        rel_v = front_car_vel - car_vel
+        desired_gap = self.min_dis + car_vel * self.reaction_time
+        acc = car.kd * (gap - desired_gap) +  car.kv * rel_v
+        acc = max(self.min_a, min(self.max_a, acc))
+        return acc
+
+    def bcc_decision(self, car, front_car, car_states, idx, front_idx, back_idx, road_length):
+        # BCC law: balance the front and back gaps
+        car.mode = 'BCC'
+        car_pos, car_vel = car_states[idx]
+        front_car_pos, front_car_vel = car_states[front_idx]
+        back_car_pos, back_car_vel = car_states[back_idx]
+        desired_gap = self.min_dis + car_vel * self.reaction_time
+        front_gap = abs((car_pos - front_car_pos - front_car.length) % road_length)
+        back_gap = abs((back_car_pos - car_pos - car.length) % road_length)
+        gap_factor = car.kd * (front_gap - desired_gap) + car.kd * (desired_gap - back_gap)
+        velocity_factor =  car.kv * (front_car_vel - car_vel) + car.kv * (back_car_vel - car_vel)
+        d_vel_factor = 0
+        acc = velocity_factor + gap_factor + d_vel_factor
+        acc = max(self.min_a, min(self.max_a, acc))
+        return acc
+
+    def integrated_decision(self, car, front_car, back_car, car_states, idx, front_idx, back_idx, road_length):
+        # ACC+BCC law: BCC weighted by the integration factor
+        self.mode = "INTEGRATED"
+        ve = car.velocity
+        vl = front_car.velocity
+        vf = back_car.velocity
+        ae = abs(self.min_a)
+        af = ae * 0.7  
+        Tr = self.reaction_time
+        Le = car.length
+        Lb = self.min_gap
+
+        Gfront_min = ve * Tr + ((vl - ve) ** 2) / (2 * ae) + Lb
+        Grear_min = vf * Tr + ((vf - ve) ** 2) / (2 * af) + Lb
+
+        X = Gfront_min + Le + Grear_min
+
+        car_pos, car_vel = car_states[idx]
+        front_car_pos, front_car_vel = car_states[front_idx]
+        back_car_pos, back_car_vel = car_states[back_idx]
+
+        front_gap = abs((car_pos - front_car_pos - front_car.length) % road_length)
+        back_gap = abs((back_car_pos - car_pos - car.length) % road_length)
+
+        car.integration_factor = self.calculate_integration_factor(front_gap, back_gap, X, car, front_car, back_car, idx)
+        iF = car.integration_factor
+        desired_gap = self.min_dis + car_vel * self.reaction_time
+
+        front_gap = abs((car_pos - front_car_pos - front_car.length) % road_length)
+        back_gap = abs((back_car_pos - car_pos - car.length) % road_length)
+
+        gap_factor = car.kd * (front_gap - desired_gap) + iF  * car.kd * (desired_gap - back_gap)
+        velocity_factor =  car.kv * (front_car_vel - car_vel) + iF *  car.kv * (back_car_vel - car_vel)
+        d_vel_factor = 0
+        # d_vel_factor = self.kc *(self.v_des - car_vel)
+        acc = velocity_factor + gap_factor + d_vel_factor
+        acc = max(self.min_a, min(self.max_a, acc))
+        return acc
+
+    def idm_decision(self, car, car_states, idx, front_idx, road_length):
+        # Intelligent Driver Model (human driver): v_des as desired speed, the car's headway_time as time gap
+        car.mode = 'IDM'
+        car_pos, car_vel = car_states[idx]
+        front_car_pos, front_car_vel = car_states[front_idx]
+        gap = (car_pos - front_car_pos - self.cars[front_idx].length) % road_length
+        braking = car_vel * (car_vel - front_car_vel) / (2 * math.sqrt(self.max_a * IDM_DECELERATION))
+        s_star = self.min_dis + max(0.0, car_vel * car.headway_time + braking)
+        acc = self.max_a * (1 - (car_vel / self.v_des) ** IDM_DELTA - (s_star / max(gap, IDM_MIN_GAP)) ** 2)
+        acc = max(self.min_a, min(self.max_a, acc))
+        return acc
+
+    def integrated_decisions(self, car_states, road_length, dt):
+        # ACC+BCC law for every ACC+BCC car with the kernels module (kernel='compiled')
+        cars = self.cars
+        array = kernels.array
+        pos = array([p for p, v in car_states])
+        vel = array([v for p, v in car_states])
+        length = array([car.length for car in cars])
+        acc = array([car.acceleration for car in cars])
+        iF = array([car.integration_factor for car in cars])
+        mode = array([0] * len(cars), np.int64)
+        front = array(self.neighbors.front, np.int64)
+        back = array(self.neighbors.back, np.int64)
+        integrated = np.flatnonzero(self.controllers == INTEGRATED_CONTROL)
+        kernels.integrated_accelerations(pos, vel, length, acc, iF, mode, front, back, array(integrated, np.int64),
+                                         float(road_length), float(dt), array(self.fleet.kd.tolist()),
+                                         array(self.fleet.kv.tolist()), self.min_dis,
+                                         self.reaction_time, self.min_a, self.max_a, self.min_gap)
+        acc, iF, mode = kernels.as_list(acc), kernels.as_list(iF), kernels.as_list(mode)
+        for i in integrated.tolist():
+            car = cars[i]
+            car.acceleration = acc[i]
+            car.integration_factor = iF[i]
+            car.mode = MODES[mode[i]]
+
+    def lead_acceleration(self, velocity, last_acc, dt=None):
+        # Acceleration of the lead car (index 0): stop, follow the velocity profile or reach v_des
+        if dt is None:
+            dt = self.dt
+        if getattr(self, 'leader_stop', False):
+            acc = self.kc * (0 - velocity)
+        elif self.lead_velocity_profile:
+            time = round(self.step_count * self.dt + self.substep_offset, 3)
+            target_velocity, inside = self.lead_velocity_profile.lookup(time)
+            if inside:
+                acc = (target_velocity - velocity) / dt
+            else:
+                # If time exceeds profile, maintain last velocity
+                acc = self.kc * (target_velocity - velocity)
+        else:
+            # Try to reach v_des if no velocity profile
+            acc = self.kc * (self.v_des - velocity)
+        acc = max(self.min_a, min(self.max_a, acc))
+        return self.limit_jerk(acc, last_acc, dt)
+
+    def limit_jerk(self, acc, last_acc, dt):
+        jerk  = (acc - last_acc) / dt
+        max_jerk = 5
+        if jerk > max_jerk:
+            acc = last_acc + max_jerk * dt
+        elif jerk < -max_jerk:
+            acc = last_acc - max_jerk * dt
+        return acc
             
 
     def calculate_integration_factor(self, front_gap, back_gap, X, car, front_car, rear_car, idx):
@@ -447,8 +839,15 @@ class City:
         if dt is None:
             dt = self.dt
         # Move all cars forward based on their velocity and acceleration
+        # Positions and velocities are recorded as Car.update leaves them (before clamping and collisions)
+        positions = []
+        velocities = []
+        accelerations = []
         for car in self.cars:
             car.update(dt)
+            positions.append(car.pos)
+            velocities.append(car.velocity)
+            accelerations.append(car.acceleration)
             # Clamp velocity to not exceed max_v
             car.velocity = max(self.min_v, min(car.velocity, self.max_v))
 
@@ -457,36 +856,48 @@ class City:
                 car.collision_timer -= 1
                 if car.collision_timer == 0:
                     car.color = car.original_color
-        # Handle any collisions that may have occurred
-        self.handle_collisions()
-
-    def handle_collisions(self):
-        # Sort cars by position to check for overlaps (circular road)
+        # Energy of the step for the whole fleet at once, at the velocities Car.update left
+        consumed, recovered = self.energy_model.step(np.array(velocities), np.array(accelerations), dt)
+        for car, e, r in zip(self.cars, consumed.tolist(), recovered.tolist()):
+            car.energy_used += e
+            car.energy_recovered += r
+        # Handle any collisions that may have occurred; resolving them keeps the repaired ring order
+        self.neighbors.update()
+        self.handle_collisions(dt)
+        return positions, velocities
+
+    def handle_collisions(self, dt=None):
+        # Overlaps are found along the ring order kept by self.neighbors (repaired by move_forward before this runs)
         road_length = self.roads[0].length if self.roads else 1000
-        sorted_cars = sorted(self.cars, key=lambda c: c.pos)
-        for i, car in enumerate(sorted_cars):
-            next_car = sorted_cars[(i + 1) % len(sorted_cars)]
-            if car == next_car:
-                continue
-            min_gap = self.min_gap  # Use instance parameter
-
-            # Calculate gap considering circular road
-            hasCollided = ((next_car.pos - car.pos) % road_length) <= car.length
-            if hasCollided:
-                v1 = car.velocity
-                v2 = next_car.velocity
-                e = car.CoR if hasattr(car, 'CoR') else 0.3
-
-                # Prevent overlap: set next_car just behind car with an addition of min_gap
-                car.velocity = ((1 - e) * v1 + (1 + e) * v2) / 2
-                next_car.velocity = ((1 - e) * v2 + (1 + e) * v1) / 2
-
-                next_car.pos = (car.pos + car.length + min_gap) % road_length
-
+        cars = self.cars
+        front = self.neighbors.front
+        overlapping = [(car.pos - cars[front[i]].pos) % road_length <= cars[front[i]].length and front[i] != i
+                       for i, car in enumerate(cars)]
+        if not any(overlapping):
+            return
+        pos = [car.pos for car in cars]
+        vel = [car.velocity for car in cars]
+        # Start the pass at a car that is clear of the car in front of it, so no pileup is split
+        start = overlapping.index(False) if not all(overlapping) else 0
+        collisions = resolve_collisions(pos, vel, [car.length for car in cars],
+                                        [getattr(car, 'CoR', 0.3) for car in cars], [car.mass for car in cars],
+                                        road_length, self.min_gap, self.neighbors.back, start)
+        for front_idx, idx, closing_speed, energy_lost in collisions:
+            for i in (front_idx, idx):
+                car = cars[i]
+                car.pos = pos[i]
+                car.velocity = vel[i]
                 # Change color to indicate collision and start timer
                 car.color = 'orange'
-                next_car.color = 'orange'
                 car.collision_timer = 40  # 40 steps * 0.1s = 4 seconds
-                next_car.collision_timer = 40
+            self.log_collision(front_idx, idx, closing_speed, energy_lost, dt)
+
+    def log_collision(self, front, follower, closing_speed, energy_lost, dt=None):
+        # Collisions are logged at the end of the (sub)step in which they were resolved
+        if dt is None:
+            dt = self.dt
+        time = self.step_count * self.dt + self.substep_offset + dt
+        self.collisions.append(Collision(self.step_count + 1, time, front, follower, closing_speed, energy_lost))
+        self.collision_count += 1
     
      
\ No newline at end of file
@@ -4,11 +4,13 @@ Control_window.py: Contains the ControlWindow class for managing the traffic sim
 
 
 import tkinter as tk
+from contextlib import nullcontext
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
-import csv
 from city import City
+from profile_loader import load_profile
+from simulation_worker import SimulationWorker
 from transportation_painter import TransportationPainter
 
 class ControlWindow:
@@ -58,7 +60,9 @@ class ControlWindow:
             "max_a": 3.0,
             "min_a": -5.0,
             "min_gap": 2.0,
-            "dt": 0.1 
+            "dt": 0.1,
+            "speed": 1.0,
+            "max_fps": 30
         }
         
         params = [
@@ -75,7 +79,9 @@ class ControlWindow:
             ("max_a", "Max Acceleration"),
             ("min_a", "Min Acceleration"),
             ("min_gap", "Minimum Gap Between Cars (for collision check)"),
-            ("dt", "Simulation Time Step (dt)")  
+            ("dt", "Simulation Time Step (dt)"),
+            ("speed", "Simulation Speed (x real time, 0 = as fast as possible)"),
+            ("max_fps", "Display Frame Rate Cap (fps)")
         ]
 
         # Create label and entry for each parameter
@@ -137,9 +143,15 @@ class ControlWindow:
         tk.Label(self.scrollable_frame, text="ACC and BCC Combined").pack()
         self.energy_label_accbcc = tk.Label(self.scrollable_frame, text="Total Energy : 0 KwH", font=("Arial", 10, "bold"))
         self.energy_label_accbcc.pack()
-        
-        # Timer for simulation updates
+        self.status_label = tk.Label(self.scrollable_frame, text="Simulated time : 0.0 s")
+        self.status_label.pack()
+
+        # Timer for display updates; the simulation itself runs in self.worker (see simulation_worker.py)
         self.timer = None
+        self.worker = None
+        self.frame_sequence = 0
+        self.max_fps = default_values["max_fps"]
+        self.master.protocol("WM_DELETE_WINDOW", self.close)
 
         # Flags to control leader stop for ACC and BCC
         self.leader_stop = False
@@ -147,23 +159,10 @@ class ControlWindow:
 
         self.dt = default_values["dt"] 
     
-    def load_velocity_profile(self, filename="data.csv"):
-        self.ego_velocity_profile = []
-        self.ego_velocity_profile_1 = []
-        with open("data.csv", 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                time = float(row['time'])
-                velocity = float(row['velocity'])
-                self.ego_velocity_profile.append((time, velocity))
-
-        with open("data2.csv", 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                time = float(row['time'])
-                velocity = float(row['velocity'])
-                self.ego_velocity_profile_1.append((time, velocity))
-        print("Velocity profile loaded from", "data1.csv and data2.csv")
+    def load_velocity_profile(self, filename="data.csv", follower_filename="data2.csv", units='m/s'):
+        self.ego_velocity_profile = load_profile(filename, units)
+        self.ego_velocity_profile_1 = load_profile(follower_filename, units)
+        print("Velocity profile loaded from", filename, "and", follower_filename)
 
     def run_simulation(self):
        # Get parameter values from entry fields
@@ -177,7 +176,11 @@ class ControlWindow:
             args.append(val)
 
         self.dt = args[-1]  # Set self.dt from user input
+        speed = self.read_number("speed", 1.0)
+        self.max_fps = max(self.read_number("max_fps", 30), 1)
 
+        # The previous run's worker must not keep stepping cities that are no longer shown
+        self.stop_worker()
         self.city_acc = City()
         self.city_bcc = City()
         self.city_accbcc = City()
@@ -212,30 +215,65 @@ class ControlWindow:
             self.city_accbcc.lead_velocity_profile = []
             self.city_accbcc.follower_velocity_profile = []
 
+        self.worker = SimulationWorker([self.city_acc, self.city_bcc, self.city_accbcc], self.dt, speed or None)
+        self.worker.leader_stop = self.leader_stop
+        self.worker.follower_stop = self.follower_stop
+        self.frame_sequence = 0
+        self.worker.start()
+
         self.master.after(60000, self.plot_vel_acc_profiles)
         self.start_timer()
 
+    def read_number(self, key, default):
+        try:
+            return float(self.entries[key].get())
+        except ValueError:
+            return default
+
     def start_timer(self):
-        # Cancel previous timer if exists, then start updating simulation
+        # Cancel previous timer if exists, then start updating the display
         if self.timer:
             self.master.after_cancel(self.timer)
         self.update_simulation()
+
+    def stop_worker(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+    def close(self):
+        self.stop_worker()
+        self.master.destroy()
+
+    def simulation_paused(self):
+        # The recorded histories are only consistent while the worker is between steps
+        return self.worker.paused() if self.worker is not None else nullcontext()
    
     def plot_vel_acc_profiles(self):
+        # matplotlib copies the data when plotting, so the worker only waits while the figure is built
+        with self.simulation_paused():
+            drawn = self.draw_vel_acc_profiles()
+        if drawn:
+            plt.show()
+
+    def draw_vel_acc_profiles(self):
         dt = self.dt  # Consistent time step
+        if self.city_acc.recorder is None:
+            return False  # Nothing has been simulated yet
 
         fig, axes = plt.subplots(3, 2, figsize=(14, 10), sharex='col')
 
         # === ACC ===
         # Velocity (left)
-        for idx, car in enumerate(self.city_acc.cars):
-            time_axis = [dt * i for i in range(len(car.vel_history))]
+        velocity = self.city_acc.recorder.velocity
+        time_axis = self.city_acc.recorder.time(dt)
+        for idx in range(len(self.city_acc.cars)):
             if idx == 0:
-                axes[0, 0].plot(time_axis, car.vel_history,color="red", linewidth=0.5)
+                axes[0, 0].plot(time_axis, velocity[:, idx],color="red", linewidth=0.5)
             elif idx == 2:
-                axes[0, 0].plot(time_axis, car.vel_history,color="green", linewidth=0.5)
+                axes[0, 0].plot(time_axis, velocity[:, idx],color="green", linewidth=0.5)
             else:
-                axes[0, 0].plot(time_axis, car.vel_history,color="blue", linewidth = 0.5)
+                axes[0, 0].plot(time_axis, velocity[:, idx],color="blue", linewidth = 0.5)
 
         axes[0, 0].set_title("ACC Velocity")
         axes[0, 0].set_ylabel("Velocity (m/s)")
@@ -243,14 +281,15 @@ class ControlWindow:
         axes[0, 0].grid(True)
 
         # Acceleration (right)
-        for idx, car in enumerate(self.city_acc.cars):
-            time_axis = [dt * i for i in range(len(car.acc_history))]
+        acceleration = self.city_acc.recorder.acceleration
+        time_axis = self.city_acc.recorder.time(dt)
+        for idx in range(len(self.city_acc.cars)):
             if idx == 0:
-                axes[0, 1].plot(time_axis, car.acc_history, color="red", linewidth=0.5)
+                axes[0, 1].plot(time_axis, acceleration[:, idx], color="red", linewidth=0.5)
             elif idx == 2:
-                axes[0, 1].plot(time_axis, car.acc_history, color="green", linewidth=0.5)
+                axes[0, 1].plot(time_axis, acceleration[:, idx], color="green", linewidth=0.5)
             else:
-                axes[0, 1].plot(time_axis, car.acc_history, color="blue", linewidth = 0.5)
+                axes[0, 1].plot(time_axis, acceleration[:, idx], color="blue", linewidth = 0.5)
         axes[0, 1].set_title("ACC Acceleration")
         axes[0, 1].set_ylabel("Acceleration (m/s^2)")
         # axes[0, 1].legend(fontsize="x-small")
@@ -258,28 +297,30 @@ class ControlWindow:
 
         # === BCC ===
         # Velocity (left)
-        for idx, car in enumerate(self.city_bcc.cars):
-            time_axis = [dt * i for i in range(len(car.vel_history))]
+        velocity = self.city_bcc.recorder.velocity
+        time_axis = self.city_bcc.recorder.time(dt)
+        for idx in range(len(self.city_bcc.cars)):
             if idx == 0:
-                axes[1, 0].plot(time_axis, car.vel_history, color="red", linewidth=0.5)
+                axes[1, 0].plot(time_axis, velocity[:, idx], color="red", linewidth=0.5)
             elif idx == 2:
-                axes[1, 0].plot(time_axis, car.vel_history, color="green", linewidth=0.5)
+                axes[1, 0].plot(time_axis, velocity[:, idx], color="green", linewidth=0.5)
             else:
-                axes[1, 0].plot(time_axis, car.vel_history, color="blue", linewidth = 0.5)
+                axes[1, 0].plot(time_axis, velocity[:, idx], color="blue", linewidth = 0.5)
         axes[1, 0].set_title("BCC Velocity")
         axes[1, 0].set_ylabel("Velocity (m/s)")
         # axes[1, 0].legend(fontsize="x-small")
         axes[1, 0].grid(True)
 
         # Acceleration (right)
-        for idx, car in enumerate(self.city_bcc.cars):
-            time_axis = [dt * i for i in range(len(car.acc_history))]
+        acceleration = self.city_bcc.recorder.acceleration
+        time_axis = self.city_bcc.recorder.time(dt)
+        for idx in range(len(self.city_bcc.cars)):
             if idx == 0:
-                axes[1, 1].plot(time_axis, car.acc_history, color="red", linewidth=0.5)
+                axes[1, 1].plot(time_axis, acceleration[:, idx], color="red", linewidth=0.5)
             elif idx == 2:
-                axes[1, 1].plot(time_axis, car.acc_history, color="green", linewidth=0.5)
+                axes[1, 1].plot(time_axis, acceleration[:, idx], color="green", linewidth=0.5)
             else:
-                axes[1, 1].plot(time_axis, car.acc_history, color="blue", linewidth = 0.5)
+                axes[1, 1].plot(time_axis, acceleration[:, idx], color="blue", linewidth = 0.5)
         axes[1, 1].set_title("BCC Acceleration")
         axes[1, 1].set_ylabel("Acceleration  (m/s^2)")
         # axes[1, 1].legend(fontsize="x-small")
@@ -287,14 +328,15 @@ class ControlWindow:
 
         # === ACC+BCC ===
         # Velocity (left)
-        for idx, car in enumerate(self.city_accbcc.cars):
-            time_axis = [dt * i for i in range(len(car.vel_history))]
+        velocity = self.city_accbcc.recorder.velocity
+        time_axis = self.city_accbcc.recorder.time(dt)
+        for idx in range(len(self.city_accbcc.cars)):
             if idx == 0:
-                axes[2, 0].plot(time_axis, car.vel_history, color="red", linewidth=0.5)
+                axes[2, 0].plot(time_axis, velocity[:, idx], color="red", linewidth=0.5)
             elif idx == 2:
-                axes[2, 0].plot(time_axis, car.vel_history, color="green", linewidth=0.5)
+                axes[2, 0].plot(time_axis, velocity[:, idx], color="green", linewidth=0.5)
             else:
-                axes[2, 0].plot(time_axis, car.vel_history, color="blue", linewidth = 0.5)
+                axes[2, 0].plot(time_axis, velocity[:, idx], color="blue", linewidth = 0.5)
         axes[2, 0].set_title("ACC+BCC Integration Velocity")
         axes[2, 0].set_xlabel("Time (s)")
         axes[2, 0].set_ylabel("Velocity (m/s)")
@@ -302,14 +344,15 @@ class ControlWindow:
         axes[2, 0].grid(True)
 
         # Acceleration (right)
-        for idx, car in enumerate(self.city_accbcc.cars):
-            time_axis = [dt * i for i in range(len(car.acc_history))]
+        acceleration = self.city_accbcc.recorder.acceleration
+        time_axis = self.city_accbcc.recorder.time(dt)
+        for idx in range(len(self.city_accbcc.cars)):
             if idx == 0:
-                axes[2, 1].plot(time_axis, car.acc_history, color="red", linewidth=0.5)
+                axes[2, 1].plot(time_axis, acceleration[:, idx], color="red", linewidth=0.5)
             elif idx == 2:
-                axes[2, 1].plot(time_axis, car.acc_history, color="green", linewidth=0.5)
+                axes[2, 1].plot(time_axis, acceleration[:, idx], color="green", linewidth=0.5)
             else:
-                axes[2, 1].plot(time_axis, car.acc_history, color="blue", linewidth = 0.5)
+                axes[2, 1].plot(time_axis, acceleration[:, idx], color="blue", linewidth = 0.5)
         axes[2, 1].set_title("ACC+BCC Integration Acceleration")
         axes[2, 1].set_xlabel("Time (s)")
         axes[2, 1].set_ylabel("Acceleration (m/s^2)")
@@ -317,60 +360,55 @@ class ControlWindow:
         axes[2, 1].grid(True)
 
         plt.tight_layout()
-        plt.show()
+        return True
 
     def update_simulation(self):
-        dt = self.dt 
+        # Paint the newest snapshot the worker has published; frames it stepped past in the meantime are skipped
+        frame = self.worker.channel.take(self.frame_sequence) if self.worker is not None else None
+        if frame is not None:
+            self.frame_sequence, (snapshot_acc, snapshot_bcc, snapshot_accbcc) = frame
 
-        # Set leader stop flags for both cities
-        self.city_acc.set_leader_stop(self.leader_stop)
-        self.city_acc.set_follower_stop(self.follower_stop)
-        self.city_bcc.set_leader_stop(self.leader_stop)
-        self.city_bcc.set_follower_stop(self.follower_stop)
-        self.city_accbcc.set_leader_stop(self.leader_stop)
-        self.city_accbcc.set_follower_stop(self.follower_stop)
+            # Update painters with the snapshot's copies of the cars
+            self.painter_acc.set_elements(snapshot_acc.roads, snapshot_acc.cars)
+            self.painter_bcc.set_elements(snapshot_bcc.roads, snapshot_bcc.cars)
+            self.painter_accbcc.set_elements(snapshot_accbcc.roads, snapshot_accbcc.cars)
 
-        # Run simulation step for both cities with fixed dt
-        self.city_acc.run(dt)
-        self.city_bcc.run(dt)
-        self.city_accbcc.run(dt)
+            # Redraw the visualizations
+            self.painter_acc.repaint()
+            self.painter_bcc.repaint()
+            self.painter_accbcc.repaint()
 
-        # Update painters with new city elements
-        self.painter_acc.set_elements(self.city_acc.roads, self.city_acc.cars)
-        self.painter_bcc.set_elements(self.city_bcc.roads, self.city_bcc.cars)
-        self.painter_accbcc.set_elements(self.city_accbcc.roads, self.city_accbcc.cars)
-
-        # Redraw the visualizations
-        self.painter_acc.repaint()
-        self.painter_bcc.repaint()
-        self.painter_accbcc.repaint()
+            # Update label texts
+            self.energy_label_acc.config(text=f"Total Energy : {snapshot_acc.energy:.4f} KwH")
+            self.energy_label_bcc.config(text=f"Total Energy : {snapshot_bcc.energy:.4f} KwH")
+            self.energy_label_accbcc.config(text=f"Total Energy : {snapshot_accbcc.energy:.4f} KwH")
+            self.status_label.config(text=f"Simulated time : {snapshot_acc.time:.1f} s")
+        if self.worker is not None and self.worker.error is not None:
+            self.status_label.config(text=f"Simulation stopped: {self.worker.error}")
 
-        # Calculate total energy
-        total_energy_acc = sum(car.energy_used for car in self.city_acc.cars)
-        total_energy_bcc = sum(car.energy_used for car in self.city_bcc.cars)
-        total_energy_accbcc = sum(car.energy_used for car in self.city_accbcc.cars)
-        
-        # Update label texts
-        self.energy_label_acc.config(text=f"Total Energy : {total_energy_acc:.4f} KwH")
-        self.energy_label_bcc.config(text=f"Total Energy : {total_energy_bcc:.4f} KwH")
-        self.energy_label_accbcc.config(text=f"Total Energy : {total_energy_accbcc:.4f} KwH")
-
-        # Schedule next update for 0.1 seconds later (100 ms)
-        self.timer = self.master.after(int(dt*1000), self.update_simulation)
+        # Schedule the next frame at the capped frame rate
+        self.timer = self.master.after(int(1000 / self.max_fps), self.update_simulation)
 
 
     def stop_lead(self):
         print("Stopping lead for ACC, BCC, and ACC+BCC")
-        self.leader_stop = True
+        self.set_stop_flags(leader_stop=True)
     
     def resume_lead(self):
-        self.leader_stop = False
+        self.set_stop_flags(leader_stop=False)
 
     def stop_follower(self):
-        self.follower_stop = True
+        self.set_stop_flags(follower_stop=True)
 
     def resume_follower(self):
-        self.follower_stop = False
+        self.set_stop_flags(follower_stop=False)
+
+    def set_stop_flags(self, **flags):
+        # The worker applies the flags to every city before its next step
+        for name, value in flags.items():
+            setattr(self, name, value)
+            if self.worker is not None:
+                setattr(self.worker, name, value)
 
 
 if __name__ == "__main__":
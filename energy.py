@@ -0,0 +1,198 @@
+"""
+energy.py: Fleet energy model with pluggable powertrain maps and regenerative braking.
+
+FleetEnergy keeps the vehicle constants of every car (mass, Cr, Cd, frontal
+area) in arrays and computes the traction power of the whole fleet (or of a
+replica x car block) in one vectorised call per step:
+
+    F = m a + Cr m g + 0.5 Cd rho A v^2,    P_wheel = F v
+
+Each car is driven by a Powertrain. Its motor map gives the efficiency of
+turning battery power into wheel power (P_wheel > 0) and its regen map the
+efficiency of recovering braking power (P_wheel < 0), both as functions of
+motor speed (rpm) and torque (Nm) looked up by bilinear interpolation. The
+default powertrain has no maps: wheel energy is counted 1:1 when driving and
+nothing is recovered when braking, which is the energy City has always
+reported. Consumed and recovered energy are tracked separately (kWh).
+
+Maps are read with EfficiencyMap.load from a .npz file (arrays `speed`,
+`torque` and `efficiency` of shape speed x torque) or a CSV grid whose first
+row holds the torques and whose first column holds the speeds.
+"""
+
+import numpy as np
+
+GRAVITY = 9.8
+AIR_DENSITY = 1.225
+
+# Efficiencies below this are treated as this, so a sparse map corner cannot blow up the battery power
+MIN_EFFICIENCY = 0.05
+
+
+def grid_position(grid, x):
+    """Cell index i (0 .. len(grid) - 2) and fraction t (0 .. 1) of x within grid[i] .. grid[i + 1], clamped."""
+    x = np.clip(x, grid[0], grid[-1])
+    steps = np.diff(grid)
+    if np.allclose(steps, steps[0]):
+        # Evenly spaced grid (the usual map layout): the cell follows from a division instead of a search
+        u = (x - grid[0]) * (1 / steps[0])
+        i = np.minimum(u.astype(np.intp), len(grid) - 2)
+        return i, u - i
+    i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    return i, (x - grid[i]) / steps[i]
+
+
+def interpolate(xs, ys, values, x, y):
+    """Bilinear interpolation of the grid values[len(xs), len(ys)] at the points (x, y), clamped to the grid."""
+    i, tx = grid_position(xs, x)
+    j, ty = grid_position(ys, y)
+    flat = np.ravel(values)
+    k = i * len(ys) + j
+    v00, v01 = flat.take(k), flat.take(k + 1)
+    v10, v11 = flat.take(k + len(ys)), flat.take(k + len(ys) + 1)
+    low = v00 + tx * (v10 - v00)
+    high = v01 + tx * (v11 - v01)
+    return low + ty * (high - low)
+
+
+class EfficiencyMap:
+    """Efficiency (0 .. 1) on a motor speed (rpm) x torque (Nm) grid."""
+
+    def __init__(self, speeds, torques, efficiency):
+        self.speeds = np.asarray(speeds, dtype=float)
+        self.torques = np.asarray(torques, dtype=float)
+        self.efficiency = np.asarray(efficiency, dtype=float)
+        if len(self.speeds) < 2 or len(self.torques) < 2:
+            raise ValueError("An efficiency map needs at least two speeds and two torques")
+        if (np.diff(self.speeds) <= 0).any() or (np.diff(self.torques) <= 0).any():
+            raise ValueError("Efficiency map speeds and torques must be strictly increasing")
+        if self.efficiency.shape != (len(self.speeds), len(self.torques)):
+            raise ValueError(f"Efficiency grid has shape {self.efficiency.shape}, "
+                             f"expected {(len(self.speeds), len(self.torques))}")
+        # Maps given in percent
+        if self.efficiency.max() > 1:
+            self.efficiency = self.efficiency / 100
+        self.efficiency = np.clip(self.efficiency, MIN_EFFICIENCY, 1.0)
+
+    def __call__(self, speed, torque):
+        return interpolate(self.speeds, self.torques, self.efficiency, speed, torque)
+
+    @classmethod
+    def load(cls, path):
+        if str(path).endswith('.npz'):
+            with np.load(path) as data:
+                return cls(data["speed"], data["torque"], data["efficiency"])
+        grid = np.loadtxt(path, delimiter=',', dtype=str)
+        torques = grid[0, 1:].astype(float)
+        speeds = grid[1:, 0].astype(float)
+        return cls(speeds, torques, grid[1:, 1:].astype(float))
+
+
+class Powertrain:
+    """
+    Converts wheel power into battery power. Motor speed and torque follow
+    from the vehicle speed and tractive force through the wheel radius and
+    the gear ratio. Without a motor_map the drive is lossless; without a
+    regen_map no braking energy is recovered. max_regen_power (W) caps the
+    recovered power, the rest goes to the friction brakes.
+    """
+
+    def __init__(self, motor_map=None, regen_map=None, wheel_radius=0.32, gear_ratio=9.0, max_regen_power=None):
+        self.motor_map = motor_map
+        self.regen_map = regen_map
+        self.wheel_radius = wheel_radius
+        self.gear_ratio = gear_ratio
+        self.max_regen_power = max_regen_power
+
+    @classmethod
+    def from_files(cls, motor_path=None, regen_path=None, **kwargs):
+        return cls(EfficiencyMap.load(motor_path) if motor_path else None,
+                   EfficiencyMap.load(regen_path) if regen_path else None, **kwargs)
+
+    def operating_point(self, vel, force):
+        # Motor speed in rpm and motor torque in Nm
+        speed = vel / self.wheel_radius * self.gear_ratio * 60 / (2 * np.pi)
+        torque = force * self.wheel_radius / self.gear_ratio
+        return speed, torque
+
+    def battery_power(self, vel, force):
+        """(power drawn, power recovered) in W for wheel power force * vel."""
+        power = force * vel
+        drawn = np.where(power > 0, power, 0.0)
+        recovered = np.zeros_like(drawn)
+        if self.motor_map is None and self.regen_map is None:
+            return drawn, recovered
+        speed, torque = self.operating_point(vel, force)
+        if self.motor_map is not None:
+            drawn = drawn / self.motor_map(speed, torque)
+        if self.regen_map is not None:
+            braking = np.where(power < 0, -power, 0.0)
+            recovered = braking * self.regen_map(speed, -torque)
+            if self.max_regen_power is not None:
+                recovered = np.minimum(recovered, self.max_regen_power)
+        return drawn, recovered
+
+
+# Lossless drive without regeneration: the energy City reported before powertrains existed
+IDEAL = Powertrain()
+
+
+class FleetEnergy:
+    """
+    Vehicle constants of a fleet as arrays (one entry per car, or replica x car)
+    and the powertrain of every car: powertrains is a list and powertrain_index
+    picks one per car (all cars use powertrains[0] when it is None).
+    """
+
+    def __init__(self, mass, Cr, Cd, frontal_area, powertrains=(IDEAL,), powertrain_index=None):
+        self.mass = np.asarray(mass, dtype=float)
+        self.Cr = np.asarray(Cr, dtype=float)
+        self.Cd = np.asarray(Cd, dtype=float)
+        self.frontal_area = np.asarray(frontal_area, dtype=float)
+        self.powertrains = list(powertrains)
+        self.powertrain_index = None if powertrain_index is None else np.asarray(powertrain_index, dtype=np.intp)
+        if len(self.powertrains) > 1 and self.powertrain_index is None:
+            raise ValueError("powertrain_index is needed with more than one powertrain")
+        # Groups are used as boolean masks, so each powertrain is evaluated once per step on its own cars
+        if self.powertrain_index is None or len(self.powertrains) == 1:
+            self.groups = None
+        else:
+            self.groups = [self.powertrain_index == k for k in range(len(self.powertrains))]
+
+    @classmethod
+    def from_cars(cls, cars, shape=None):
+        """
+        Reads the constants and the `powertrain` attribute (None for IDEAL) of
+        every Car; the arrays are reshaped to shape (e.g. replica x car) if given.
+        """
+        cars = list(cars)
+        powertrains = []
+        index = []
+        for car in cars:
+            powertrain = getattr(car, 'powertrain', None) or IDEAL
+            if powertrain not in powertrains:
+                powertrains.append(powertrain)
+            index.append(powertrains.index(powertrain))
+        shape = (len(cars),) if shape is None else shape
+        columns = [np.reshape([getattr(c, name) for c in cars], shape) for name in ('mass', 'Cr', 'Cd', 'frontal_area')]
+        return cls(*columns, powertrains or [IDEAL], np.reshape(index, shape) if len(powertrains) > 1 else None)
+
+    def force(self, vel, acc):
+        # Inertia, rolling resistance and drag, in N
+        F_inertia = self.mass * acc
+        F_roll = self.Cr * self.mass * GRAVITY
+        F_drag = 0.5 * self.Cd * AIR_DENSITY * self.frontal_area * vel ** 2
+        return F_inertia + F_roll + F_drag
+
+    def step(self, vel, acc, dt):
+        """(energy consumed, energy recovered) of every car over a step of dt at vel and acc, in kWh."""
+        force = self.force(vel, acc)
+        if self.groups is None:
+            drawn, recovered = self.powertrains[0].battery_power(vel, force)
+        else:
+            vel = np.broadcast_to(vel, force.shape)
+            drawn = np.zeros(force.shape)
+            recovered = np.zeros(force.shape)
+            for powertrain, group in zip(self.powertrains, self.groups):
+                drawn[group], recovered[group] = powertrain.battery_power(vel[group], force[group])
+        return drawn * dt / 3600000, recovered * dt / 3600000
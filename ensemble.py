@@ -0,0 +1,91 @@
+"""
+ensemble.py: Contains the Ensemble class, many independent rings advanced in one array step.
+"""
+
+import numpy as np
+from parallel_runner import build_city
+from vector_engine import VectorEngine
+
+class Ensemble:
+    """
+    R replicas of the same ring (same model and number of cars), each a normal
+    City with its own gains, initial spacing, profile, recorder and gap
+    statistics. run() advances all of them with one VectorEngine step on
+    (replica x car) arrays, giving the same results as running each City on
+    its own. Replicas are stepped by the ensemble, so call Ensemble.run()
+    rather than City.run() on them.
+
+    To keep the per-replica Python work out of the step loop, the Car objects,
+    recorders and gap statistics are brought up to date every flush_steps
+    steps in blocks. Indexing the ensemble (ensemble[r]) flushes first, so the
+    City it returns is always current; call flush() before reading
+    ensemble.cities directly.
+    """
+
+    def __init__(self, cities, flush_steps=64):
+        self.cities = list(cities)
+        for city in self.cities:
+            city.engine = None
+        self.engine = VectorEngine(self.cities)
+        self.flush_steps = flush_steps
+        self.pending = []
+
+    @classmethod
+    def from_params(cls, params_list, model='ACC', lead_velocity_profile=(), flush_steps=64):
+        """Builds one replica per run_headless style params dict (e.g. different kd or min_dis)."""
+        return cls([build_city(params, model, lead_velocity_profile) for params in params_list], flush_steps)
+
+    def __len__(self):
+        return len(self.cities)
+
+    def __getitem__(self, replica):
+        self.flush()
+        return self.cities[replica]
+
+    def run(self, dt=None):
+        if dt is None:
+            dt = self.cities[0].dt
+        engine = self.engine
+        positions, velocities, gap_rows = engine.advance(dt)
+        # The engine replaces its float state arrays every step, so keeping references is enough;
+        # the mode array is updated in place and has to be copied
+        self.pending.append((positions, velocities, engine.acc, gap_rows, engine.energy, engine.iF, engine.mode.copy()))
+        for city in self.cities:
+            city.step_count += 1
+        if len(self.pending) >= self.flush_steps:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending steps into every replica's cars, recorder and gap statistics."""
+        if not self.pending:
+            return
+        # (channel x step x replica x car)
+        blocks = [np.stack(channel) for channel in zip(*self.pending)]
+        self.pending = []
+        self.engine.sync_cars()
+        for r, city in enumerate(self.cities):
+            position, velocity, acceleration, gap, energy, iF, mode = (block[:, r] for block in blocks)
+            if city.recorder is not None:
+                city.recorder.record(position, velocity, acceleration, gap, energy, iF, mode)
+            city.record_gaps(gap)
+
+    # (replica x car) views of the current state
+    @property
+    def positions(self):
+        return self.engine.pos
+
+    @property
+    def velocities(self):
+        return self.engine.vel
+
+    @property
+    def accelerations(self):
+        return self.engine.acc
+
+    @property
+    def energy_used(self):
+        return self.engine.energy
+
+    @property
+    def energy_recovered(self):
+        return self.engine.recovered
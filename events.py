@@ -0,0 +1,172 @@
+"""
+events.py: Detectors that watch a City while it runs and can end the run early.
+
+A detector is attached with City.add_detector() and checked after every
+step against the row the City has just recorded. When it fires, the City
+logs an Event, calls the detector's callback (callback(city, event)) and
+acts on the detector's action:
+
+  - 'stop': the City stops (City.stopped); run loops skip stopped cities
+  - 'fast_forward': the City stops and the rest of the run can be filled in
+    with City.fast_forward(), which extrapolates the current steady state
+  - 'continue': only the event and the callback
+
+Every detector fires at most once. The collisions themselves are logged as
+Collision records in City.collisions.
+"""
+
+import numpy as np
+
+ACTIONS = ('stop', 'fast_forward', 'continue')
+
+
+class Event:
+    def __init__(self, name, step, time, detail):
+        self.name = name
+        self.step = step
+        self.time = time
+        self.detail = detail
+
+    def __repr__(self):
+        return f"Event({self.name!r}, step={self.step}, time={self.time:.2f}, detail={self.detail!r})"
+
+
+class Collision:
+    """One resolved collision, logged by City.handle_collisions in City.collisions."""
+
+    def __init__(self, step, time, front, follower, closing_speed, energy_lost):
+        self.step = step
+        self.time = time
+        # Car indices: the car in front and the car that ran into it
+        self.front = front
+        self.follower = follower
+        self.closing_speed = closing_speed  # m/s
+        self.energy_lost = energy_lost  # J of kinetic energy
+
+    def __repr__(self):
+        return (f"Collision(step={self.step}, time={self.time:.2f}, pair=({self.front}, {self.follower}), "
+                f"closing_speed={self.closing_speed:.2f}, energy_lost={self.energy_lost:.0f})")
+
+
+class Detector:
+    """Base class; check(city) returns a description of the event when it happens, else None."""
+    name = 'event'
+
+    def __init__(self, action='stop', callback=None, **config):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action: {action}")
+        self.action = action
+        self.callback = callback
+        # Settings that determine when the detector fires (see sweep.point_id)
+        self.config = dict(config, action=action)
+        self.fired = False
+
+    def attach(self, city):
+        # Called by City.add_detector, before the detector is first checked
+        pass
+
+    def check(self, city):
+        raise NotImplementedError
+
+
+class SteadyState(Detector):
+    """
+    Fires when every velocity and every gap has stayed within epsilon of its
+    value at the start of a window of `duration` seconds. The window only
+    starts once City.inputs_steady(): a plateau of a velocity profile that
+    has samples left, or a leader or follower stop, is not a steady state.
+    """
+    name = 'steady_state'
+
+    def __init__(self, duration=10.0, velocity_epsilon=0.05, gap_epsilon=0.05, action='fast_forward', callback=None):
+        super().__init__(action, callback, duration=duration, velocity_epsilon=velocity_epsilon,
+                         gap_epsilon=gap_epsilon)
+        self.duration = duration
+        self.velocity_epsilon = velocity_epsilon
+        self.gap_epsilon = gap_epsilon
+        self.reference = None
+        self.since = 0
+
+    def check(self, city):
+        velocity = city.recorder.velocity[-1]
+        gap = city.recorder.gap[-1]
+        if not city.inputs_steady():
+            self.reference = None
+            return None
+        if (self.reference is None or np.abs(velocity - self.reference[0]).max(initial=0) > self.velocity_epsilon
+                or np.abs(gap - self.reference[1]).max(initial=0) > self.gap_epsilon):
+            # Drifted away: the window starts again here
+            self.reference = (velocity.copy(), gap.copy())
+            self.since = city.step_count
+            return None
+        if (city.step_count - self.since) * city.dt >= self.duration - 1e-9:
+            return f"steady for {self.duration:g} s at {float(velocity.mean()):.2f} m/s"
+        return None
+
+
+class FirstCollision(Detector):
+    """Fires on the first collision after the detector was attached."""
+    name = 'collision'
+
+    def __init__(self, action='stop', callback=None):
+        super().__init__(action, callback)
+        self.start_count = None
+
+    def attach(self, city):
+        # Collisions from here on count, including any in the first step after attaching
+        self.start_count = city.collision_count
+
+    def check(self, city):
+        if self.start_count is None:
+            self.start_count = 0
+        if city.collision_count > self.start_count:
+            first = city.collisions[self.start_count - city.collision_count]
+            return (f"{city.collision_count - self.start_count} collision(s), first between cars {first.front} and "
+                    f"{first.follower} at {first.closing_speed:.2f} m/s")
+        return None
+
+
+class StringInstability(Detector):
+    """
+    Fires when disturbances grow along the platoon: the peak spacing error
+    (gap minus min_dis + velocity * reaction_time) of the last follower since
+    `after` seconds exceeds `growth` times that of the first follower and is
+    at least min_error metres.
+    """
+    name = 'string_instability'
+
+    def __init__(self, growth=2.0, min_error=1.0, after=0.0, action='stop', callback=None):
+        super().__init__(action, callback, growth=growth, min_error=min_error, after=after)
+        self.growth = growth
+        self.min_error = min_error
+        self.after = after
+        self.peak = None
+
+    def check(self, city):
+        if city.step_count * city.dt < self.after or city.recorder.car_count < 3:
+            return None
+        velocity = city.recorder.velocity[-1, 1:]
+        gap = city.recorder.gap[-1, 1:]
+        # Ring gaps are taken modulo the road length, so an overlap shows up as a gap of almost a full lap
+        road_length = city.roads[0].length if city.roads else 1000
+        gap = np.where(gap > road_length / 2, gap - road_length, gap)
+        error = np.abs(gap - (city.min_dis + velocity * city.reaction_time))
+        self.peak = error if self.peak is None else np.maximum(self.peak, error)
+        first, last = float(self.peak[0]), float(self.peak[-1])
+        if last >= self.min_error and last > self.growth * first:
+            return f"spacing error grew from {first:.2f} m to {last:.2f} m along the platoon"
+        return None
+
+
+class ProfileEnd(Detector):
+    """Fires once the lead car's velocity profile has been played to its last sample."""
+    name = 'profile_end'
+
+    def __init__(self, action='stop', callback=None):
+        super().__init__(action, callback)
+
+    def check(self, city):
+        profile = city.lead_velocity_profile
+        if len(profile) and city.step_count * city.dt >= profile.times[-1]:
+            return f"lead profile ended at {float(profile.times[-1]):g} s"
+        return None
@@ -0,0 +1,156 @@
+"""
+export.py: Writes recorded trajectories to columnar files and loads them back memory-mapped.
+
+Every model gets its own partition directory (out_dir/model=ACC, ...) with a
+meta.json and one column per file:
+
+  - layout='wide': one (step x car) .npy matrix per channel plus time.npy
+  - layout='long': one row per (step, car) with time and car columns
+  - file_format='parquet': the long table as part.parquet (needs pyarrow)
+
+Columns are written chunk_steps rows at a time into memory-mapped .npy files
+(or Parquet row groups), so the long table is never held in memory at once.
+"""
+
+import json
+import os
+import numpy as np
+from recorder import CHANNELS
+from vector_engine import MODES
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+LAYOUTS = ('wide', 'long')
+FORMATS = ('npy', 'parquet')
+
+
+def partition_dir(out_dir, model):
+    return os.path.join(out_dir, f"model={model}")
+
+
+def channel_dtype(name, dtype):
+    return np.int8 if name == 'mode' else dtype
+
+
+def export_trajectories(results, out_dir, dt, layout='wide', file_format='npy', chunk_steps=4096):
+    """
+    Exports {model: City or ModelResult} (anything with a recorder) to out_dir.
+    Returns the partition directories that were written.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout}")
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown format: {file_format}")
+    if file_format == 'parquet':
+        if pq is None:
+            raise ImportError("Parquet export needs pyarrow; use file_format='npy' instead")
+        layout = 'long'
+
+    written = []
+    for model, result in results.items():
+        recorder = result.recorder
+        directory = partition_dir(out_dir, model)
+        os.makedirs(directory, exist_ok=True)
+        if file_format == 'parquet':
+            write_parquet(recorder, directory, dt, chunk_steps)
+        elif layout == 'wide':
+            write_wide(recorder, directory, dt, chunk_steps)
+        else:
+            write_long(recorder, directory, dt, chunk_steps)
+        columns = ["time"] + (["car"] if layout == 'long' else []) + list(CHANNELS)
+        meta = {"model": model, "dt": dt, "steps": recorder.steps, "car_count": recorder.car_count,
+                "layout": layout, "format": file_format, "columns": columns, "modes": list(MODES)}
+        with open(os.path.join(directory, "meta.json"), 'w') as f:
+            json.dump(meta, f, indent=2)
+        written.append(directory)
+    return written
+
+
+def open_column(directory, name, dtype, shape):
+    return np.lib.format.open_memmap(os.path.join(directory, name + ".npy"), mode='w+', dtype=dtype, shape=shape)
+
+
+def chunks(steps, chunk_steps):
+    for start in range(0, steps, chunk_steps):
+        yield start, min(start + chunk_steps, steps)
+
+
+def write_wide(recorder, directory, dt, chunk_steps):
+    steps, cars = recorder.steps, recorder.car_count
+    time = open_column(directory, "time", np.float64, (steps,))
+    time[:] = recorder.time(dt)
+    time.flush()
+    for name in CHANNELS:
+        column = open_column(directory, name, channel_dtype(name, recorder.dtype), (steps, cars))
+        source = recorder.channel(name)
+        for start, end in chunks(steps, chunk_steps):
+            column[start:end] = source[start:end]
+        column.flush()
+        del column
+
+
+def long_chunk(recorder, dt, start, end):
+    # {column: 1-D array} for steps start..end-1, one row per (step, car)
+    cars = recorder.car_count
+    rows = {"time": np.repeat(np.arange(start, end) * dt, cars),
+            "car": np.tile(np.arange(cars, dtype=np.int32), end - start)}
+    for name in CHANNELS:
+        rows[name] = recorder.channel(name)[start:end].reshape(-1).astype(channel_dtype(name, recorder.dtype))
+    return rows
+
+
+def write_long(recorder, directory, dt, chunk_steps):
+    steps, cars = recorder.steps, recorder.car_count
+    dtypes = {"time": np.float64, "car": np.int32}
+    dtypes.update({name: channel_dtype(name, recorder.dtype) for name in CHANNELS})
+    columns = {name: open_column(directory, name, dtype, (steps * cars,)) for name, dtype in dtypes.items()}
+    for start, end in chunks(steps, chunk_steps):
+        for name, values in long_chunk(recorder, dt, start, end).items():
+            columns[name][start * cars:end * cars] = values
+    for column in columns.values():
+        column.flush()
+
+
+def write_parquet(recorder, directory, dt, chunk_steps):
+    writer = None
+    try:
+        for start, end in chunks(recorder.steps, chunk_steps):
+            rows = long_chunk(recorder, dt, start, end)
+            table = pa.table({name: pa.DictionaryArray.from_arrays(values, list(MODES)) if name == 'mode' else values
+                              for name, values in rows.items()})
+            if writer is None:
+                writer = pq.ParquetWriter(os.path.join(directory, "part.parquet"), table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def load_trajectories(out_dir, model=None):
+    """
+    Opens an export. Returns {model: {"meta": meta, column: array}} with the
+    .npy columns memory-mapped read-only (Parquet partitions give a
+    memory-mapped pyarrow Table under "table"). With model set, returns only
+    that model's entry.
+    """
+    models = [model] if model is not None else sorted(
+        name[len("model="):] for name in os.listdir(out_dir) if name.startswith("model="))
+    loaded = {}
+    for name in models:
+        directory = partition_dir(out_dir, name)
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        data = {"meta": meta}
+        if meta["format"] == 'parquet':
+            if pq is None:
+                raise ImportError("Reading a Parquet export needs pyarrow")
+            data["table"] = pq.read_table(os.path.join(directory, "part.parquet"), memory_map=True)
+        else:
+            for column in meta["columns"]:
+                data[column] = np.load(os.path.join(directory, column + ".npy"), mmap_mode='r')
+        loaded[name] = data
+    return loaded[model] if model is not None else loaded
@@ -0,0 +1,184 @@
+"""
+fleet.py: Per-vehicle parameters of a platoon, stored as one contiguous array per attribute.
+
+A Fleet is a struct of arrays: fleet.length, fleet.mass, fleet.kd, ... each
+hold one float64 value per car (car 0 is the lead car), so the engines read a
+parameter of the whole platoon with one array access instead of one
+attribute lookup per car. The attributes are
+
+  length, mass, Cd, Cr, frontal_area, CoR   vehicle body and resistances
+  headway_time                              the driver's time headway
+  kd, kv                                    gap and velocity gains of the controller
+
+and fleet.controller gives the controller of every car as an index into
+CONTROLLERS (-1: the City's model). Attributes that are not given take
+VEHICLE_DEFAULTS; kd, kv and headway_time default to NaN, which City.init
+replaces with its own kd, kv and headway_time. Mixed fleets are built with
+
+  Fleet.sample(n, [{'name': 'car', 'share': 0.8, 'length': ('normal', 4.5, 0.3)},
+                   {'name': 'truck', 'share': 0.2, 'length': 12, 'mass': 15000, 'kd': 0.5}], seed=1)
+
+and mixed penetration of controllers (IDM being human drivers) with e.g.
+
+  Fleet.sample(n, [{'share': 0.3, 'controller': 'BCC'}, {'share': 0.2, 'controller': 'ACC'},
+                   {'share': 0.5, 'controller': 'IDM'}], seed=1)
+
+where a value is a number or a distribution ('uniform', low, high),
+('normal', mean, std) or ('lognormal', mean, sigma), or read with
+Fleet.load(path) from a CSV file with one row per vehicle, a header naming
+its columns and optional `class` and `controller` columns. Pass the result as
+City.init(..., fleet=...).
+"""
+
+import numpy as np
+
+VEHICLE_DEFAULTS = {
+    'length': 4.0,
+    'mass': 1800.0,
+    'Cd': 0.29,
+    'Cr': 0.015,
+    'frontal_area': 2.2,
+    'CoR': 0.2,
+    # NaN: taken from the City
+    'headway_time': np.nan,
+    'kd': np.nan,
+    'kv': np.nan,
+}
+FIELDS = tuple(VEHICLE_DEFAULTS)
+# Car-following controllers; City.controllers holds LEAD for the lead car
+CONTROLLERS = ('ACC', 'BCC', 'ACC+BCC', 'IDM')
+ACC_CONTROL, BCC_CONTROL, INTEGRATED_CONTROL, IDM_CONTROL = range(len(CONTROLLERS))
+LEAD = -1
+DISTRIBUTIONS = ('uniform', 'normal', 'lognormal')
+
+
+def draw(value, count, rng):
+    # count values of a number or a (distribution, a, b) spec
+    if isinstance(value, (tuple, list)):
+        kind, a, b = value
+        if kind not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown distribution: {kind}")
+        return getattr(rng, kind)(a, b, count)
+    return np.full(count, float(value))
+
+
+def controller_index(name):
+    if name not in CONTROLLERS:
+        raise ValueError(f"Unknown controller: {name}")
+    return CONTROLLERS.index(name)
+
+
+def start_positions(lengths, headway, road_length):
+    """Positions of a platoon packed at `headway` behind the lead car, with the last car at road_length."""
+    n = len(lengths)
+    if n and (lengths == lengths[0]).all():
+        # The formula of a uniform platoon, so homogeneous runs start exactly where they always did
+        return [road_length - (n - 1 - i) * (float(lengths[0]) + headway) for i in range(n)]
+    # Car i occupies pos .. pos + length, so the car behind it starts length + headway further on
+    spacing = np.asarray(lengths[:-1], dtype=float) + headway
+    tail = np.append(np.cumsum(spacing[::-1])[::-1], 0.0)
+    return (road_length - tail).tolist()
+
+
+class Fleet:
+    def __init__(self, count, vehicle_class=None, class_names=(), controller=None, **columns):
+        unknown = set(columns) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown vehicle attributes: {sorted(unknown)}")
+        self.count = int(count)
+        for name in FIELDS:
+            values = np.asarray(columns.get(name, VEHICLE_DEFAULTS[name]), dtype=float)
+            setattr(self, name, np.array(np.broadcast_to(values, (self.count,))))
+        if (self.length <= 0).any() or (self.mass <= 0).any():
+            raise ValueError("Vehicle lengths and masses must be positive")
+        # Class of every car as an index into class_names (all 0 for a single class)
+        self.vehicle_class = (np.zeros(self.count, dtype=np.intp) if vehicle_class is None
+                              else np.asarray(vehicle_class, dtype=np.intp))
+        self.class_names = list(class_names) or ['vehicle']
+        self.controller = (np.full(self.count, -1, dtype=np.int8) if controller is None
+                           else np.asarray(controller, dtype=np.int8))
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def sample(cls, count, classes, seed=None):
+        """
+        Draws count vehicles from classes, a list of dicts with a `share`, an
+        optional `name` and attribute values or distributions. Cars are
+        assigned to classes in proportion to the shares, in random order.
+        """
+        rng = np.random.default_rng(seed)
+        shares = np.array([c.get('share', 1.0) for c in classes], dtype=float)
+        counts = np.floor(shares / shares.sum() * count).astype(int)
+        # Cars left over by rounding go to the classes with the largest remainders
+        remainder = shares / shares.sum() * count - counts
+        counts[np.argsort(-remainder, kind='stable')[:count - counts.sum()]] += 1
+        vehicle_class = rng.permutation(np.repeat(np.arange(len(classes)), counts))
+
+        columns = {}
+        controller = np.full(count, -1, dtype=np.int8)
+        for k, spec in enumerate(classes):
+            cars = vehicle_class == k
+            if 'controller' in spec:
+                controller[cars] = controller_index(spec['controller'])
+            for name, value in spec.items():
+                if name in ('share', 'name', 'controller'):
+                    continue
+                if name not in FIELDS:
+                    raise ValueError(f"Unknown vehicle attribute: {name}")
+                column = columns.setdefault(name, np.full(count, VEHICLE_DEFAULTS[name]))
+                column[cars] = draw(value, int(cars.sum()), rng)
+        names = [c.get('name', f"class{k}") for k, c in enumerate(classes)]
+        return cls(count, vehicle_class, names, controller, **columns)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a CSV file with a header row and one row per vehicle."""
+        table = np.genfromtxt(path, delimiter=',', names=True, dtype=None, encoding='utf-8')
+        table = np.atleast_1d(table)
+        columns = {name: table[name].astype(float) for name in table.dtype.names if name not in ('class', 'controller')}
+        vehicle_class, names, controller = None, (), None
+        if 'class' in table.dtype.names:
+            names, vehicle_class = np.unique(table['class'].astype(str), return_inverse=True)
+            names = names.tolist()
+        if 'controller' in table.dtype.names:
+            controller = [controller_index(name) for name in table['controller'].astype(str)]
+        return cls(len(table), vehicle_class, names, controller, **columns)
+
+    @classmethod
+    def from_cars(cls, cars):
+        """Reads the attributes of Car objects (e.g. restored from a checkpoint)."""
+        cars = list(cars)
+        columns = {name: [getattr(car, name) for car in cars] for name in FIELDS}
+        return cls(len(cars), **columns)
+
+    def resolved(self, kd, kv, headway_time):
+        """Copy with the NaN gains and headway times replaced by the City's values."""
+        columns = {name: getattr(self, name) for name in FIELDS}
+        for name, value in (('kd', kd), ('kv', kv), ('headway_time', headway_time)):
+            columns[name] = np.where(np.isnan(columns[name]), value, columns[name])
+        return Fleet(self.count, self.vehicle_class, self.class_names, self.controller, **columns)
+
+    def controllers_for(self, model):
+        """
+        Controller of every car as an index into CONTROLLERS: the fleet's where
+        set, else `model`. Car 0 is LEAD, and a BCC or ACC+BCC last car runs ACC
+        (the car behind it is the lead car).
+        """
+        controllers = np.where(self.controller >= 0, self.controller, controller_index(model)).astype(np.int8)
+        if self.count > 1 and controllers[-1] in (BCC_CONTROL, INTEGRATED_CONTROL):
+            controllers[-1] = ACC_CONTROL
+        controllers[:1] = LEAD
+        return controllers
+
+    def apply(self, cars):
+        # Mirror the arrays into the Car attributes the per-car code reads
+        columns = {name: getattr(self, name).tolist() for name in FIELDS}
+        for i, car in enumerate(cars):
+            for name in FIELDS:
+                setattr(car, name, columns[name][i])
+
+    def class_of(self, name):
+        """Boolean mask of the cars of a vehicle class."""
+        return self.vehicle_class == self.class_names.index(name)
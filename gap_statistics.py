@@ -0,0 +1,159 @@
+"""
+gap_statistics.py: Contains the GapStatistics class, a constant-memory accumulator for inter-vehicle gaps.
+"""
+
+import numpy as np
+
+PERCENTILES = {"p5": 5, "p25": 25, "median": 50, "p75": 75, "p95": 95}
+
+class Moments:
+    """Running count, mean, M2 (Welford), min and max; works on scalars or per-car arrays."""
+
+    def __init__(self, shape=()):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def combine(self, count, mean, m2, low, high):
+        # Chan et al. pairwise update, so a whole batch is merged at once
+        total = self.count + count
+        safe_total = np.maximum(total, 1)
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / safe_total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / safe_total
+        self.count = total
+        self.min = np.minimum(self.min, low)
+        self.max = np.maximum(self.max, high)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return
+        mean = values.mean()
+        self.combine(values.size, mean, ((values - mean)**2).sum(), values.min(), values.max())
+
+    def add_per_index(self, values, index):
+        # values[i] belongs to entry index[i] (e.g. the car of each gap)
+        size = len(self.count)
+        count = np.bincount(index, minlength=size)
+        mean = np.bincount(index, values, minlength=size) / np.maximum(count, 1)
+        m2 = np.bincount(index, (values - mean[index])**2, minlength=size)
+        low = np.full_like(self.min, np.inf)
+        np.minimum.at(low, index, values)
+        high = np.full_like(self.max, -np.inf)
+        np.maximum.at(high, index, values)
+        self.combine(count, mean, m2, low, high)
+
+    def merge(self, other):
+        self.combine(other.count, other.mean, other.m2, other.min, other.max)
+
+    def variance(self):
+        return self.m2 / np.maximum(self.count - 1, 1)
+
+    def summary(self):
+        variance = self.variance()
+        return {"count": self.count, "min": self.min, "mean": self.mean, "max": self.max,
+                "std": np.sqrt(variance), "variance": variance}
+
+
+class GapStatistics:
+    """
+    Streaming replacement for storing every gap: Welford moments for the mean
+    and variance plus a fixed-bin histogram over [0, max_gap] for the
+    percentiles (accurate to one bin width). Both parts can be merged, so
+    statistics from several runs or workers can be combined.
+
+    per_car keeps moments for each car index; window_steps closes a window
+    summary every that many add() calls.
+    """
+
+    def __init__(self, max_gap=1000.0, bin_width=0.01, car_count=0, per_car=False, window_steps=None):
+        self.max_gap = max_gap
+        self.bin_width = bin_width
+        self.bins = np.zeros(int(np.ceil(max_gap / bin_width)) + 1, dtype=np.int64)
+        self.moments = Moments()
+        self.car_moments = Moments(car_count) if per_car else None
+        self.window_steps = window_steps
+        self.window = Moments()
+        self.window_steps_done = 0
+        self.windows = []
+
+    @property
+    def count(self):
+        return int(self.moments.count)
+
+    def add(self, gaps, cars=None, steps=1):
+        """
+        Adds the gaps of one step (or of `steps` consecutive steps within one window);
+        cars gives the car index of each gap for the per-car breakdown.
+        """
+        gaps = np.asarray(gaps, dtype=float)
+        if gaps.size:
+            self.moments.add(gaps)
+            index = np.clip((gaps / self.bin_width).astype(np.int64), 0, len(self.bins) - 1)
+            np.add.at(self.bins, index, 1)
+            if self.car_moments is not None and cars is not None:
+                self.car_moments.add_per_index(gaps, cars)
+        if self.window_steps:
+            self.window.add(gaps)
+            self.window_steps_done += steps
+            if self.window_steps_done >= self.window_steps:
+                self.close_window()
+
+    def close_window(self):
+        if self.window_steps_done:
+            summary = {key: float(value) for key, value in self.window.summary().items()}
+            summary["steps"] = self.window_steps_done
+            self.windows.append(summary)
+        self.window = Moments()
+        self.window_steps_done = 0
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        self.bins += other.bins
+        if self.car_moments is not None and other.car_moments is not None:
+            self.car_moments.merge(other.car_moments)
+        self.windows.extend(other.windows)
+
+    def percentile(self, q):
+        # Linear interpolation between order statistics, as np.percentile does, on the histogram
+        n = self.count
+        if n == 0:
+            return float('nan')
+        rank = q / 100 * (n - 1)
+        low, high = int(np.floor(rank)), int(np.ceil(rank))
+        value_low, value_high = self.order_statistic(low), self.order_statistic(high)
+        return value_low + (rank - low) * (value_high - value_low)
+
+    def order_statistic(self, k):
+        cumulative = np.cumsum(self.bins)
+        b = int(np.searchsorted(cumulative, k, side='right'))
+        before = cumulative[b - 1] if b > 0 else 0
+        # Spread the samples of a bin evenly across it
+        value = (b + (k - before + 0.5) / self.bins[b]) * self.bin_width
+        return float(min(max(value, self.moments.min), self.moments.max))
+
+    def summary(self):
+        """Same fields as run_headless.get_gap_statistics."""
+        moments = self.moments.summary()
+        stats = {"min": float(moments["min"])}
+        for name in ("p5", "p25", "median"):
+            stats[name] = self.percentile(PERCENTILES[name])
+        stats["mean"] = float(moments["mean"])
+        for name in ("p75", "p95"):
+            stats[name] = self.percentile(PERCENTILES[name])
+        stats["max"] = float(moments["max"])
+        stats["std"] = float(moments["std"])
+        stats["variance"] = float(moments["variance"])
+        return stats
+
+    def car_summary(self):
+        """Per-car count, min, mean, max, std and variance arrays (requires per_car=True)."""
+        if self.car_moments is None:
+            return None
+        return self.car_moments.summary()
+
+    def window_summary(self):
+        return list(self.windows)
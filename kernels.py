@@ -0,0 +1,135 @@
+"""
+kernels.py: Scalar kernels for the ACC+BCC integration factor and acceleration law.
+
+integrated_accelerations() runs the whole ACC+BCC car loop of one step in a
+single call, so with Numba installed the loop is compiled instead of paying a
+dispatch per car. Without Numba the same functions run as plain Python on
+lists, which is still cheaper than City.calculate_integration_factor (no
+closure, no getattr and no NumPy calls on scalars). Select them with
+City.init(..., kernel='compiled').
+"""
+
+import math
+import numpy as np
+from vector_engine import ACC, BCC, INTEGRATED, MAX_JERK
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        # Without Numba the kernels stay ordinary Python functions
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+
+def array(values, dtype=float):
+    # Compiled kernels take NumPy arrays, the plain Python fallback is fastest on lists
+    return np.array(values, dtype=dtype) if HAVE_NUMBA else list(values)
+
+
+def as_list(values):
+    return values.tolist() if isinstance(values, np.ndarray) else values
+
+
+@njit(cache=True)
+def integration_factor(front_gap, back_gap, X, vel, front_vel, rear_vel, rear_acc, old_iF):
+    # Same weights, thresholds, hysteresis and order of operations as City.calculate_integration_factor
+    total_w = 0
+    raw_iF = 0.0
+
+    # 1) Gap ratios
+    back_ratio = (X - min(X, back_gap)) / X
+    total_w += 6
+    raw_iF += back_ratio * 6
+    front_ratio = math.exp(-0.01 * math.pow(front_gap - 10, 2))
+    raw_iF += front_ratio * 6
+    total_w += 6
+
+    # 2) Rear braking
+    if back_gap < X and rear_acc < 0:
+        if rear_acc > -2:
+            rear_brake_ratio = 1.0
+        else:
+            rear_brake_ratio = math.exp(1.23 * (rear_acc + 2))
+        total_w += 2
+        raw_iF += rear_brake_ratio * 2
+
+    # 3) Relative rear velocity
+    rel_vel_rear = rear_vel - vel
+    if back_gap < 2 * X and rel_vel_rear > 0:
+        total_w += 2
+        raw_iF += min(max(rel_vel_rear / 5.0, 0.0), 1.0) * 2
+
+    # 4) Relative front velocity
+    rel_vel_front = vel - front_vel
+    if front_gap < 2 * X and rel_vel_front > 0:
+        raw_iF += min(max(rel_vel_front / 5.0, 0.0), 1.0) * 3
+        total_w += 3
+
+    # 5)-7) Weighted sum, clamp and hysteresis
+    normalized_iF = min(1, max(0, raw_iF / total_w))
+    alpha = 0.009
+    return (1 - alpha) * old_iF + alpha * normalized_iF
+
+
+@njit(cache=True)
+def integration_mode(iF):
+    # Index into vector_engine.MODES
+    if iF < 0.1:
+        return ACC
+    elif iF > 0.8:
+        return BCC
+    return INTEGRATED
+
+
+@njit(cache=True)
+def integrated_acceleration(pos, vel, length, front_pos, front_vel, front_length, back_pos, back_vel, rear_acc,
+                            old_iF, road_length, kd, kv, min_dis, reaction_time, min_a, max_a, min_gap):
+    """ACC+BCC law of one car; returns the clamped acceleration (before jerk limiting) and the new integration factor."""
+    ae = abs(min_a)
+    af = ae * 0.7
+    Gfront_min = vel * reaction_time + ((front_vel - vel) ** 2) / (2 * ae) + min_gap
+    Grear_min = back_vel * reaction_time + ((back_vel - vel) ** 2) / (2 * af) + min_gap
+    X = Gfront_min + length + Grear_min
+
+    front_gap = abs((pos - front_pos - front_length) % road_length)
+    back_gap = abs((back_pos - pos - length) % road_length)
+    iF = integration_factor(front_gap, back_gap, X, vel, front_vel, back_vel, rear_acc, old_iF)
+
+    desired_gap = min_dis + vel * reaction_time
+    gap_factor = kd * (front_gap - desired_gap) + iF * kd * (desired_gap - back_gap)
+    velocity_factor = kv * (front_vel - vel) + iF * kv * (back_vel - vel)
+    acc = velocity_factor + gap_factor
+    return max(min_a, min(max_a, acc)), iF
+
+
+@njit(cache=True)
+def limit_jerk(acc, last_acc, dt):
+    jerk = (acc - last_acc) / dt
+    if jerk > MAX_JERK:
+        acc = last_acc + MAX_JERK * dt
+    elif jerk < -MAX_JERK:
+        acc = last_acc - MAX_JERK * dt
+    return acc
+
+
+@njit(cache=True)
+def integrated_accelerations(pos, vel, length, acc, iF, mode, front, back, cars, road_length, dt,
+                             kd, kv, min_dis, reaction_time, min_a, max_a, min_gap):
+    """
+    Updates acc, iF and mode in place for the ACC+BCC cars (indices in
+    ascending order), so a rear car that was already updated this step
+    contributes its new acceleration exactly as in City.driver_decision. kd
+    and kv hold the gains of every car (City.fleet).
+    """
+    for i in cars:
+        f, b = front[i], back[i]
+        new_acc, iF[i] = integrated_acceleration(pos[i], vel[i], length[i], pos[f], vel[f], length[f], pos[b], vel[b],
+                                                 acc[b], iF[i], road_length, kd[i], kv[i], min_dis, reaction_time,
+                                                 min_a, max_a, min_gap)
+        mode[i] = integration_mode(iF[i])
+        acc[i] = limit_jerk(new_acc, acc[i], dt)
@@ -0,0 +1,64 @@
+"""
+neighbor_index.py: Contains the NeighborIndex class, the ring order of the cars on a circular road.
+"""
+
+class NeighborIndex:
+    """
+    Keeps the indices of the cars sorted by position around the ring so the
+    front and back neighbour of every car can be read in O(1).
+
+    Cars move towards lower positions, so the front car is the previous entry
+    in the ring order and the back car is the next one (with wrap-around).
+    Cars almost never overtake on a single lane, so update() repairs the
+    previous order with local swaps instead of sorting from scratch.
+    """
+
+    def __init__(self, cars, road_length):
+        self.cars = cars
+        self.road_length = road_length
+        self.rebuild()
+
+    def rebuild(self):
+        keys = self.keys()
+        self.order = sorted(range(len(self.cars)), key=lambda i: keys[i])
+        self.link()
+
+    def keys(self):
+        road_length = self.road_length
+        return [car.pos % road_length for car in self.cars]
+
+    def update(self):
+        n = len(self.cars)
+        if len(self.order) != n:
+            self.rebuild()
+            return
+        if n < 2:
+            return
+        keys = self.keys()
+        order = self.order
+
+        # A car wrapping past 0 keeps its place in the ring, so rotate the order to start at the lowest key
+        start = min(range(n), key=lambda k: keys[order[k]])
+        order = order[start:] + order[:start]
+
+        # Insertion sort: O(N) when only a few neighbours swapped places
+        for k in range(1, n):
+            car = order[k]
+            key = keys[car]
+            j = k - 1
+            while j >= 0 and keys[order[j]] > key:
+                order[j + 1] = order[j]
+                j -= 1
+            order[j + 1] = car
+
+        self.order = order
+        self.link()
+
+    def link(self):
+        order = self.order
+        n = len(order)
+        self.front = [0] * n
+        self.back = [0] * n
+        for k, car in enumerate(order):
+            self.front[car] = order[k - 1]
+            self.back[car] = order[(k + 1) % n]
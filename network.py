@@ -0,0 +1,565 @@
+"""
+network.py: Contains the Network class, car following on a graph of roads and lanes.
+
+Roads are linked with Road.connect (successors, optional mid-road entry
+points for merges, weighted splits for off-ramps) and Road.set_adjacent
+(parallel lanes). Vehicles live in struct-of-arrays form; every step they are
+kept sorted by (road, position), so each road is a contiguous, sorted
+segment and a vehicle's leader and follower are its neighbours in that
+segment. Only the first and last vehicle of a road look across a link, so a
+step costs O(vehicles + roads) array work plus a Python loop over roads.
+
+The acceleration laws are the ring models of City (ACC, BCC, ACC+BCC) from
+vector_engine, with a few network rules: a vehicle without a leader drives
+towards v_des, a leader far ahead never pushes a vehicle past the v_des
+speed law, a vehicle closing in on a much slower leader brakes early enough
+to stop behind it, and a vehicle waiting to merge stops at the end of its
+road until the gap on the other road is safe. ACC+BCC uses the rear vehicle's acceleration of the previous step
+(there is no single car order to update in on a network). Vehicles are not
+pushed apart after an overlap as on the ring; overlaps are only counted.
+"""
+
+import numpy as np
+from car import Car
+from gap_statistics import GapStatistics
+from road import Road
+from vector_engine import (MODES, VEL, ACC, BCC, acc_law, bcc_law, clamp, integration_factor, integration_mode,
+                           limit_jerk, safe_gap_sum, traction_energy)
+
+# Per-vehicle arrays, all indexed by the same vehicle slot
+STATE = {'id': np.int64, 'road': np.int64, 'pos': float, 'vel': float, 'acc': float, 'length': float,
+         'next_road': np.int64, 'next_entry': float, 'iF': float, 'mode': np.int8, 'energy': float,
+         'lane_timer': np.int64}
+
+NO_ROAD = -1
+LOOKAHEAD_LINKS = 3
+LANE_CHANGE_GAIN = 10.0   # m of extra front gap needed before changing lanes
+LANE_CHANGE_COOLDOWN = 30  # steps between two lane changes of one vehicle
+
+MASS, FRONTAL_AREA, CR, CD = 1800, 2.2, 0.015, 0.29
+
+
+class Network:
+    """
+    Vehicles on a set of linked roads. params is a run_headless style dict
+    (kd, kv, kc, v_des, max_v, min_v, min_dis, reaction_time, max_a, min_a,
+    min_gap, dt). Vehicles enter with add_vehicles() or through Road.inflow
+    (vehicles per second) and leave at roads without successors.
+    """
+
+    def __init__(self, roads, params, model='ACC', lane_changes=True, seed=None):
+        if model not in ('ACC', 'BCC', 'ACC+BCC'):
+            raise ValueError(f"Unknown model: {model}")
+        self.roads = list(roads)
+        self.model = model
+        self.lane_changes = lane_changes
+        for name in ('kd', 'kv', 'kc', 'v_des', 'max_v', 'min_v', 'min_dis', 'reaction_time', 'max_a', 'min_a',
+                     'min_gap', 'dt'):
+            setattr(self, name, params[name])
+        self.rng = np.random.default_rng(seed)
+        self.step_count = 0
+        self.next_id = 0
+        self.exited = 0
+        self.overlap_count = 0
+        self.inflow_credit = np.zeros(len(self.roads))
+        self.gap_stats = GapStatistics(max_gap=max(road.length for road in self.roads) * (LOOKAHEAD_LINKS + 1))
+        self.cars = {}
+        self.index_roads()
+        self.state = {name: np.empty(0, dtype=dtype) for name, dtype in STATE.items()}
+        self.resort()
+
+    def index_roads(self):
+        # Integer ids for roads, their links and their lanes
+        ids = {id(road): r for r, road in enumerate(self.roads)}
+        self.road_length = np.array([road.length for road in self.roads], dtype=float)
+        # Disjoint key ranges per road, so one sort orders by (road, position)
+        self.road_offset = np.concatenate([[0.0], np.cumsum(self.road_length + 1)[:-1]])
+        self.successors = [[(ids[id(to)], entry, weight) for to, entry, weight in road.successors] for road in self.roads]
+        self.predecessors = [[] for _ in self.roads]
+        for r, links in enumerate(self.successors):
+            for to, entry, weight in links:
+                self.predecessors[to].append((r, entry))
+        self.left = np.array([ids[id(road.left)] if road.left is not None else NO_ROAD for road in self.roads])
+        self.right = np.array([ids[id(road.right)] if road.right is not None else NO_ROAD for road in self.roads])
+        self.inflow = np.array([road.inflow for road in self.roads], dtype=float)
+
+    def __len__(self):
+        return len(self.state['pos'])
+
+    # Per-vehicle views of the current state
+    @property
+    def positions(self):
+        return self.state['pos']
+
+    @property
+    def velocities(self):
+        return self.state['vel']
+
+    @property
+    def accelerations(self):
+        return self.state['acc']
+
+    # --- Vehicles ---
+
+    def add_vehicles(self, road, positions, velocity=0.0, length=4.0):
+        """Adds vehicles on road (a Road of this network) at the given positions; returns their ids."""
+        r = self.roads.index(road)
+        positions = np.atleast_1d(np.asarray(positions, dtype=float))
+        n = len(positions)
+        ids = np.arange(self.next_id, self.next_id + n)
+        self.next_id += n
+        new = {'id': ids, 'road': np.full(n, r), 'pos': positions, 'vel': np.full(n, float(velocity)),
+               'acc': np.zeros(n), 'length': np.full(n, float(length)), 'next_road': np.full(n, NO_ROAD),
+               'next_entry': np.zeros(n), 'iF': np.ones(n), 'mode': np.zeros(n, dtype=np.int8),
+               'energy': np.zeros(n), 'lane_timer': np.zeros(n, dtype=np.int64)}
+        start = len(self)
+        for name, dtype in STATE.items():
+            self.state[name] = np.concatenate([self.state[name], new[name].astype(dtype)])
+        self.choose_next(np.arange(start, start + n))
+        self.resort()
+        return ids
+
+    def fill(self, road, spacing, velocity=0.0, length=4.0):
+        """Places vehicles every spacing metres along road."""
+        return self.add_vehicles(road, np.arange(road.length - spacing, -1e-9, -spacing), velocity, length)
+
+    def remove_vehicles(self, mask):
+        for vehicle_id in self.state['id'][mask].tolist():
+            self.cars.pop(vehicle_id, None)
+        keep = ~mask
+        for name in STATE:
+            self.state[name] = self.state[name][keep]
+        self.resort()
+
+    def choose_next(self, vehicles):
+        # Pick the successor every vehicle takes at the end of its current road
+        road = self.state['road'][vehicles]
+        for r in np.unique(road).tolist():
+            members = vehicles[road == r]
+            links = self.successors[r]
+            if not links:
+                self.state['next_road'][members] = NO_ROAD
+                continue
+            weights = np.array([weight for _, _, weight in links], dtype=float)
+            picks = self.rng.choice(len(links), size=len(members), p=weights / weights.sum()) if len(links) > 1 \
+                else np.zeros(len(members), dtype=int)
+            self.state['next_road'][members] = [links[k][0] for k in picks.tolist()]
+            self.state['next_entry'][members] = [links[k][1] for k in picks.tolist()]
+
+    # --- Per-road sorted order ---
+
+    def keys(self):
+        return self.road_offset[self.state['road']] + self.state['pos']
+
+    def resort(self):
+        self.order = np.argsort(self.keys(), kind='stable')
+        self.update_segments()
+
+    def update_order(self):
+        # The previous order is almost sorted, which the stable (Tim)sort handles in close to linear time
+        order = self.order
+        self.order = order[np.argsort(self.keys()[order], kind='stable')]
+        self.update_segments()
+
+    def update_segments(self):
+        # Road r holds the vehicles order[start[r]:start[r + 1]], sorted by position (front first)
+        counts = np.bincount(self.state['road'], minlength=len(self.roads))
+        self.start = np.concatenate([[0], np.cumsum(counts)])
+        self.sorted_keys = self.keys()[self.order]
+
+    def vehicles_on(self, r):
+        return self.order[self.start[r]:self.start[r + 1]]
+
+    def leader_on(self, r, position):
+        # Vehicle on road r closest ahead of (below) position, or None
+        k = int(np.searchsorted(self.sorted_keys, self.road_offset[r] + position, side='left')) - 1
+        return int(self.order[k]) if k >= self.start[r] else None
+
+    def follower_on(self, r, position):
+        # Vehicle on road r closest behind (above) position, or None
+        k = int(np.searchsorted(self.sorted_keys, self.road_offset[r] + position, side='right'))
+        return int(self.order[k]) if k < self.start[r + 1] else None
+
+    def neighbors(self):
+        """
+        Front and back vehicle (-1 if none) of every vehicle, the gaps to them,
+        and a mask of vehicles that must stop at the end of their road (merge
+        not yet possible).
+        """
+        n = len(self)
+        s = self.state
+        pos, length, road = s['pos'], s['length'], s['road']
+        order, start = self.order, self.start
+        front = np.full(n, -1)
+        back = np.full(n, -1)
+        if n == 0:
+            return front, back, np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool)
+
+        same_road = road[order][1:] == road[order][:-1]
+        front[order[1:][same_road]] = order[:-1][same_road]
+        back[order[:-1][same_road]] = order[1:][same_road]
+        front_gap = np.full(n, np.inf)
+        back_gap = np.full(n, np.inf)
+        has_front = front >= 0
+        front_gap[has_front] = pos[has_front] - pos[front[has_front]] - length[front[has_front]]
+        has_back = back >= 0
+        back_gap[has_back] = pos[back[has_back]] - pos[has_back] - length[has_back]
+        yield_at_end = np.zeros(n, dtype=bool)
+
+        occupied = np.flatnonzero(start[1:] > start[:-1])
+        for r in occupied.tolist():
+            head = int(order[start[r]])
+            self.link_front(head, front, front_gap, yield_at_end)
+            tail = int(order[start[r + 1] - 1])
+            self.link_back(r, tail, back, back_gap)
+        return front, back, front_gap, back_gap, yield_at_end
+
+    def link_front(self, head, front, front_gap, yield_at_end):
+        # Leader of the first vehicle of a road, along its own route
+        s = self.state
+        r, entry = int(s['next_road'][head]), float(s['next_entry'][head])
+        if r != NO_ROAD and entry < self.road_length[r]:
+            yield_at_end[head] = not self.can_merge(head, r, entry)
+            if yield_at_end[head]:
+                # Until it merges its leader is the end of its road, not the traffic passing by
+                return
+        leader, gap = self.leader_along(int(s['road'][head]), float(s['pos'][head]), (r, entry))
+        if leader is not None:
+            front[head] = leader
+            front_gap[head] = gap
+
+    def can_merge(self, head, r, entry):
+        """
+        Gap acceptance for a vehicle about to merge into the middle of road r:
+        predicts where the vehicles of r will be when it reaches the entry
+        point and requires a safe gap to the vehicles just ahead and behind.
+        """
+        s = self.state
+        others = self.vehicles_on(r)
+        if others.size == 0:
+            return True
+        # Time to reach the entry point at full acceleration
+        vel, distance = float(s['vel'][head]), max(float(s['pos'][head]), 0.0)
+        arrival = min((np.sqrt(vel**2 + 2 * self.max_a * distance) - vel) / self.max_a, 10.0)
+        # The gap has to be safe both now and on arrival, with room to brake off any speed difference
+        for t in (0.0, arrival):
+            predicted = s['pos'][others] - s['vel'][others] * t
+            behind = predicted >= entry
+            if behind.any():
+                k = np.argmin(np.where(behind, predicted, np.inf))
+                lag_vel = s['vel'][others[k]]
+                room = predicted[k] - entry - s['length'][head]
+                if room < self.min_dis + lag_vel * self.reaction_time + self.braking_distance(lag_vel - vel):
+                    return False
+            if (~behind).any():
+                k = np.argmax(np.where(behind, -np.inf, predicted))
+                room = entry - predicted[k] - s['length'][others[k]]
+                if room < self.min_dis + vel * self.reaction_time + self.braking_distance(vel - s['vel'][others[k]]):
+                    return False
+        return True
+
+    def braking_distance(self, closing_speed):
+        return max(closing_speed, 0.0)**2 / (-2 * self.min_a)
+
+    def link_back(self, r, tail, back, back_gap):
+        # Follower of the last vehicle of a road, coming from a predecessor
+        s = self.state
+        follower, distance = self.follower_along(r, float(s['pos'][tail]))
+        if follower is not None:
+            back[tail] = follower
+            back_gap[tail] = distance - s['length'][tail]
+
+    def leader_along(self, r, position, link=None):
+        """
+        Closest vehicle ahead of position on road r or, past its end, on link
+        (road, entry) and then the most likely successors, up to
+        LOOKAHEAD_LINKS roads on. Returns (vehicle, gap to its rear) or (None, inf).
+        """
+        s = self.state
+        distance = 0.0
+        for _ in range(LOOKAHEAD_LINKS + 1):
+            leader = self.leader_on(r, position)
+            if leader is not None:
+                return leader, distance + position - s['pos'][leader] - s['length'][leader]
+            distance += position
+            if link is None:
+                links = self.successors[r]
+                if not links:
+                    break
+                link = max(links, key=lambda item: item[2])[:2]
+            (r, position), link = link, None
+            if r == NO_ROAD:
+                break
+        return None, np.inf
+
+    def follower_along(self, r, position):
+        """
+        Closest vehicle behind position on road r or, if there is none, the
+        first vehicle of a predecessor that continues onto the start of r.
+        Returns (vehicle, distance from position to its front) or (None, inf).
+        """
+        s = self.state
+        follower = self.follower_on(r, position)
+        if follower is not None:
+            return follower, s['pos'][follower] - position
+        best, best_distance = None, np.inf
+        for p, entry in self.predecessors[r]:
+            if entry != self.road_length[r] or self.start[p + 1] == self.start[p]:
+                continue
+            head = int(self.order[self.start[p]])
+            distance = s['pos'][head] + entry - position
+            if s['next_road'][head] == r and distance < best_distance:
+                best, best_distance = head, distance
+        return best, best_distance
+
+    # --- Step ---
+
+    def step(self, dt=None):
+        if dt is None:
+            dt = self.dt
+        self.spawn(dt)
+        front, back, front_gap, back_gap, yield_at_end = self.neighbors()
+        self.driver_decision(front, back, front_gap, back_gap, yield_at_end, dt)
+        if self.lane_changes:
+            self.change_lanes(front_gap)
+        self.move_forward(dt)
+        self.step_count += 1
+
+        # Vehicles are not pushed apart as on the ring; overlaps (negative gaps) are only counted
+        gaps = front_gap[np.isfinite(front_gap)]
+        self.overlap_count += int(np.count_nonzero(gaps < 0))
+        self.gap_stats.add(gaps[gaps > 0])
+
+    def driver_decision(self, front, back, front_gap, back_gap, yield_at_end, dt):
+        s = self.state
+        vel, old_acc, length = s['vel'], s['acc'], s['length']
+        has_front = front >= 0
+        has_back = back >= 0
+        front_vel = np.where(has_front, vel[front], vel)
+        back_vel = np.where(has_back, vel[back], vel)
+        # A vehicle waiting to merge treats the end of its road as a stopped leader
+        front_gap = np.where(yield_at_end, np.minimum(front_gap, s['pos']), front_gap)
+        front_vel = np.where(yield_at_end, 0.0, front_vel)
+        has_front = has_front | yield_at_end
+        # Missing neighbours get a placeholder gap; their law results are masked out below
+        front_gap = np.where(has_front, front_gap, 0.0)
+        back_gap = np.where(has_back, back_gap, 0.0)
+
+        free = self.kc * (self.v_des - vel)
+        acc = np.where(has_front, acc_law(front_gap, vel, front_vel, self.kd, self.kv, self.min_dis,
+                                          self.reaction_time), free)
+        mode = np.where(has_front, ACC, VEL).astype(np.int8)
+        pair = has_front & has_back
+        if self.model == 'BCC':
+            acc = np.where(pair, bcc_law(front_gap, back_gap, vel, front_vel, back_vel, self.kd, self.kv,
+                                         self.min_dis, self.reaction_time), acc)
+            mode[pair] = BCC
+        elif self.model == 'ACC+BCC':
+            rear_acc = np.where(has_back, old_acc[back], 0.0)
+            X = safe_gap_sum(vel, front_vel, back_vel, length, self.min_a, self.min_gap, self.reaction_time)
+            iF = integration_factor(front_gap, back_gap, X, vel, front_vel, back_vel, rear_acc, s['iF'])
+            s['iF'] = np.where(pair, iF, s['iF'])
+            acc = np.where(pair, bcc_law(front_gap, back_gap, vel, front_vel, back_vel, self.kd, self.kv,
+                                         self.min_dis, self.reaction_time, s['iF']), acc)
+            mode = np.where(pair, integration_mode(s['iF']), mode).astype(np.int8)
+        # A leader far ahead never pushes a vehicle past the v_des speed law
+        acc = np.minimum(acc, free)
+        # Closing in on a much slower leader (e.g. a queue at a merge), brake early enough to stop behind it
+        closing = has_front & (vel > front_vel)
+        room = np.maximum(front_gap - self.min_gap, 0.1)
+        acc = np.where(closing, np.minimum(acc, (front_vel**2 - vel**2) / (2 * room)), acc)
+        s['acc'] = limit_jerk(clamp(acc, self.min_a, self.max_a), old_acc, dt)
+        s['mode'] = mode
+
+    def change_lanes(self, front_gap):
+        """
+        A vehicle changes to an adjacent lane when the gap ahead there is
+        LANE_CHANGE_GAIN metres larger and the vehicle behind keeps a safe
+        gap. At most one vehicle moves into any one gap per step.
+        """
+        s = self.state
+        s['lane_timer'] = np.maximum(s['lane_timer'] - 1, 0)
+        moved = np.zeros(len(self), dtype=bool)
+        for adjacent in (self.left, self.right):
+            target = adjacent[s['road']]
+            candidates = np.flatnonzero((target != NO_ROAD) & (s['lane_timer'] == 0) & ~moved &
+                                        np.isfinite(front_gap))
+            if candidates.size == 0:
+                continue
+            t = target[candidates]
+            pos, length, vel = s['pos'][candidates], s['length'][candidates], s['vel'][candidates]
+            k = np.searchsorted(self.sorted_keys, self.road_offset[t] + pos, side='left')
+            leader_ok = k - 1 >= self.start[t]
+            follower_ok = k < self.start[t + 1]
+            leader = self.order[np.clip(k - 1, 0, max(len(self) - 1, 0))]
+            follower = self.order[np.clip(k, 0, max(len(self) - 1, 0))]
+            new_gap = np.where(leader_ok, pos - s['pos'][leader] - s['length'][leader], np.inf)
+            rear_gap = np.where(follower_ok, s['pos'][follower] - pos - length, np.inf)
+            rear_vel = np.where(follower_ok, s['vel'][follower], 0.0)
+            # Near the ends of the target lane the neighbours may sit across a link
+            for c in np.flatnonzero(~leader_ok).tolist():
+                _, new_gap[c] = self.leader_along(int(t[c]), float(pos[c]))
+            for c in np.flatnonzero(~follower_ok).tolist():
+                rear, distance = self.follower_along(int(t[c]), float(pos[c]))
+                if rear is not None:
+                    rear_gap[c] = distance - length[c]
+                    rear_vel[c] = s['vel'][rear]
+            safe = (rear_gap >= self.min_dis + rear_vel * self.reaction_time) & (new_gap >= self.min_dis + vel * self.reaction_time)
+            better = new_gap >= front_gap[candidates] + LANE_CHANGE_GAIN
+            chosen = safe & better
+            # One vehicle per target gap (same target road and insertion point)
+            slots = t[chosen] * (len(self) + 1) + k[chosen]
+            _, first = np.unique(slots, return_index=True)
+            movers = candidates[np.flatnonzero(chosen)[first]]
+            if movers.size:
+                s['road'][movers] = target[movers]
+                s['lane_timer'][movers] = LANE_CHANGE_COOLDOWN
+                moved[movers] = True
+                self.choose_next(movers)
+                self.resort()
+
+    def move_forward(self, dt):
+        # S = ut + 0.5at^2, v = u + at (vehicles move towards lower positions)
+        s = self.state
+        energy = traction_energy(s['vel'], s['acc'], dt, MASS, CR, CD, FRONTAL_AREA)
+        # A stopped vehicle that keeps braking stays where it is instead of rolling back
+        s['pos'] = s['pos'] - np.maximum(s['vel'] * dt + 0.5 * s['acc'] * dt**2, 0.0)
+        s['vel'] = clamp(s['vel'] + s['acc'] * dt, self.min_v, self.max_v)
+        s['energy'] = s['energy'] + np.where(energy > 0, energy, 0.0)
+
+        # A vehicle that may not merge yet stops at the end of its road
+        for i in np.flatnonzero(s['pos'] < 0).tolist():
+            r, entry = int(s['next_road'][i]), float(s['next_entry'][i])
+            if r != NO_ROAD and entry < self.road_length[r] and not self.can_merge(i, r, entry):
+                s['pos'][i] = s['vel'][i] = s['acc'][i] = 0.0
+
+        # Vehicles past the end of their road continue on their next road or leave the network
+        for _ in range(LOOKAHEAD_LINKS):
+            crossed = np.flatnonzero(s['pos'] < 0)
+            if crossed.size == 0:
+                break
+            leaving = crossed[s['next_road'][crossed] == NO_ROAD]
+            moving = crossed[s['next_road'][crossed] != NO_ROAD]
+            s['pos'][moving] += s['next_entry'][moving]
+            s['road'][moving] = s['next_road'][moving]
+            self.choose_next(moving)
+            if leaving.size:
+                self.exited += leaving.size
+                mask = np.zeros(len(self), dtype=bool)
+                mask[leaving] = True
+                self.remove_vehicles(mask)
+        if len(self.order) == len(self):
+            self.update_order()
+        else:
+            self.resort()
+
+    def spawn(self, dt):
+        # Road.inflow vehicles per second enter at the start of their road when there is room
+        if not self.inflow.any():
+            return
+        self.inflow_credit += self.inflow * dt
+        for r in np.flatnonzero(self.inflow_credit >= 1).tolist():
+            length = self.road_length[r]
+            velocity = min(self.v_des, self.max_v)
+            last, gap = self.leader_along(r, length)
+            if last is not None:
+                if gap < self.min_dis:
+                    continue
+                # Enter no faster than the vehicle ahead unless there is a full headway of room
+                if gap < self.min_dis + velocity * self.reaction_time:
+                    velocity = min(velocity, self.state['vel'][last])
+                # and never faster than it can stop in half the room (the leader may be stopping too)
+                velocity = min(velocity, np.sqrt(-self.min_a * (gap - self.min_dis)))
+            self.add_vehicles(self.roads[r], [length], velocity=velocity)
+            self.inflow_credit[r] -= 1
+
+    # --- Views ---
+
+    def sync_cars(self):
+        """Creates/updates one Car per vehicle and each Road's cars_on_road (highest position first)."""
+        s = self.state
+        for road in self.roads:
+            road.cars_on_road = []
+        for i in self.order[::-1].tolist():
+            vehicle_id = int(s['id'][i])
+            road = self.roads[s['road'][i]]
+            car = self.cars.get(vehicle_id)
+            if car is None:
+                car = Car(length=float(s['length'][i]), color='blue', pos=0.0, min_dis=self.min_dis, velocity=0.0,
+                          acceleration=0.0, current_road=road)
+                car.original_color = car.color
+                self.cars[vehicle_id] = car
+            car.pos = float(s['pos'][i])
+            car.velocity = float(s['vel'][i])
+            car.acceleration = float(s['acc'][i])
+            car.current_road = road
+            car.integration_factor = float(s['iF'][i])
+            car.mode = MODES[s['mode'][i]]
+            car.energy_used = float(s['energy'][i])
+            road.cars_on_road.append(car)
+        return list(self.cars.values())
+
+    def road_summary(self):
+        """Vehicle count, density (veh/km) and mean speed (m/s) of every road."""
+        s = self.state
+        counts = np.bincount(s['road'], minlength=len(self.roads))
+        speed = np.bincount(s['road'], s['vel'], minlength=len(self.roads)) / np.maximum(counts, 1)
+        return {"count": counts, "density": counts / self.road_length * 1000, "mean_speed": speed}
+
+
+# --- Topologies ---
+
+def ring(length=1000):
+    road = Road(length, 0, 0, 1, 0)
+    road.connect(road)
+    return [road]
+
+
+def multi_lane_ring(lanes=2, length=1000):
+    """Parallel ring lanes; lane k is left of lane k + 1."""
+    roads = []
+    for lane in range(lanes):
+        road = Road(length, 0, lane * 4, 1, 0)
+        road.connect(road)
+        if roads:
+            road.set_adjacent(left=roads[-1])
+        roads.append(road)
+    return roads
+
+
+def ring_with_ramps(length=1000, ramp_length=200, exit_share=0.1, inflow=0.2):
+    """
+    A ring split in two halves. At the end of the first half a share of the
+    vehicles leaves on an off-ramp; an on-ramp with the given inflow merges
+    into the middle of the second half.
+    """
+    first = Road(length / 2, 0, 0, 1, 0)
+    second = Road(length / 2, length / 2, 0, 1, 0)
+    off_ramp = Road(ramp_length, 0, -20, 1, 0)
+    on_ramp = Road(ramp_length, length / 2, 20, 1, 0)
+    first.connect(second, weight=1 - exit_share)
+    first.connect(off_ramp, weight=exit_share)
+    second.connect(first)
+    on_ramp.connect(second, entry_pos=length / 4)
+    on_ramp.inflow = inflow
+    return [first, second, off_ramp, on_ramp]
+
+
+def corridor(lanes=3, segments=10, segment_length=500, inflow=0.5):
+    """A straight multi-lane corridor of linked segments; vehicles enter at the first segment and leave after the last."""
+    roads = []
+    previous = [None] * lanes
+    for segment in range(segments):
+        current = []
+        for lane in range(lanes):
+            road = Road(segment_length, segment * segment_length, lane * 4, 1, 0)
+            if previous[lane] is not None:
+                previous[lane].connect(road)
+            if current:
+                road.set_adjacent(left=current[-1])
+            if segment == 0:
+                road.inflow = inflow
+            current.append(road)
+        roads.extend(current)
+        previous = current
+    return roads
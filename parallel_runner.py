@@ -0,0 +1,125 @@
+"""
+parallel_runner.py: Runs independent City models (ACC, BCC, ACC+BCC) in separate processes.
+
+Each worker runs one City to completion and copies its recorded histories
+into a shared-memory block created by the parent, so only the small
+statistics objects are pickled back instead of Car objects. Detectors
+(events.Detector) are copied onto every City, as in sweep.evaluate.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import copy
+from multiprocessing import shared_memory
+import numpy as np
+from city import City
+from recorder import CHANNELS, TrajectoryRecorder
+
+MODELS = ('ACC', 'BCC', 'ACC+BCC')
+
+# Positional arguments of City.init, in order
+INIT_KEYS = ["car_number", "kd", "kv", "kc", "v_des", "max_v", "min_v", "min_dis", "reaction_time", "headway_time", "max_a", "min_a", "min_gap"]
+
+
+def build_city(params, model, lead_velocity_profile=(), engine='object'):
+    """Creates and initialises a City from a run_headless style params dict."""
+    city = City()
+    city.init(*[params[k] for k in INIT_KEYS], dt=params["dt"], model=model, engine=engine,
+              integrator=params.get("integrator", 'fixed'), max_substeps=params.get("max_substeps", 10),
+              powertrain=params.get("powertrain"), fleet=params.get("fleet"))
+    city.lead_velocity_profile = lead_velocity_profile
+    city.follower_velocity_profile = []
+    return city
+
+
+class ModelResult:
+    """
+    Compact result of one model run. It exposes the same recorder,
+    gap_stats and overall_min_gap/overall_max_gap attributes as a City, so
+    the run_headless plotting and statistics functions accept either.
+    """
+
+    def __init__(self, model, recorder, gap_stats, overall_min_gap, overall_max_gap, step_count, integration=None,
+                 road_length=1000, dt=0.1, events=()):
+        self.model = model
+        self.recorder = recorder
+        self.gap_stats = gap_stats
+        self.overall_min_gap = overall_min_gap
+        self.overall_max_gap = overall_max_gap
+        self.step_count = step_count
+        self.integration = integration
+        # Ring length and step, for the space-time analysis (see spacetime.py)
+        self.road_length = road_length
+        self.dt = dt
+        # Events of the detectors, as City.events
+        self.events = list(events)
+
+    def integration_summary(self):
+        return self.integration
+
+    @property
+    def energy_used(self):
+        # Cumulative energy of every car at the end of the run
+        return self.recorder.energy[-1]
+
+    @property
+    def total_energy(self):
+        return float(self.energy_used.sum())
+
+
+def run_model(params, model, num_steps, lead_velocity_profile, shm_name, engine='object', detectors=()):
+    """
+    Worker: runs one model and writes its (channel x step x car) histories
+    into shared memory. A detector may stop the run early (fewer rows) or
+    fast-forward it to num_steps.
+    """
+    city = build_city(params, model, lead_velocity_profile, engine)
+    for detector in detectors:
+        city.add_detector(copy.deepcopy(detector))
+    dt = params["dt"]
+    city.run_steps(num_steps, dt)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray((len(CHANNELS), num_steps + 1, len(city.cars)), dtype=np.float64, buffer=shm.buf)
+        for i, name in enumerate(CHANNELS):
+            channel = city.recorder.channel(name)
+            out[i, :len(channel)] = channel
+        del out
+    finally:
+        shm.close()
+    return (city.gap_stats, city.overall_min_gap, city.overall_max_gap, city.step_count, city.integration_summary(),
+            city.roads[0].length, city.events)
+
+
+def run_models(params, models=MODELS, duration=60, lead_velocity_profile=(), engine='object', max_workers=None,
+               detectors=()):
+    """
+    Runs every model in its own process and returns {model: ModelResult}.
+    detectors (events.Detector, e.g. SteadyState()) are attached to every run.
+    """
+    dt = params["dt"]
+    num_steps = int(duration / dt)
+    car_count = int(params["car_number"])
+    shape = (len(CHANNELS), num_steps + 1, car_count)
+    nbytes = max(int(np.prod(shape)) * np.dtype(np.float64).itemsize, 1)
+    lead_velocity_profile = np.asarray(lead_velocity_profile, dtype=float)
+
+    blocks = {model: shared_memory.SharedMemory(create=True, size=nbytes) for model in models}
+    results = {}
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers or len(models)) as pool:
+            futures = {model: pool.submit(run_model, params, model, num_steps, lead_velocity_profile, blocks[model].name,
+                                          engine, detectors)
+                       for model in models}
+            for model, future in futures.items():
+                gap_stats, min_gap, max_gap, step_count, integration, road_length, events = future.result()
+                # A run stopped by a detector recorded only step_count + 1 rows
+                histories = np.ndarray(shape, dtype=np.float64, buffer=blocks[model].buf)[:, :step_count + 1].copy()
+                recorder = TrajectoryRecorder.from_arrays(dict(zip(CHANNELS, histories)))
+                results[model] = ModelResult(model, recorder, gap_stats, min_gap, max_gap, step_count, integration,
+                                             road_length, dt, events)
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+    return results
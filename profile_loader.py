@@ -0,0 +1,88 @@
+"""
+profile_loader.py: Loads (time, velocity) profiles from CSV files of any size.
+
+The CSV is parsed in chunks with NumPy's vectorised reader and the result is
+cached next to it as a .npy sidecar named after the SHA-1 of the file, so
+later runs memory-map the sidecar instead of parsing again. A changed CSV
+gets a new hash and is parsed once more; stale sidecars are removed.
+"""
+
+import glob
+import hashlib
+import itertools
+import os
+import numpy as np
+
+# Factors from the file's velocity unit to m/s
+UNITS = {'m/s': 1.0, 'km/h': 1 / 3.6, 'mph': 0.44704}
+
+CHUNK_ROWS = 1_000_000
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def sidecar_path(path, digest, cache_dir=None):
+    directory = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(path))
+    return os.path.join(directory, f".{os.path.basename(path)}.{digest}.npy")
+
+
+def parse_csv(path, time_column='time', velocity_column='velocity'):
+    """Parses the two columns of a CSV with a header row into a (row x 2) float array."""
+    with open(path, 'r') as f:
+        header = [name.strip() for name in f.readline().split(',')]
+        try:
+            usecols = (header.index(time_column), header.index(velocity_column))
+        except ValueError:
+            raise ValueError(f"{path} needs '{time_column}' and '{velocity_column}' columns, found {header}")
+        chunks = []
+        while True:
+            # Bounded parser memory: at most CHUNK_ROWS lines are tokenised at once
+            lines = list(itertools.islice(f, CHUNK_ROWS))
+            if not lines:
+                break
+            if any(map(str.strip, lines)):
+                chunks.append(np.loadtxt(lines, delimiter=',', usecols=usecols, ndmin=2, dtype=np.float64))
+    return np.concatenate(chunks) if chunks else np.empty((0, 2))
+
+
+def write_sidecar(data, sidecar):
+    # Atomic, so a concurrent run never maps a half-written cache
+    tmp_path = sidecar + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp_path, sidecar)
+    for stale in glob.glob(glob.escape(sidecar.rsplit('.', 2)[0]) + ".*.npy"):
+        if stale != sidecar:
+            os.remove(stale)
+
+
+def load_profile(path, units='m/s', time_column='time', velocity_column='velocity', cache=True, cache_dir=None):
+    """
+    Returns the profile at path as a (sample x 2) array of (time in s, velocity in m/s).
+    units is the velocity unit of the file ('m/s', 'km/h' or 'mph'). With cache
+    the parsed file is kept in a memory-mapped .npy sidecar (in cache_dir, or
+    next to the CSV); an unwritable cache location just skips caching.
+    """
+    if units not in UNITS:
+        raise ValueError(f"Unknown velocity unit: {units}")
+    data = None
+    if cache:
+        sidecar = sidecar_path(path, file_digest(path), cache_dir)
+        if os.path.exists(sidecar):
+            data = np.load(sidecar, mmap_mode='r')
+    if data is None:
+        data = parse_csv(path, time_column, velocity_column)
+        if cache:
+            try:
+                write_sidecar(data, sidecar)
+            except OSError:
+                pass
+    if UNITS[units] != 1.0:
+        data = np.column_stack([data[:, 0], data[:, 1] * UNITS[units]])
+    return data
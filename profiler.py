@@ -0,0 +1,157 @@
+"""
+profiler.py: Opt-in timing of the phases of City.run.
+
+city.enable_profiling() wraps the phase methods of one City (and of its
+engine, recorder, neighbour index and velocity profiles) with timers that
+accumulate call counts, inclusive time and self time (inclusive time minus
+the time spent in timed calls below it) per call path:
+
+  run
+    driver_decision
+      lead (lead car) -> profile (velocity profile lookup)
+      ACC, BCC, ACC+BCC (model branch) -> integration_factor
+    move_forward -> handle_collisions, neighbors
+    gap_statistics, record
+
+city.disable_profiling() removes the wrappers again, so a City that was never
+profiled runs exactly the code it ran before. Results are read with
+profiler.summary() (per phase), profiler.paths() (per call path) or written
+with profiler.write_folded(path) in the folded-stack format that
+flamegraph.pl, speedscope and inferno read.
+"""
+
+import time
+
+# (attribute holding the object, method name, phase label); '' is the City itself
+CITY_PHASES = (
+    ('', 'run', 'run'),
+    ('', 'advance', 'advance'),
+    ('', 'driver_decision', 'driver_decision'),
+    ('', 'lead_acceleration', 'lead'),
+    ('', 'acc_decision', 'ACC'),
+    ('', 'bcc_decision', 'BCC'),
+    ('', 'integrated_decision', 'ACC+BCC'),
+    ('', 'integrated_decisions', 'ACC+BCC'),
+    ('', 'idm_decision', 'IDM'),
+    ('', 'calculate_integration_factor', 'integration_factor'),
+    ('', 'move_forward', 'move_forward'),
+    ('', 'handle_collisions', 'handle_collisions'),
+    ('', 'front_gaps', 'front_gaps'),
+    ('', 'record_gaps', 'gap_statistics'),
+    ('', 'check_detectors', 'detectors'),
+    ('neighbors', 'update', 'neighbors'),
+    ('recorder', 'record', 'record'),
+    ('lead_velocity_profile', 'lookup', 'profile'),
+    ('follower_velocity_profile', 'lookup', 'profile'),
+)
+ENGINE_PHASES = (
+    ('engine', 'step', 'engine_step'),
+    ('engine', 'advance', 'advance'),
+    ('engine', 'driver_decision', 'driver_decision'),
+    ('engine', 'integrated_acceleration', 'ACC+BCC'),
+    ('engine', 'move_forward', 'move_forward'),
+    ('engine', 'handle_collisions', 'handle_collisions'),
+    ('engine', 'update_neighbors', 'neighbors'),
+    ('engine', 'front_gaps', 'front_gaps'),
+    ('engine', 'sync_cars', 'sync_cars'),
+)
+
+
+class PhaseProfiler:
+    def __init__(self):
+        # call path (tuple of labels) -> [calls, inclusive seconds, seconds in timed calls below]
+        self.totals = {}
+        self.stack = []
+        self.child_seconds = []
+        self.wrapped = []
+
+    def attach(self, city):
+        """Wraps the phase methods of city; attaching again re-wraps objects replaced since (e.g. by City.init)."""
+        self.detach()
+        for owner, name, label in CITY_PHASES + (ENGINE_PHASES if city.engine is not None else ()):
+            target = getattr(city, owner, None) if owner else city
+            # Velocity profiles are [] until one is assigned
+            if target is not None and hasattr(target, name):
+                self.wrap(target, name, label)
+
+    def detach(self):
+        # Deleting the instance attribute uncovers the class method again
+        for target, name in self.wrapped:
+            if name in vars(target):
+                delattr(target, name)
+        self.wrapped = []
+
+    def wrap(self, target, name, label):
+        method = getattr(target, name)
+        totals = self.totals
+        stack = self.stack
+        child_seconds = self.child_seconds
+        perf_counter = time.perf_counter
+
+        def timed(*args, **kwargs):
+            stack.append(label)
+            child_seconds.append(0.0)
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                path = tuple(stack)
+                stack.pop()
+                children = child_seconds.pop()
+                if child_seconds:
+                    child_seconds[-1] += elapsed
+                entry = totals.get(path)
+                if entry is None:
+                    totals[path] = [1, elapsed, children]
+                else:
+                    entry[0] += 1
+                    entry[1] += elapsed
+                    entry[2] += children
+
+        setattr(target, name, timed)
+        self.wrapped.append((target, name))
+
+    def reset(self):
+        self.totals.clear()
+
+    def paths(self):
+        """{'run;driver_decision;ACC': {'calls', 'seconds', 'self_seconds'}, ...} per call path."""
+        return {';'.join(path): {"calls": calls, "seconds": seconds, "self_seconds": seconds - children}
+                for path, (calls, seconds, children) in self.totals.items()}
+
+    def summary(self):
+        """
+        {'ACC': {'calls', 'seconds', 'self_seconds'}, ...} per phase, summed over
+        every path the phase was called from. A phase nested in itself (e.g.
+        advance inside a vector engine step) counts its inclusive time only once.
+        """
+        phases = {}
+        for path, (calls, seconds, children) in self.totals.items():
+            label = path[-1]
+            entry = phases.setdefault(label, {"calls": 0, "seconds": 0.0, "self_seconds": 0.0})
+            entry["calls"] += calls
+            entry["self_seconds"] += seconds - children
+            if label not in path[:-1]:
+                entry["seconds"] += seconds
+        return phases
+
+    def report(self):
+        lines = [f"{'phase':20s} {'calls':>10s} {'total [s]':>11s} {'self [s]':>11s} {'per call [us]':>14s}"]
+        for label, entry in sorted(self.summary().items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"{label:20s} {entry['calls']:10d} {entry['seconds']:11.4f} {entry['self_seconds']:11.4f} "
+                         f"{1e6 * entry['seconds'] / entry['calls']:14.2f}")
+        return "\n".join(lines)
+
+    def folded(self):
+        """Folded stacks ('run;driver_decision;ACC 1234'), weighted by self time in microseconds."""
+        lines = []
+        for path, (calls, seconds, children) in sorted(self.totals.items()):
+            weight = int(round(1e6 * (seconds - children)))
+            if weight > 0:
+                lines.append(f"{';'.join(path)} {weight}")
+        return "\n".join(lines) + "\n"
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            f.write(self.folded())
@@ -0,0 +1,99 @@
+"""
+recorder.py: Contains the TrajectoryRecorder class, the preallocated step x car history of a City.
+"""
+
+import numpy as np
+
+# mode holds the index of each car's mode in vector_engine.MODES
+CHANNELS = ('position', 'velocity', 'acceleration', 'gap', 'energy', 'integration_factor', 'mode')
+
+class TrajectoryRecorder:
+    """
+    Stores one (step x car) matrix per channel. The matrices are preallocated
+    and grow in chunks of rows, so recording a step is a single row write per
+    channel instead of one list append per car.
+
+    The channel properties return NumPy views of the recorded rows. A view
+    keeps pointing at the old buffer once the recorder grows, so take a fresh
+    one after recording more steps.
+    """
+
+    def __init__(self, car_count, dtype=np.float64, chunk_steps=1024):
+        self.car_count = car_count
+        self.dtype = np.dtype(dtype)
+        self.chunk_steps = chunk_steps
+        self.steps = 0
+        self.buffers = {name: np.empty((chunk_steps, car_count), dtype=self.dtype) for name in CHANNELS}
+
+    @classmethod
+    def from_arrays(cls, channels):
+        # Wrap already recorded (step x car) arrays, e.g. histories returned by a worker process
+        first = np.asarray(channels[CHANNELS[0]])
+        recorder = cls(first.shape[1], dtype=first.dtype, chunk_steps=1)
+        recorder.chunk_steps = 1024
+        recorder.buffers = {name: np.asarray(channels[name], dtype=first.dtype) for name in CHANNELS}
+        recorder.steps = len(first)
+        return recorder
+
+    @property
+    def capacity(self):
+        return len(self.buffers['position'])
+
+    def reserve(self, steps):
+        # Grow in whole chunks until the given number of steps fits
+        if steps <= self.capacity:
+            return
+        chunks = -(-steps // self.chunk_steps)
+        for name, buffer in self.buffers.items():
+            grown = np.empty((chunks * self.chunk_steps, self.car_count), dtype=self.dtype)
+            grown[:self.steps] = buffer[:self.steps]
+            self.buffers[name] = grown
+
+    def record(self, position, velocity, acceleration, gap, energy, integration_factor, mode):
+        """Records one step (one value per car) or a block of steps (step x car arrays)."""
+        rows = 1 if np.ndim(position) < 2 else len(position)
+        self.reserve(self.steps + rows)
+        start, end = self.steps, self.steps + rows
+        buffers = self.buffers
+        buffers['position'][start:end] = position
+        buffers['velocity'][start:end] = velocity
+        buffers['acceleration'][start:end] = acceleration
+        buffers['gap'][start:end] = gap
+        buffers['energy'][start:end] = energy
+        buffers['integration_factor'][start:end] = integration_factor
+        buffers['mode'][start:end] = mode
+        self.steps = end
+
+    def channel(self, name):
+        return self.buffers[name][:self.steps]
+
+    @property
+    def position(self):
+        return self.channel('position')
+
+    @property
+    def velocity(self):
+        return self.channel('velocity')
+
+    @property
+    def acceleration(self):
+        return self.channel('acceleration')
+
+    @property
+    def gap(self):
+        return self.channel('gap')
+
+    @property
+    def energy(self):
+        return self.channel('energy')
+
+    @property
+    def integration_factor(self):
+        return self.channel('integration_factor')
+
+    @property
+    def mode(self):
+        return self.channel('mode')
+
+    def time(self, dt):
+        return np.arange(self.steps) * dt
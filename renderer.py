@@ -0,0 +1,310 @@
+"""
+renderer.py: Offscreen animation of recorded runs, rasterized into NumPy image buffers.
+
+FrameRenderer draws one frame per recorded row without any GUI toolkit: the
+ring road as a grey circle (pos 0 at the top), every car as an arc of its
+length coloured by its mode or by its integration factor, cars that collided
+in the last highlight_seconds with a red halo, and a progress bar along the
+bottom edge. Each car is stamped as a small block of ring pixels with one
+fancy-indexed write for the whole fleet, so a frame costs the same few array
+operations for 10 or 10,000 cars.
+
+render_animation streams the frames to a file as they are produced:
+
+  - .png / .apng: animated PNG written with zlib only (no extra packages)
+  - any other extension (.mp4, .gif, .webm, ...): raw frames piped to ffmpeg
+
+With workers > 1 chunks of frames are rendered and compressed in worker
+processes and written in order while later chunks are still being drawn.
+"""
+
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+BACKGROUND = (255, 255, 255)
+ROAD_COLOR = (200, 200, 200)
+COLLISION_COLOR = (230, 40, 30)
+PROGRESS_COLOR = (140, 140, 140)
+# Car colour per index in vector_engine.MODES: VEL, ACC, BCC, INTEGRATED, IDM
+MODE_COLORS = np.array([(120, 120, 120), (40, 90, 220), (30, 160, 60), (150, 60, 190), (220, 140, 30)],
+                       dtype=np.uint8)
+# color_by='integration_factor' blends from the first colour (0, pure ACC) to the second (1)
+FACTOR_COLORS = (MODE_COLORS[1], MODE_COLORS[2])
+COLOR_BY = ('mode', 'integration_factor')
+# zlib level for animated PNG frames: level 3 is about 2.5x faster than 6 for mostly blank frames
+PNG_COMPRESSION = 3
+
+
+class FrameRenderer:
+    """
+    Renders the rows of one run. position, mode and integration_factor are
+    (step x car) arrays as recorded by TrajectoryRecorder (mode may be None,
+    integration_factor is only needed for color_by='integration_factor').
+    lengths is one car length for all cars or one per car; collisions are
+    Collision objects or (step, front, follower) rows.
+    """
+
+    def __init__(self, position, road_length, dt, mode=None, integration_factor=None, lengths=5.0, collisions=(),
+                 size=480, color_by='mode', highlight_seconds=1.0):
+        if color_by not in COLOR_BY:
+            raise ValueError(f"Unknown color_by: {color_by}")
+        if color_by == 'integration_factor' and integration_factor is None:
+            raise ValueError("color_by='integration_factor' needs the integration_factor channel")
+        self.position = position
+        self.mode = mode
+        self.integration_factor = integration_factor
+        self.road_length = float(road_length)
+        self.dt = dt
+        self.color_by = color_by
+        self.car_count = np.shape(position)[1]
+        self.lengths = np.broadcast_to(np.asarray(lengths, dtype=float), (self.car_count,))
+        # Video encoders want even dimensions
+        self.size = size + size % 2
+        self.highlight_steps = max(1, int(round(highlight_seconds / dt)))
+
+        collisions = [(c.step, c.front, c.follower) if hasattr(c, 'step') else tuple(c)[:3] for c in collisions]
+        collisions = np.array(collisions, dtype=np.int64).reshape(-1, 3)
+        order = np.argsort(collisions[:, 0], kind='stable')
+        self.collision_steps = collisions[order, 0]
+        self.collision_cars = collisions[order, 1:]
+
+        # Ring geometry in pixels: a road band of half width `width` around `radius`
+        self.center = (self.size - 1) / 2
+        self.radius = 0.4 * self.size
+        width = max(3, self.size // 60)
+        self.band = self.radius + np.arange(-width + 1, width, dtype=float)
+        self.halo = self.radius + np.arange(-width - 2, width + 3, dtype=float)
+        # Samples along a car, about one per pixel of its arc
+        metres_per_pixel = self.road_length / (2 * np.pi * self.halo[-1])
+        samples = max(2, int(np.ceil(self.lengths.max() / metres_per_pixel)) + 1)
+        self.along = np.linspace(0.0, 1.0, samples)
+        self.background = self.draw_background()
+
+    @classmethod
+    def from_city(cls, city, **kwargs):
+        recorder = city.recorder
+        return cls(recorder.position, city.roads[0].length, city.dt, mode=recorder.channel('mode'),
+                   integration_factor=recorder.channel('integration_factor'),
+                   lengths=[car.length for car in city.cars], collisions=city.collisions, **kwargs)
+
+    @classmethod
+    def from_export(cls, data, road_length, lengths=5.0, **kwargs):
+        """Reads one model of export.load_trajectories; the export does not store the ring length or car lengths."""
+        meta = data["meta"]
+        if meta["layout"] != 'wide':
+            raise ValueError("Rendering reads the wide layout; export with layout='wide'")
+        return cls(data["position"], road_length, meta["dt"], mode=data["mode"],
+                   integration_factor=data["integration_factor"], lengths=lengths, **kwargs)
+
+    @property
+    def steps(self):
+        return len(self.position)
+
+    def frame_rows(self, fps=20, speed=1.0, start=0, stop=None):
+        """Rows to render so the animation plays at speed times real time at fps frames per second."""
+        stride = max(1, int(round(speed / (fps * self.dt))))
+        return np.arange(start, self.steps if stop is None else stop, stride)
+
+    def pixel_index(self, angle, radii):
+        # Flat pixel index of every (angle, radius) pair; angle 0 is the top of the ring
+        x = np.rint(self.center + radii * np.sin(angle)).astype(np.intp)
+        y = np.rint(self.center - radii * np.cos(angle)).astype(np.intp)
+        return y * self.size + x
+
+    def draw_background(self):
+        frame = np.empty((self.size, self.size, 3), dtype=np.uint8)
+        frame[:] = BACKGROUND
+        samples = int(np.ceil(4 * np.pi * self.band[-1]))
+        angle = np.linspace(0.0, 2 * np.pi, samples, endpoint=False)
+        frame.reshape(-1, 3)[self.pixel_index(angle[:, None], self.band)] = ROAD_COLOR
+        return frame
+
+    def stamp(self, frame, pos, lengths, colors, radii):
+        # A car covers pos .. pos + length on the ring
+        angle = (pos[:, None] + self.along * lengths[:, None]) * (2 * np.pi / self.road_length)
+        index = self.pixel_index(angle[:, :, None], radii).reshape(len(pos), -1)
+        pixels = frame.reshape(-1, 3)
+        if np.ndim(colors) == 1:
+            pixels[index] = colors
+        else:
+            pixels[index] = colors[:, None, :]
+
+    def car_colors(self, row):
+        if self.color_by == 'integration_factor':
+            factor = np.clip(np.asarray(self.integration_factor[row], dtype=float), 0.0, 1.0)[:, None]
+            low, high = FACTOR_COLORS
+            return (low + factor * (high.astype(float) - low)).astype(np.uint8)
+        if self.mode is None:
+            return MODE_COLORS[1]
+        return MODE_COLORS[np.asarray(self.mode[row]).astype(np.intp)]
+
+    def colliding(self, row):
+        # Cars in a collision logged within the last highlight_steps rows
+        first = np.searchsorted(self.collision_steps, row - self.highlight_steps, side='right')
+        last = np.searchsorted(self.collision_steps, row, side='right')
+        return np.unique(self.collision_cars[first:last])
+
+    def render(self, row):
+        """(size x size x 3) uint8 RGB frame of recorded row `row`."""
+        frame = self.background.copy()
+        pos = np.asarray(self.position[row], dtype=float) % self.road_length
+        cars = self.colliding(row)
+        if len(cars):
+            self.stamp(frame, pos[cars], self.lengths[cars], np.array(COLLISION_COLOR, dtype=np.uint8), self.halo)
+        self.stamp(frame, pos, self.lengths, self.car_colors(row), self.band)
+        frame[-4:, :int(round(self.size * (row + 1) / self.steps))] = PROGRESS_COLOR
+        return frame
+
+
+def png_frame_data(frame):
+    """zlib stream of a frame's PNG scanlines (filter type 0 on every row)."""
+    height = len(frame)
+    rows = np.zeros((height, 1 + frame[0].size), dtype=np.uint8)
+    rows[:, 1:] = frame.reshape(height, -1)
+    return zlib.compress(rows.tobytes(), PNG_COMPRESSION)
+
+
+def raw_frame_data(frame):
+    return np.ascontiguousarray(frame, dtype=np.uint8).tobytes()
+
+
+class AnimationWriter:
+    """Streams frames to a file; write_encoded takes the output of encode(frame), e.g. from a worker process."""
+    encode = staticmethod(raw_frame_data)
+
+    def write(self, frame):
+        self.write_encoded(self.encode(frame))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+class ApngWriter(AnimationWriter):
+    """
+    Animated PNG. Every frame is written as soon as it arrives; the frame count
+    in the acTL chunk is patched in when the file is closed.
+    """
+    encode = staticmethod(png_frame_data)
+
+    def __init__(self, path, width, height, fps):
+        self.width = width
+        self.height = height
+        self.fps = int(round(fps))
+        self.frames = 0
+        self.sequence = 0
+        self.file = open(path, 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.file.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        self.actl_offset = self.file.tell()
+        self.file.write(self.actl(0))
+
+    def actl(self, frames):
+        # Frame count and 0 = loop forever
+        return png_chunk(b'acTL', struct.pack('>II', frames, 0))
+
+    def write_encoded(self, data):
+        control = struct.pack('>IIIIIHHBB', self.sequence, self.width, self.height, 0, 0, 1, self.fps, 0, 0)
+        self.file.write(png_chunk(b'fcTL', control))
+        self.sequence += 1
+        if self.frames == 0:
+            # The first frame doubles as the still image for viewers without APNG support
+            self.file.write(png_chunk(b'IDAT', data))
+        else:
+            self.file.write(png_chunk(b'fdAT', struct.pack('>I', self.sequence) + data))
+            self.sequence += 1
+        self.frames += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.write(png_chunk(b'IEND', b''))
+        self.file.seek(self.actl_offset)
+        self.file.write(self.actl(self.frames))
+        self.file.close()
+
+
+class FfmpegWriter(AnimationWriter):
+    """Pipes raw RGB frames to an ffmpeg process, which picks the codec from the file extension."""
+
+    def __init__(self, path, width, height, fps):
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg is None:
+            raise RuntimeError(f"Writing {os.path.basename(path)} needs ffmpeg on the PATH; "
+                               "write a .png (animated PNG) instead")
+        command = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', f'{width}x{height}', '-r', str(fps), '-i', '-']
+        if not path.endswith('.gif'):
+            command += ['-pix_fmt', 'yuv420p']
+        self.process = subprocess.Popen(command + [path], stdin=subprocess.PIPE)
+
+    def write_encoded(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {self.process.returncode}")
+
+
+def open_writer(path, width, height, fps):
+    if str(path).lower().endswith(('.png', '.apng')):
+        return ApngWriter(path, width, height, fps)
+    return FfmpegWriter(str(path), width, height, fps)
+
+
+# The renderer of a worker process, set once by the pool initializer instead of being sent with every chunk
+worker_renderer = None
+
+
+def set_worker_renderer(renderer):
+    global worker_renderer
+    worker_renderer = renderer
+
+
+def render_chunk(rows, encode):
+    """Worker: renders and encodes a chunk of rows."""
+    return [encode(worker_renderer.render(row)) for row in rows]
+
+
+def render_animation(renderer, path, fps=20, speed=1.0, rows=None, workers=1, chunk_frames=16):
+    """
+    Renders rows (default renderer.frame_rows(fps, speed)) to path and returns
+    the number of frames written. With workers > 1 (None = one per CPU) chunks
+    of chunk_frames frames are rendered and encoded in that many processes and
+    written in order, with at most two chunks per worker in flight.
+    """
+    rows = renderer.frame_rows(fps, speed) if rows is None else np.asarray(rows)
+    workers = workers or os.cpu_count()
+    with open_writer(path, renderer.size, renderer.size, fps) as writer:
+        if workers <= 1:
+            for row in rows:
+                writer.write(renderer.render(row))
+            return len(rows)
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_worker_renderer,
+                                 initargs=(renderer,)) as pool:
+            pending = deque()
+            for start in range(0, len(rows), chunk_frames):
+                pending.append(pool.submit(render_chunk, rows[start:start + chunk_frames], writer.encode))
+                if len(pending) >= 2 * workers:
+                    for data in pending.popleft().result():
+                        writer.write_encoded(data)
+            while pending:
+                for data in pending.popleft().result():
+                    writer.write_encoded(data)
+    return len(rows)
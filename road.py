@@ -10,6 +10,11 @@ class Road:
         self.dir_x = dir_x
         self.dir_y = dir_y
         self.cars_on_road = []
+        # Network links (see network.py); a City ring road leaves them empty
+        self.successors = []
+        self.left = None
+        self.right = None
+        self.inflow = 0.0
 
     def get_length(self):
         return self.length
@@ -35,3 +40,18 @@ class Road:
 
     def get_cars_on_road(self):
         return self.cars_on_road
+
+    def connect(self, road, entry_pos=None, weight=1.0):
+        """
+        Cars reaching the end of this road (pos 0) continue on road at entry_pos
+        (its start, road.length, by default). With several successors each car
+        picks one with probability proportional to weight; no successors = exit.
+        """
+        self.successors.append((road, road.length if entry_pos is None else entry_pos, weight))
+
+    def set_adjacent(self, left=None, right=None):
+        # Parallel lanes of the same length that cars may change into
+        if left is not None:
+            self.left, left.right = left, self
+        if right is not None:
+            self.right, right.left = right, self
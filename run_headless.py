@@ -1,20 +1,27 @@
+import os
 import matplotlib.pyplot as plt
-import csv
 from city import City
+from parallel_runner import run_models
+from export import export_trajectories
+from renderer import FrameRenderer, render_animation
+from spacetime import SpaceTimeField, city_amplification
+from events import SteadyState
+from energy import Powertrain
+from fleet import Fleet
+from profile_loader import load_profile
 import numpy as numpy
 import pandas as pd
 
-def load_velocity_profiles(city_acc, city_bcc, city_accbcc):
+def read_velocity_profile(filename, units='m/s'):
+    """Reads a (time, velocity) profile from a CSV file (cached, see profile_loader.py)."""
+    return load_profile(filename, units)
+
+def load_velocity_profiles(city_acc, city_bcc, city_accbcc, filename="data.csv", units='m/s'):
     """Loads the velocity profiles from data files and assigns them to the cities."""
     ego_velocity_profile = []
     ego_velocity_profile_1 = []
     try:
-        with open("data.csv", 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                time = float(row['time'])
-                velocity = float(row['velocity'])
-                ego_velocity_profile.append((time, velocity))
+        ego_velocity_profile = read_velocity_profile(filename, units)
 
         # with open("data2.csv", 'r') as f:
         #     reader = csv.DictReader(f)
@@ -23,7 +30,7 @@ def load_velocity_profiles(city_acc, city_bcc, city_accbcc):
         #         velocity = float(row['velocity'])
         #         ego_velocity_profile_1.append((time, velocity))
         
-        print("Velocity profiles loaded from data1.csv")
+        print(f"Velocity profiles loaded from {filename}")
 
         # Assign profiles to all city models
         city_acc.lead_velocity_profile = ego_velocity_profile
@@ -46,49 +53,31 @@ def load_velocity_profiles(city_acc, city_bcc, city_accbcc):
 
 
 def plot_results(city_acc, city_bcc, city_accbcc, dt, use_profiles):
-    """Plots the velocity and acceleration profiles for all three models."""
+    """Plots the space-time speed field and the acceleration of every car for all three models."""
     fig, axes = plt.subplots(3, 2, figsize=(18, 12), sharex='col')
     fig.suptitle('Simulation Results', fontsize=16)
 
     # --- Plotting function for a single model ---
     def plot_model(ax_vel, ax_acc, city, model_name):
-        num_cars = len(city.cars)
-        
-        # Plot follower cars first
-        for idx, car in enumerate(city.cars):
-            if idx == 0:
-                continue # Skip lead car, we'll plot it last
-
-            time_axis = [dt * i for i in range(len(car.vel_history))]
-            
-            color = 'gray'
-            linewidth = 0.8
-
-            # Color car 2 green ONLY if velocity profiles are active
-            if use_profiles and idx == 2:
-                color = 'green'
-                linewidth = 1.5
-
-            ax_vel.plot(time_axis, car.vel_history, color=color, linewidth=linewidth)
-            ax_acc.plot(time_axis, car.acc_history, color=color, linewidth=linewidth)
-
-        # Plot the lead car (car 0) last to ensure it's on top
-        if num_cars > 0:
-            lead_car = city.cars[0]
-            time_axis = [dt * i for i in range(len(lead_car.vel_history))]
-            ax_vel.plot(time_axis, lead_car.vel_history, color='red', linewidth=1.5)
-            ax_acc.plot(time_axis, lead_car.acc_history, color='red', linewidth=1.5)
-
-
-        ax_vel.set_title(f"{model_name} Velocity")
-        ax_vel.set_ylabel("Velocity (m/s)")
-        ax_vel.grid(True)
-
+        # One image per panel instead of one line per car (see spacetime.py)
+        field = SpaceTimeField.from_city(city, dt=dt)
+        wave = field.wave_speed()
+        image = ax_vel.imshow(field.speed.T, origin='lower', aspect='auto', cmap='RdYlGn', vmin=0,
+                              extent=(field.time_edges[0], field.time_edges[-1], 0, field.space_edges[-1]))
+        fig.colorbar(image, ax=ax_vel, label="Speed (m/s)")
+        ax_vel.set_title(f"{model_name} Speed (wave speed {wave:.1f} m/s)")
+        ax_vel.set_ylabel("Position (m)")
+
+        acceleration = city.recorder.acceleration
+        limit = max(float(numpy.abs(acceleration).max()), 1e-6)
+        image = ax_acc.imshow(acceleration.T, origin='lower', aspect='auto', cmap='coolwarm', vmin=-limit, vmax=limit,
+                              interpolation='nearest', extent=(0, len(acceleration) * dt, -0.5, acceleration.shape[1] - 0.5))
+        fig.colorbar(image, ax=ax_acc, label="Acceleration (m/s^2)")
+        # Car 2 follows the follower velocity profile when profiles are active
+        if use_profiles and acceleration.shape[1] > 2:
+            ax_acc.axhline(2, color='green', linewidth=0.8)
         ax_acc.set_title(f"{model_name} Acceleration")
-        ax_acc.set_ylabel("Acceleration (m/s^2)")
-        ax_acc.grid(True)
-
-
+        ax_acc.set_ylabel("Car")
 
     # --- Plot each model ---
     plot_model(axes[0, 0], axes[0, 1], city_acc, "ACC")
@@ -102,11 +91,27 @@ def plot_results(city_acc, city_bcc, city_accbcc, dt, use_profiles):
     plt.tight_layout(rect=[0.025, 0.025, 0.975, 0.975])
     plt.show()
 
+
+def plot_fundamental_diagram(city_acc, city_bcc, city_accbcc, dt):
+    """Scatters the (density, flow) points of the space-time cells of each model."""
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for name, city in (('ACC', city_acc), ('BCC', city_bcc), ('ACC+BCC', city_accbcc)):
+        # Coarser cells than the speed image, so each point averages several cars
+        density, flow = SpaceTimeField.from_city(city, dt=dt, space_bins=20, time_bin=5.0).fundamental_diagram()
+        ax.scatter(density, flow, s=6, alpha=0.5, label=name)
+    ax.set_xlabel("Density (veh/km)")
+    ax.set_ylabel("Flow (veh/h)")
+    ax.set_title("Fundamental Diagram")
+    ax.legend()
+    ax.grid(True)
+    plt.show()
+
 def plot_energy_consumption(city_acc, city_bcc, city_accbcc):
     """Plots the total energy consumption for each model as a bar graph."""
-    total_energy_acc = sum(car.energy_used for car in city_acc.cars)
-    total_energy_bcc = sum(car.energy_used for car in city_bcc.cars)
-    total_energy_accbcc = sum(car.energy_used for car in city_accbcc.cars)
+    # Last row of the recorded cumulative energy of every car
+    total_energy_acc = city_acc.recorder.energy[-1].sum()
+    total_energy_bcc = city_bcc.recorder.energy[-1].sum()
+    total_energy_accbcc = city_accbcc.recorder.energy[-1].sum()
 
     models = ['ACC', 'BCC', 'ACC+BCC']
     energy_values = [total_energy_acc, total_energy_bcc, total_energy_accbcc]
@@ -128,18 +133,18 @@ def display_gap_statistics(city_acc, city_bcc, city_accbcc):
     # --- ACC ---
     min_gap_acc = city_acc.overall_min_gap
     max_gap_acc = city_acc.overall_max_gap
-    avg_gap_acc = sum(city_acc.all_gaps) / len(city_acc.all_gaps) if city_acc.all_gaps else 0
+    avg_gap_acc = city_acc.gap_stats.summary()["mean"] if city_acc.gap_stats.count else 0
 
     # --- BCC ---
     min_gap_bcc = city_bcc.overall_min_gap
     max_gap_bcc = city_bcc.overall_max_gap
-    avg_gap_bcc = sum(city_bcc.all_gaps) / len(city_bcc.all_gaps) if city_bcc.all_gaps else 0
+    avg_gap_bcc = city_bcc.gap_stats.summary()["mean"] if city_bcc.gap_stats.count else 0
 
     # --- ACC+BCC ---
     min_gap_accbcc = city_accbcc.overall_min_gap
     max_gap_accbcc = city_accbcc.overall_max_gap
-    avg_gap_accbcc = sum(city_accbcc.all_gaps) / len(city_accbcc.all_gaps) if city_accbcc.all_gaps else 0
-    print("Lenght: ", len(city_accbcc.all_gaps))
+    avg_gap_accbcc = city_accbcc.gap_stats.summary()["mean"] if city_accbcc.gap_stats.count else 0
+    print("Lenght: ", city_accbcc.gap_stats.count)
     print("\n--- Inter-vehicular Distance Statistics ---")
     print(f"ACC Model:")
     print(f"  - Minimum Distance: {min_gap_acc:.2f} m")
@@ -159,21 +164,9 @@ def display_gap_statistics(city_acc, city_bcc, city_accbcc):
 
 import numpy as np
 
-def get_gap_statistics(gaps):
-    gaps = np.array(gaps)
-
-    stats = {
-        "min": np.min(gaps),
-        "p5": np.percentile(gaps, 5),
-        "p25": np.percentile(gaps, 25),
-        "median": np.median(gaps),
-        "mean": np.mean(gaps),
-        "p75": np.percentile(gaps, 75),
-        "p95": np.percentile(gaps, 95),
-        "max": np.max(gaps),
-        "std": np.std(gaps, ddof=1),  # sample std deviation
-        "variance": np.var(gaps, ddof=1)  # sample variance
-    }
+def get_gap_statistics(gap_stats):
+    # min, percentiles, mean, max, sample std and variance from the city's streaming accumulator
+    stats = gap_stats.summary()
     df = pd.DataFrame.from_dict(stats, orient="index", columns=["Value"])
     df.index.name = "Statistic"
     print(df.to_string(float_format="%.4f"))
@@ -186,6 +179,23 @@ def main():
     # --- Control Flag ---
     # Set this to True to use data1.csv and data2.csv, False to run without them.
     USE_VELOCITY_PROFILES = True
+    # Set this to True to run the three models in separate processes
+    RUN_IN_PARALLEL = False
+    # Set this to a directory to export the trajectories of every model (see export.py)
+    EXPORT_DIR = None
+    # Set this to True to fast-forward each model once it has settled into steady state (see events.py)
+    EARLY_STOP = False
+    # Set this to (motor_map_path, regen_map_path) to use powertrain efficiency maps and regenerative
+    # braking (see energy.py); either path may be None
+    POWERTRAIN_MAPS = None
+    # Set this to a fleet CSV file (one row per vehicle with columns such as length, mass, kd, kv; see fleet.py)
+    # for per-vehicle parameters; car_number is taken from the file
+    FLEET_FILE = None
+    # Set this to controller shares, e.g. {'ACC+BCC': 0.3, 'ACC': 0.2, 'IDM': 0.5} (IDM: human drivers), to run
+    # mixed-penetration traffic: every model then runs the same random mix of controllers (see fleet.py)
+    PENETRATION = None
+    # Set this to a directory to write an animation of every model as <model>.png (animated PNG, see renderer.py)
+    ANIMATION_DIR = None
     
     # --- Simulation Parameters ---
     simulation_duration = 60  # Run for 60 seconds
@@ -203,11 +213,41 @@ def main():
         "max_a": 4.0,
         "min_a": -5.0,
         "min_gap": 2.0,
-        "dt": 0.1
+        "dt": 0.1,
+        # 'adaptive' splits a step of dt into up to max_substeps during hard braking (see integration.py)
+        "integrator": "fixed",
+        "max_substeps": 10
     }
+    if POWERTRAIN_MAPS:
+        params["powertrain"] = Powertrain.from_files(*POWERTRAIN_MAPS)
+    if FLEET_FILE:
+        params["fleet"] = Fleet.load(FLEET_FILE)
+        params["car_number"] = len(params["fleet"])
+    if PENETRATION:
+        mix = Fleet.sample(params["car_number"], [{'name': name, 'share': share, 'controller': name}
+                                                  for name, share in PENETRATION.items()], seed=0)
+        if "fleet" in params:
+            params["fleet"].controller = mix.controller
+        else:
+            params["fleet"] = mix
     dt = params["dt"]
     num_steps = int(simulation_duration / dt)
 
+    if RUN_IN_PARALLEL:
+        lead_velocity_profile = []
+        if USE_VELOCITY_PROFILES:
+            try:
+                lead_velocity_profile = read_velocity_profile("data.csv")
+            except FileNotFoundError:
+                print("Warning: data.csv not found. Running without velocity profiles.")
+        print(f"Running simulation for {simulation_duration} seconds ({num_steps} steps) in parallel...")
+        results = run_models(params, duration=simulation_duration, lead_velocity_profile=lead_velocity_profile,
+                             detectors=[SteadyState()] if EARLY_STOP else ())
+        city_acc, city_bcc, city_accbcc = results['ACC'], results['BCC'], results['ACC+BCC']
+        print("Simulation complete.")
+        report(city_acc, city_bcc, city_accbcc, dt, USE_VELOCITY_PROFILES, EXPORT_DIR, ANIMATION_DIR)
+        return
+
     # --- Initialize City Models ---
     city_acc = City()
     city_bcc = City()
@@ -216,36 +256,93 @@ def main():
     # Unpack params dictionary to pass as arguments
     init_args = [params[k] for k in ["car_number", "kd", "kv", "kc", "v_des", "max_v", "min_v", "min_dis", "reaction_time", "headway_time", "max_a", "min_a", "min_gap"]]
 
-    city_acc.init(*init_args, dt=dt, model='ACC')
-    city_bcc.init(*init_args, dt=dt, model='BCC')
-    city_accbcc.init(*init_args, dt=dt, model='ACC+BCC')
+    integration = {"integrator": params["integrator"], "max_substeps": params["max_substeps"],
+                   "powertrain": params.get("powertrain"), "fleet": params.get("fleet")}
+    city_acc.init(*init_args, dt=dt, model='ACC', **integration)
+    city_bcc.init(*init_args, dt=dt, model='BCC', **integration)
+    city_accbcc.init(*init_args, dt=dt, model='ACC+BCC', **integration)
 
     # --- Load Velocity Profiles (Conditional) ---
     if USE_VELOCITY_PROFILES:
         # This is crucial to replicate the scenario from the GUI
         load_velocity_profiles(city_acc, city_bcc, city_accbcc)
 
+    cities = (city_acc, city_bcc, city_accbcc)
+    if EARLY_STOP:
+        for city in cities:
+            city.add_detector(SteadyState())
+
     # --- Run Simulation Loop ---
     print(f"Running simulation for {simulation_duration} seconds ({num_steps} steps)...")
     for step in range(num_steps):
         # Print progress every 10%
         if (step + 1) % (num_steps // 10) == 0:
             print(f"  ...Progress: {int(((step + 1) / num_steps) * 100)}%")
-            
-        city_acc.run(dt)
-        city_bcc.run(dt)
-        city_accbcc.run(dt)
-    
+
+        for city in cities:
+            if not city.stopped:
+                city.run(dt)
+        if all(city.stopped for city in cities):
+            break
+    # Models that reached steady state are extrapolated to the full duration
+    for city in cities:
+        if city.stop_action == 'fast_forward':
+            city.fast_forward(num_steps - city.step_count, dt)
+
     print("Simulation complete.")
+    report(city_acc, city_bcc, city_accbcc, dt, USE_VELOCITY_PROFILES, EXPORT_DIR, ANIMATION_DIR)
+
+
+def report(city_acc, city_bcc, city_accbcc, dt, use_profiles, export_dir=None, animation_dir=None):
+    """Plots and prints the results; accepts City objects or parallel_runner.ModelResult objects."""
+    if export_dir:
+        export_trajectories({'ACC': city_acc, 'BCC': city_bcc, 'ACC+BCC': city_accbcc}, export_dir, dt)
+        print(f"Trajectories exported to {export_dir}")
+    if animation_dir:
+        os.makedirs(animation_dir, exist_ok=True)
+        for name, city in (('ACC', city_acc), ('BCC', city_bcc), ('ACC+BCC', city_accbcc)):
+            # A ModelResult has no ring geometry to draw
+            if hasattr(city, 'roads'):
+                path = os.path.join(animation_dir, f"{name}.png")
+                frames = render_animation(FrameRenderer.from_city(city), path, workers=None)
+                print(f"{name}: {frames} frames written to {path}")
+
+    for name, city in (('ACC', city_acc), ('BCC', city_bcc), ('ACC+BCC', city_accbcc)):
+        for event in getattr(city, 'events', ()):
+            print(f"{name}: {event.name} at {event.time:.1f} s ({event.detail})")
+        summary = city.integration_summary()
+        if summary and summary["substeps"] != summary["steps"]:
+            print(f"{name}: {summary['substeps']} integration steps for {summary['steps']} steps of dt "
+                  f"(mean {summary['mean_substeps']:.2f}, max {summary['max_substeps']} per step, "
+                  f"{summary.get('fast_forward_steps', 0)} fast-forwarded)")
+        if hasattr(city, 'energy_summary'):
+            energy = city.energy_summary()
+            if energy["recovered"]:
+                print(f"{name}: {energy['consumed']:.3f} kWh consumed, {energy['recovered']:.3f} kWh recovered, "
+                      f"{energy['net']:.3f} kWh net")
+        # Mixed-penetration runs: energy and gaps of every controller group
+        groups = city.group_summary() if hasattr(city, 'group_summary') else {}
+        if len(groups) > 2:
+            for group, stats in groups.items():
+                print(f"{name} [{group}]: {stats['cars']} cars, {stats['consumed']:.3f} kWh consumed, "
+                      f"{stats['recovered']:.3f} kWh recovered, gap mean {stats['mean_gap']:.2f} m, "
+                      f"min {stats['min_gap']:.2f} m")
+
+    for name, city in (('ACC', city_acc), ('BCC', city_bcc), ('ACC+BCC', city_accbcc)):
+        # Followers only: the lead car's ratio compares it with the last car of the ring
+        amplification = city_amplification(city)[1:]
+        print(f"{name}: wave speed {SpaceTimeField.from_city(city, dt=dt).wave_speed():.2f} m/s, "
+              f"max string amplification {numpy.nanmax(amplification, initial=0.0):.2f}")
 
     # --- Plot Final Results ---
     print("Generating plots...")
-    plot_results(city_acc, city_bcc, city_accbcc, dt, USE_VELOCITY_PROFILES)
+    plot_results(city_acc, city_bcc, city_accbcc, dt, use_profiles)
+    plot_fundamental_diagram(city_acc, city_bcc, city_accbcc, dt)
     plot_energy_consumption(city_acc, city_bcc, city_accbcc)
     display_gap_statistics(city_acc, city_bcc, city_accbcc)
-    acc_stats = get_gap_statistics(city_acc.all_gaps)
-    bcc_stats = get_gap_statistics(city_bcc.all_gaps)
-    int_stats = get_gap_statistics(city_accbcc.all_gaps)
+    acc_stats = get_gap_statistics(city_acc.gap_stats)
+    bcc_stats = get_gap_statistics(city_bcc.gap_stats)
+    int_stats = get_gap_statistics(city_accbcc.gap_stats)
 
     print("ACC Stats:", acc_stats)
     print("BCC Stats:", bcc_stats)
@@ -0,0 +1,145 @@
+"""
+simulation_worker.py: Runs City models in a background thread and hands snapshots to a display.
+
+SimulationWorker advances its cities one step of dt at a time, paced to
+`speed` times real time (speed=None runs as fast as possible), and publishes
+a Snapshot of every city to a SnapshotChannel whenever the display has taken
+the previous one. The display (ControlWindow) polls the channel at its own
+capped frame rate and paints the latest snapshot, so steps the display is too
+slow for are simply never captured. Snapshots are plain copies of the car
+state: the display never reads a Car while the worker is moving it.
+"""
+
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+
+class CarView:
+    """Copy of the car attributes a painter reads."""
+    __slots__ = ('pos', 'velocity', 'length', 'color', 'mode', 'integration_factor')
+
+    def __init__(self, pos, velocity, length, color, mode, integration_factor):
+        self.pos = pos
+        self.velocity = velocity
+        self.length = length
+        self.color = color
+        self.mode = mode
+        self.integration_factor = integration_factor
+
+
+class Snapshot:
+    """State of one City after `step` steps."""
+
+    def __init__(self, city):
+        self.step = city.step_count
+        self.time = city.step_count * city.dt
+        # Roads are not changed by City.run, so the painter can share them
+        self.roads = list(city.roads)
+        self.cars = [CarView(c.pos, c.velocity, c.length, c.color, c.mode, c.integration_factor) for c in city.cars]
+        self.energy = city.energy_summary()["consumed"]
+        self.collision_count = city.collision_count
+
+
+class SnapshotChannel:
+    """
+    Single-slot mailbox between one producer and one consumer. publish() and
+    take() only swap references (atomic in CPython), so neither side locks or
+    waits: the consumer always gets the newest snapshots and older ones are
+    dropped.
+    """
+
+    def __init__(self):
+        # (sequence, snapshots) in one reference, so the consumer never pairs a number with the wrong frame
+        self.latest = (0, None)
+        # Set by the consumer when it is ready for a new frame; the producer only captures one then
+        self.wanted = True
+
+    def publish(self, snapshots):
+        # Cleared before the frame appears: the consumer can only ask for the next one after seeing this one
+        self.wanted = False
+        self.latest = (self.latest[0] + 1, snapshots)
+
+    def take(self, last_sequence=0):
+        """Returns (sequence, snapshots) if something newer than last_sequence was published, else None."""
+        sequence, snapshots = self.latest
+        if sequence == last_sequence or snapshots is None:
+            return None
+        self.wanted = True
+        return sequence, snapshots
+
+
+class SimulationWorker(threading.Thread):
+    def __init__(self, cities, dt, speed=1.0, channel=None):
+        super().__init__(daemon=True)
+        self.cities = list(cities)
+        self.dt = dt
+        self.speed = speed
+        self.channel = channel if channel is not None else SnapshotChannel()
+        self.leader_stop = False
+        self.follower_stop = False
+        self.steps = 0
+        self.error = None
+        self.stopping = threading.Event()
+        self.running = threading.Event()
+        self.running.set()
+        # Held while a step is in progress, so paused() can wait for the cities to be consistent
+        self.step_lock = threading.Lock()
+        self.rebase = True
+
+    def set_speed(self, speed):
+        # Multiple of real time; None or 0 runs as fast as possible
+        self.speed = speed or None
+        self.rebase = True
+
+    def stop(self, timeout=1.0):
+        self.stopping.set()
+        self.running.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    @contextmanager
+    def paused(self):
+        """Holds the worker between steps, e.g. while the recorded histories are plotted."""
+        self.running.clear()
+        try:
+            with self.step_lock:
+                yield self
+        finally:
+            self.rebase = True
+            self.running.set()
+
+    def run(self):
+        try:
+            self.loop()
+        except Exception as error:
+            self.error = error
+            traceback.print_exc()
+
+    def loop(self):
+        channel = self.channel
+        while not self.stopping.is_set():
+            if not self.running.is_set():
+                self.running.wait()
+                continue
+            if self.rebase:
+                # Pace from here: after a pause or a speed change the worker must not try to catch up
+                self.rebase = False
+                start_time = time.perf_counter()
+                start_steps = self.steps
+
+            with self.step_lock:
+                for city in self.cities:
+                    city.set_leader_stop(self.leader_stop)
+                    city.set_follower_stop(self.follower_stop)
+                    city.run(self.dt)
+                self.steps += 1
+                if channel.wanted:
+                    channel.publish([Snapshot(city) for city in self.cities])
+
+            speed = self.speed
+            if speed:
+                ahead = (self.steps - start_steps) * self.dt / speed - (time.perf_counter() - start_time)
+                if ahead > 0:
+                    self.stopping.wait(ahead)
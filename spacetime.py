@@ -0,0 +1,178 @@
+"""
+spacetime.py: Space-time (x-t) fields of a recorded run and the traffic-wave measures derived from them.
+
+SpaceTimeField bins every recorded (step, car) sample into time x space cells
+of the ring with np.bincount, using Edie's generalised definitions: a sample
+adds dt vehicle-seconds and velocity * dt vehicle-metres to its cell, so
+
+    density = vehicle-seconds / cell area     (veh/m)
+    flow    = vehicle-metres / cell area      (veh/s)
+    speed   = vehicle-metres / vehicle-seconds (space-mean speed, m/s)
+
+From the field:
+
+  - wave_speed(): propagation speed of stop-and-go waves from the spatial
+    shift that best aligns the speed field with itself lag_seconds later
+    (circular cross-correlation along the ring). Speeds are given in the
+    driving direction, so a wave travelling upstream is negative.
+  - fundamental_diagram(): (density, flow) points of the occupied cells.
+
+string_amplification() works on the per-car velocity histories: the size of
+each car's speed deviations divided by that of the car in front of it
+(> 1 means disturbances grow along the platoon).
+"""
+
+import numpy as np
+
+
+def ring_length(city):
+    # A City knows its roads; a parallel_runner.ModelResult carries the length of the ring it ran on
+    return city.roads[0].length if getattr(city, 'roads', None) else city.road_length
+
+
+def row_chunks(steps, chunk_steps):
+    for start in range(0, steps, chunk_steps):
+        yield start, min(start + chunk_steps, steps)
+
+
+def fill_ring(field):
+    """Copy of a (time x space) field with its NaN cells interpolated around the ring from the occupied ones."""
+    filled = np.nan_to_num(field)
+    cells = np.arange(field.shape[1])
+    for row, values in zip(filled, field):
+        known = ~np.isnan(values)
+        if known.any() and not known.all():
+            row[~known] = np.interp(cells[~known], cells[known], values[known], period=len(cells))
+    return filled
+
+
+class SpaceTimeField:
+    """
+    Vehicle-seconds (occupancy) and vehicle-metres (distance) per cell of a
+    (time bin x space bin) grid; time_edges are in seconds, space_edges in
+    metres along the ring.
+    """
+
+    def __init__(self, time_edges, space_edges, occupancy, distance):
+        self.time_edges = np.asarray(time_edges, dtype=float)
+        self.space_edges = np.asarray(space_edges, dtype=float)
+        self.occupancy = occupancy
+        self.distance = distance
+
+    @classmethod
+    def from_histories(cls, position, velocity, road_length, dt, space_bins=100, time_bin=1.0, chunk_steps=4096):
+        """
+        Bins (step x car) position and velocity histories into cells of
+        road_length / space_bins metres and time_bin seconds (a whole number
+        of steps). Rows are binned chunk_steps at a time.
+        """
+        steps = len(position)
+        rows_per_bin = max(1, int(round(time_bin / dt)))
+        time_bins = max(1, -(-steps // rows_per_bin))
+        cells = time_bins * space_bins
+        occupancy = np.zeros(cells)
+        distance = np.zeros(cells)
+        for start, end in row_chunks(steps, chunk_steps):
+            pos = np.asarray(position[start:end], dtype=float) % road_length
+            space_index = np.minimum((pos * (space_bins / road_length)).astype(np.intp), space_bins - 1)
+            time_index = (np.arange(start, end) // rows_per_bin)[:, None]
+            cell = (time_index * space_bins + space_index).ravel()
+            occupancy += np.bincount(cell, minlength=cells)
+            distance += np.bincount(cell, weights=np.abs(np.asarray(velocity[start:end], dtype=float)).ravel(),
+                                    minlength=cells)
+        # The last time bin may cover fewer steps than the others
+        time_edges = np.minimum(np.arange(time_bins + 1) * rows_per_bin, steps) * dt
+        space_edges = np.linspace(0.0, road_length, space_bins + 1)
+        return cls(time_edges, space_edges, (occupancy * dt).reshape(time_bins, space_bins),
+                   (distance * dt).reshape(time_bins, space_bins))
+
+    @classmethod
+    def from_city(cls, city, dt=None, **kwargs):
+        """Field of a City (or parallel_runner.ModelResult) from its recorder."""
+        recorder = city.recorder
+        dt = city.dt if dt is None else dt
+        return cls.from_histories(recorder.position, recorder.velocity, ring_length(city), dt, **kwargs)
+
+    @property
+    def cell_area(self):
+        # Seconds x metres of every cell
+        return np.diff(self.time_edges)[:, None] * np.diff(self.space_edges)[None, :]
+
+    @property
+    def density(self):
+        return self.occupancy / self.cell_area
+
+    @property
+    def flow(self):
+        return self.distance / self.cell_area
+
+    @property
+    def speed(self):
+        """Space-mean speed per cell in m/s, NaN where no car passed."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.occupancy > 0, self.distance / self.occupancy, np.nan)
+
+    def wave_speed(self, lag_seconds=5.0):
+        """
+        Propagation speed (m/s, in the driving direction) of the speed pattern,
+        NaN when the field has no speed variations to follow.
+        """
+        durations = np.diff(self.time_edges)
+        bin_seconds = durations[0]
+        lag = max(1, int(round(lag_seconds / bin_seconds)))
+        # A shorter last bin would break the even time spacing the lag relies on
+        speed = self.speed[durations > bin_seconds - 1e-9]
+        if len(speed) <= lag:
+            return np.nan
+        anomaly = fill_ring(speed)
+        anomaly -= anomaly.mean(axis=1, keepdims=True)
+        spectra = np.fft.rfft(anomaly, axis=1)
+        # correlation[s] = sum over t and x of anomaly[t, x] * anomaly[t + lag, x + s]
+        correlation = np.fft.irfft((np.conj(spectra[:-lag]) * spectra[lag:]).sum(axis=0), n=anomaly.shape[1])
+        peak = int(np.argmax(correlation))
+        if correlation[peak] <= 0:
+            return np.nan
+        # Sub-cell peak from a parabola through its circular neighbours
+        left, right = correlation[peak - 1], correlation[(peak + 1) % len(correlation)]
+        curvature = left - 2 * correlation[peak] + right
+        shift = peak + (0.5 * (left - right) / curvature if curvature < 0 else 0.0)
+        if shift > len(correlation) / 2:
+            shift -= len(correlation)
+        cell = self.space_edges[1] - self.space_edges[0]
+        # Cars drive toward lower pos, so a pattern moving to higher pos travels upstream
+        return -shift * cell / (lag * bin_seconds)
+
+    def fundamental_diagram(self):
+        """(density in veh/km, flow in veh/h) of every occupied cell."""
+        occupied = self.occupancy > 0
+        return self.density[occupied] * 1000, self.flow[occupied] * 3600
+
+
+def front_cars(initial_position, road_length):
+    # The car in front of each car is the next one at a lower pos around the ring
+    order = np.argsort(np.asarray(initial_position, dtype=float) % road_length, kind='stable')
+    front = np.empty(len(order), dtype=np.intp)
+    front[order] = np.roll(order, 1)
+    return front
+
+
+def string_amplification(velocity, position, road_length, dt, after=0.0, norm='l2'):
+    """
+    Per car, the size of its speed deviations from its own mean speed (the
+    'l2' norm or the 'max' deviation, from `after` seconds on) divided by that
+    of the car in front of it. The ring order is taken from the first row of
+    position. NaN where the car in front never deviated.
+    """
+    if norm not in ('l2', 'max'):
+        raise ValueError(f"Unknown norm: {norm}")
+    velocity = np.asarray(velocity[int(round(after / dt)):], dtype=float)
+    deviation = velocity - velocity.mean(axis=0)
+    size = np.sqrt((deviation ** 2).sum(axis=0)) if norm == 'l2' else np.abs(deviation).max(axis=0)
+    front_size = size[front_cars(position[0], road_length)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(front_size > 0, size / front_size, np.nan)
+
+
+def city_amplification(city, **kwargs):
+    recorder = city.recorder
+    return string_amplification(recorder.velocity, recorder.position, ring_length(city), city.dt, **kwargs)
@@ -0,0 +1,202 @@
+"""
+sweep.py: Parameter sweeps over the City.init gains and timing parameters.
+
+A design (grid, random or Latin hypercube) is a list of parameter overrides.
+run_sweep() fans the points out to worker processes in chunks and streams
+every finished chunk to a columnar part file (part-*.npz, one array per
+column) in the output directory. Each row carries a point_id derived from
+the full parameter set, so rerunning the same sweep skips finished points.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import copy
+import hashlib
+import itertools
+import json
+import os
+import uuid
+import numpy as np
+from parallel_runner import build_city
+
+RESULT_COLUMNS = ["energy", "gap_min", "gap_mean", "collision_count", "max_jerk", "steps_run", "stop_event"]
+
+
+def grid_design(space):
+    """Full factorial design from {name: [values]}."""
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def random_design(bounds, n, seed=None):
+    """n points drawn uniformly from {name: (low, high)}."""
+    rng = np.random.default_rng(seed)
+    samples = {name: rng.uniform(low, high, n) for name, (low, high) in bounds.items()}
+    return [{name: float(samples[name][i]) for name in bounds} for i in range(n)]
+
+
+def latin_hypercube_design(bounds, n, seed=None):
+    """n points from {name: (low, high)} with exactly one point in each of the n strata of every parameter."""
+    rng = np.random.default_rng(seed)
+    samples = {}
+    for name, (low, high) in bounds.items():
+        unit = (rng.permutation(n) + rng.random(n)) / n
+        samples[name] = low + unit * (high - low)
+    return [{name: float(samples[name][i]) for name in bounds} for i in range(n)]
+
+
+def is_scalar(value):
+    return value is None or isinstance(value, (bool, int, float, str, np.generic))
+
+
+def scalar_params(params):
+    # The parameters that fit a result column; objects such as a fleet or powertrain only enter the point_id
+    return {name: value for name, value in params.items() if is_scalar(value)}
+
+
+def value_key(value):
+    """JSON-able stand-in for a parameter value: scalars as they are, arrays and objects by a digest of their contents."""
+    if is_scalar(value):
+        return value.item() if isinstance(value, np.generic) else value
+    if isinstance(value, (list, tuple)):
+        return [value_key(item) for item in value]
+    if isinstance(value, dict):
+        return [[str(name), value_key(item)] for name, item in sorted(value.items(), key=lambda kv: str(kv[0]))]
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest = hashlib.sha1(f"{value.dtype.str}{value.shape}".encode())
+        digest.update(value.tobytes())
+        return digest.hexdigest()
+    # e.g. a fleet.Fleet (its arrays) or an energy.Powertrain (its settings and efficiency maps)
+    key = json.dumps([type(value).__name__, value_key(vars(value))])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def point_id(params, model, duration, lead_velocity_profile, detectors=()):
+    # Stable id of everything that determines the result of a run
+    key = [model, duration, value_key(params)]
+    if detectors:
+        key.append([[type(detector).__name__, sorted(detector.config.items())] for detector in detectors])
+    key = json.dumps(key)
+    digest = hashlib.sha1(key.encode())
+    digest.update(np.ascontiguousarray(lead_velocity_profile, dtype=float).tobytes())
+    return digest.hexdigest()[:20]
+
+
+def evaluate(params, model, duration, lead_velocity_profile=(), engine='object', detectors=()):
+    """
+    Runs one City and returns its result row. detectors (events.Detector) are
+    copied onto the City, so a stable point can stop early or fast-forward
+    through its steady state.
+    """
+    city = build_city(params, model, lead_velocity_profile, engine)
+    for detector in detectors:
+        city.add_detector(copy.deepcopy(detector))
+    dt = params["dt"]
+    steps_run = city.run_steps(int(duration / dt), dt)
+    # Only the integrated rows: fast-forwarded rows hold a zero acceleration the simulation never produced
+    acceleration = city.recorder.acceleration[:steps_run + 1]
+    jerk = np.abs(np.diff(acceleration, axis=0)) / dt
+    return {
+        "energy": float(city.recorder.energy[-1].sum()),
+        "gap_min": float(city.overall_min_gap),
+        "gap_mean": city.gap_stats.summary()["mean"] if city.gap_stats.count else float('nan'),
+        "collision_count": city.collision_count,
+        "max_jerk": float(jerk.max()) if jerk.size else 0.0,
+        "steps_run": steps_run,
+        "stop_event": city.events[0].name if city.stopped else "",
+    }
+
+
+def evaluate_chunk(tasks, duration, lead_velocity_profile, engine, detectors=()):
+    # Worker: one chunk of (point_id, model, params) tasks
+    rows = []
+    for pid, model, params in tasks:
+        row = {"point_id": pid, "model": model}
+        row.update(scalar_params(params))
+        row.update(evaluate(params, model, duration, lead_velocity_profile, engine, detectors))
+        rows.append(row)
+    return rows
+
+
+def write_part(out_dir, rows):
+    """Writes rows as one columnar part file (atomically, so a crash never leaves half a part)."""
+    columns = {name: np.array([row[name] for row in rows]) for name in rows[0]}
+    name = f"part-{uuid.uuid4().hex}.npz"
+    tmp_path = os.path.join(out_dir, name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(tmp_path, os.path.join(out_dir, name))
+
+
+def part_files(out_dir):
+    return sorted(os.path.join(out_dir, f) for f in os.listdir(out_dir) if f.startswith("part-") and f.endswith(".npz"))
+
+
+def finished_points(out_dir):
+    done = set()
+    if os.path.isdir(out_dir):
+        for path in part_files(out_dir):
+            with np.load(path) as part:
+                done.update(part["point_id"].tolist())
+    return done
+
+
+def load_results(out_dir):
+    """Concatenates every part file into {column: array}."""
+    parts = []
+    for path in part_files(out_dir):
+        with np.load(path) as part:
+            parts.append({name: part[name] for name in part.files})
+    if not parts:
+        return {}
+    names = [name for name in parts[0] if all(name in part for part in parts)]
+    return {name: np.concatenate([part[name] for part in parts]) for name in names}
+
+
+def run_sweep(points, out_dir, base_params, models=('ACC',), duration=60, lead_velocity_profile=(),
+              chunk_size=4, max_workers=None, engine='object', detectors=()):
+    """
+    Evaluates every design point for every model and streams the rows to out_dir.
+    Points that already have a row in out_dir are not recomputed. detectors (events.Detector,
+    e.g. SteadyState()) are attached to every run. Returns the number of new rows.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    lead_velocity_profile = np.asarray(lead_velocity_profile, dtype=float)
+    done = finished_points(out_dir)
+
+    tasks = []
+    for point in points:
+        params = dict(base_params)
+        params.update(point)
+        for model in models:
+            pid = point_id(params, model, duration, lead_velocity_profile, detectors)
+            if pid not in done:
+                done.add(pid)
+                tasks.append((pid, model, params))
+    if not tasks:
+        return 0
+
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+    written = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(evaluate_chunk, chunk, duration, lead_velocity_profile, engine, detectors)
+                   for chunk in chunks]
+        for future in as_completed(futures):
+            rows = future.result()
+            write_part(out_dir, rows)
+            written += len(rows)
+            print(f"  ...Sweep: {written}/{len(tasks)} runs")
+    return written
+
+
+if __name__ == "__main__":
+    base_params = {
+        "car_number": 15, "kd": 0.9, "kv": 0.6, "kc": 0.4, "v_des": 30.0, "max_v": 50.0, "min_v": 0.0,
+        "min_dis": 6.0, "reaction_time": 0.8, "headway_time": 2.0, "max_a": 4.0, "min_a": -5.0,
+        "min_gap": 2.0, "dt": 0.1
+    }
+    points = grid_design({"kd": [0.3, 0.6, 0.9], "kv": [0.2, 0.4, 0.6]})
+    run_sweep(points, "sweep_results", base_params, models=('ACC', 'BCC', 'ACC+BCC'))
+    results = load_results("sweep_results")
+    for row in zip(*(results[name] for name in ["model", "kd", "kv"] + RESULT_COLUMNS)):
+        print(row)
@@ -0,0 +1,65 @@
+"""
+test_events.py: Checks of the run detectors (run with python -m pytest).
+"""
+
+import numpy as np
+import pytest
+
+from city import City
+from events import FirstCollision, SteadyState
+
+PARAMS = (0.9, 0.6, 0.4, 30.0, 50.0, 0.0, 6.0, 0.8, 2.0, 4.0, -5.0)
+# The lead holds 15 m/s from 17 s to 90 s, long enough to look steady, and then stops or speeds up
+PLATEAU_THEN_STOP = [(0, 0), (2, 0), (17, 15), (90, 15), (105, 0)]
+PLATEAU_THEN_CRUISE = [(0, 0), (2, 0), (17, 15), (90, 15), (100, 20)]
+
+
+def profile_city(model, profile, steps, detector=None):
+    city = City()
+    city.init(15, *PARAMS, min_gap=2.0, dt=0.1, model=model)
+    city.lead_velocity_profile = profile
+    if detector is not None:
+        city.add_detector(detector)
+    city.run_steps(steps)
+    return city
+
+
+@pytest.mark.parametrize('model', ['ACC', 'ACC+BCC'])
+def test_steady_state_ignores_a_profile_plateau(model):
+    full = profile_city(model, PLATEAU_THEN_STOP, 1500)
+    fast = profile_city(model, PLATEAU_THEN_STOP, 1500, SteadyState())
+    assert all(event.time >= PLATEAU_THEN_STOP[-1][0] for event in fast.events)
+    assert fast.cars[0].velocity == pytest.approx(full.cars[0].velocity, abs=0.05)
+    assert fast.energy_summary()["consumed"] == pytest.approx(full.energy_summary()["consumed"], rel=1e-3)
+
+
+@pytest.mark.parametrize('model', ['ACC', 'ACC+BCC'])
+def test_fast_forward_after_the_profile_matches_a_full_run(model):
+    full = profile_city(model, PLATEAU_THEN_CRUISE, 2500)
+    fast = profile_city(model, PLATEAU_THEN_CRUISE, 2500, SteadyState())
+    # Fired on the final cruise, not on the plateau
+    assert [event.name for event in fast.events] == ['steady_state']
+    assert fast.events[0].time >= PLATEAU_THEN_CRUISE[-1][0]
+    assert fast.fast_forward_steps > 0 and fast.step_count == full.step_count
+    assert fast.energy_summary()["consumed"] == pytest.approx(full.energy_summary()["consumed"], rel=1e-3)
+    assert np.allclose(fast.recorder.velocity[-1], full.recorder.velocity[-1], atol=0.05)
+
+
+def test_fast_forward_refuses_a_playing_profile():
+    city = profile_city('ACC', PLATEAU_THEN_CRUISE, 300)
+    with pytest.raises(ValueError):
+        city.fast_forward(100)
+
+
+def test_first_collision_fires_on_a_collision_in_the_first_step():
+    city = City()
+    city.init(5, *PARAMS, model='ACC')
+    detector = city.add_detector(FirstCollision())
+    front, car = city.cars[1], city.cars[2]
+    # 0.5 m behind the car in front and closing at 20 m/s: they collide within the first step
+    car.pos = front.pos + front.length + 0.5
+    car.velocity = 20.0
+    city.neighbors.update()
+    city.run()
+    assert city.collision_count > 0
+    assert detector.fired and city.events[0].name == 'collision'
@@ -0,0 +1,48 @@
+"""
+test_fleet.py: Checks of mixed fleets (run with python -m pytest).
+"""
+
+import numpy as np
+import pytest
+
+from city import City
+from fleet import Fleet
+
+PARAMS = (0.9, 0.6, 0.4, 30.0, 50.0, 0.0, 6.0, 0.8, 2.0, 4.0, -5.0)
+
+
+def mixed_city(model, engine, count=30):
+    fleet = Fleet.sample(count, [{'name': 'car', 'share': 0.7, 'length': ('normal', 4.5, 0.3)},
+                                 {'name': 'truck', 'share': 0.3, 'length': 12.0, 'mass': 15000.0}], seed=3)
+    city = City()
+    city.init(count, *PARAMS, min_gap=2.0, dt=0.1, model=model, engine=engine, road_length=1500, fleet=fleet)
+    return city
+
+
+@pytest.mark.parametrize('engine', ['object', 'vector'])
+@pytest.mark.parametrize('model', ['ACC', 'BCC', 'ACC+BCC'])
+def test_mixed_fleet_starts_clear_and_runs_without_collisions(model, engine):
+    city = mixed_city(model, engine)
+    gaps = city.recorder.gap[0]
+    # Every follower starts min_dis behind the rear of the car in front of it
+    assert np.allclose(gaps[1:], 6.0)
+    city.run_steps(300)
+    assert city.collision_count == 0
+    assert (city.recorder.gap[:, 1:] > 0).all()
+
+
+def test_collision_of_unequal_masses_loses_energy():
+    # A full ring of four cars and a truck, min_dis apart
+    city = City()
+    city.init(5, *PARAMS, model='ACC', road_length=60,
+              fleet=Fleet(5, length=[4.5] * 4 + [12.0], mass=[1800.0] * 4 + [15000.0]))
+    front, truck = city.cars[3], city.cars[4]
+    # The truck runs into the car ahead of it at 20 m/s
+    truck.pos = front.pos + front.length - 0.5
+    front.velocity, truck.velocity = 5.0, 25.0
+    city.neighbors.update()
+    city.handle_collisions()
+    assert [(c.front, c.follower) for c in city.collisions] == [(3, 4)]
+    assert city.collisions[0].energy_lost > 0
+    # Momentum is conserved
+    assert front.velocity * 1800.0 + truck.velocity * 15000.0 == pytest.approx(5.0 * 1800.0 + 25.0 * 15000.0)
@@ -1,15 +1,58 @@
 """
 transportation_painter.py: Visualization for the simulation (using tkinter).
+
+Canvas items are created once and then moved or relabelled: every frame only
+the cars whose pixel position, speed text, mode label or colour changed are
+touched. Above max_car_items cars the painter draws a density strip instead
+(the road split into density_bins cells coloured by how much of each cell is
+occupied), which keeps the canvas small with thousands of vehicles.
 """
 
 import tkinter as tk
+import numpy as np
+
+# Road line on the canvas: lowest pos = rightmost (X2), highest pos = leftmost (X1)
+X1, X2, Y = 100, 1100, 200
+# Density strip colours from an empty cell to a fully occupied one
+DENSITY_LEVELS = 20
+DENSITY_COLORS = ['#%02x%02x%02x' % (int(224 - 48 * k / DENSITY_LEVELS), int(224 * (1 - k / DENSITY_LEVELS)),
+                                     int(224 * (1 - k / DENSITY_LEVELS))) for k in range(DENSITY_LEVELS + 1)]
+
+
+def mode_label(car):
+    mode = getattr(car, 'mode', 'ACC')
+    if mode == 'ACC':
+        return 'A'
+    if mode == 'BCC':
+        return 'B'
+    if mode == 'INTEGRATED':
+        return f"{car.integration_factor:.2f}".split(".")[1]
+    if mode == 'SWITCH':
+        return 'S'
+    if mode == 'IDM':
+        return 'H'
+    return 'V'
+
 
 class TransportationPainter(tk.Canvas):
-    def __init__(self, master, roads, cars, *args, **kwargs):
+    def __init__(self, master, roads, cars, *args, max_car_items=500, density_bins=200, **kwargs):
         super().__init__(master, *args, **kwargs)
         self.roads = roads
         self.cars = cars
         self.counter = 0
+        self.max_car_items = max_car_items
+        self.density_bins = density_bins
+        self.road_items = []
+        # Per car: (rectangle, speed text, mode text) and the state they were last drawn with
+        self.car_items = []
+        self.car_drawn = []
+        # Density view: one rectangle per cell, its colour level and a summary text
+        self.density_items = []
+        self.density_drawn = None
+        self.density_text = None
+        self.density_summary = None
+        # ('cars', n) or ('density', bins): what the vehicle items on the canvas are laid out for
+        self.layout = None
 
     def set_elements(self, roads, cars):
         self.roads = roads
@@ -20,32 +63,105 @@ class TransportationPainter(tk.Canvas):
 
     def init(self):
         self.counter = 0
+        self.clear()
         self.repaint()
 
-    def repaint(self):
+    def clear(self):
+        # Drop every item, the next repaint creates them again
         self.delete('all')
+        self.road_items = []
+        self.clear_vehicles()
+
+    def clear_vehicles(self):
+        for items in self.car_items:
+            self.delete(*items)
+        self.delete(*self.density_items)
+        if self.density_text is not None:
+            self.delete(self.density_text)
+        self.car_items = []
+        self.car_drawn = []
+        self.density_items = []
+        self.density_drawn = None
+        self.density_text = None
+        self.density_summary = None
+        self.layout = None
+
+    def repaint(self):
         self.paint()
 
     def paint(self):
         # Draw roads (as a single horizontal line for now)
-        for road in self.roads:
-            x1, y1 = 100, 200
-            x2, y2 = 1100, 200
-            self.create_line(x1, y1, x2, y2, width=8, fill='gray')
-            
-        # Draw cars sorted by position (lowest pos = rightmost)
-        if self.cars:
-            sorted_cars = sorted(self.cars, key=lambda c: c.pos)
-            l = len(sorted_cars)
-            for i in range(l-1, -1, -1):
-                car = sorted_cars[i]
-                road_length = self.roads[0].length if self.roads else 1000
-                # Inverted mapping: lowest pos = rightmost (x2), highest pos = leftmost (x1)
-                x = 1100 - (car.pos / road_length) * 1000
-                y = 200
-                self.create_rectangle(x-car.length/2, y-10, x+car.length/2, y+10, fill=car.color, outline='black')
-                self.create_text(x, y-25, text=f"{car.velocity:.1f}")
-                mode_label = 'A' if getattr(car, 'mode', 'ACC') == 'ACC' else 'B' if getattr(car, 'mode', 'BCC') == 'BCC' else f"{car.integration_factor:.2f}".split(".")[1] if getattr(car, 'mode', 'INTEGRATED') == 'INTEGRATED' else "S" if getattr(car, 'mode', "SWITCH") == "SWITCH" else 'V'
-                self.create_text(x, y + 20, text=mode_label, font=("Arial", 8))
-
-   
\ No newline at end of file
+        if len(self.road_items) != len(self.roads):
+            self.delete(*self.road_items)
+            self.road_items = [self.create_line(X1, Y, X2, Y, width=8, fill='gray') for _ in self.roads]
+            # Cars stay on top of the road
+            for items in self.car_items:
+                for item in items:
+                    self.tag_raise(item)
+            for item in self.density_items:
+                self.tag_raise(item)
+
+        road_length = self.roads[0].length if self.roads else 1000
+        if len(self.cars) > self.max_car_items:
+            self.paint_density(road_length)
+        else:
+            self.paint_cars(road_length)
+
+    def paint_cars(self, road_length):
+        cars = self.cars
+        if self.layout != ('cars', len(cars)):
+            self.clear_vehicles()
+            self.layout = ('cars', len(cars))
+            self.car_items = [(self.create_rectangle(0, 0, 0, 0, outline='black'), self.create_text(0, 0),
+                               self.create_text(0, 0, font=("Arial", 8))) for _ in cars]
+            self.car_drawn = [None] * len(cars)
+
+        for i, car in enumerate(cars):
+            # Inverted mapping, rounded so sub-pixel moves do not touch the canvas
+            x = round(X2 - (car.pos / road_length) * (X2 - X1), 1)
+            state = (x, car.length, car.color, f"{car.velocity:.1f}", mode_label(car))
+            drawn = self.car_drawn[i]
+            if state == drawn:
+                continue
+            rectangle, speed_text, mode_text = self.car_items[i]
+            if drawn is None or drawn[:2] != state[:2]:
+                self.coords(rectangle, x - car.length / 2, Y - 10, x + car.length / 2, Y + 10)
+                self.coords(speed_text, x, Y - 25)
+                self.coords(mode_text, x, Y + 20)
+            if drawn is None or drawn[2] != state[2]:
+                self.itemconfig(rectangle, fill=state[2])
+            if drawn is None or drawn[3] != state[3]:
+                self.itemconfig(speed_text, text=state[3])
+            if drawn is None or drawn[4] != state[4]:
+                self.itemconfig(mode_text, text=state[4])
+            self.car_drawn[i] = state
+
+    def paint_density(self, road_length):
+        cars = self.cars
+        bins = self.density_bins
+        if self.layout != ('density', bins):
+            self.clear_vehicles()
+            self.layout = ('density', bins)
+            width = (X2 - X1) / bins
+            # Cell k covers pos [k, k + 1) * road_length / bins, drawn from the right end like the cars
+            self.density_items = [self.create_rectangle(X2 - (k + 1) * width, Y - 10, X2 - k * width, Y + 10,
+                                                        width=0, fill=DENSITY_COLORS[0]) for k in range(bins)]
+            self.density_drawn = np.zeros(bins, dtype=int)
+            self.density_text = self.create_text((X1 + X2) / 2, Y - 25)
+
+        count = len(cars)
+        pos = np.fromiter((car.pos for car in cars), dtype=float, count=count)
+        length = np.fromiter((car.length for car in cars), dtype=float, count=count)
+        cell = np.clip((pos / road_length * bins).astype(int), 0, bins - 1)
+        # Fraction of each cell covered by cars, as a colour level
+        occupied = np.bincount(cell, weights=length, minlength=bins) / (road_length / bins)
+        levels = np.minimum(np.rint(occupied * DENSITY_LEVELS), DENSITY_LEVELS).astype(int)
+        for k in np.flatnonzero(levels != self.density_drawn):
+            self.itemconfig(self.density_items[k], fill=DENSITY_COLORS[levels[k]])
+        self.density_drawn = levels
+
+        mean_speed = sum(car.velocity for car in cars) / count
+        summary = f"{count} cars, mean speed {mean_speed:.1f}"
+        if summary != self.density_summary:
+            self.itemconfig(self.density_text, text=summary)
+            self.density_summary = summary
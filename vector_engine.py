@@ -0,0 +1,411 @@
+"""
+vector_engine.py: Contains the VectorEngine class, an array-based step engine for City.
+
+The engine keeps the state of every car in (replica x car) NumPy arrays and
+computes the accelerations of every controller group (ACC, BCC, ACC+BCC and
+IDM cars, see fleet.CONTROLLERS), jerk limiting, kinematics and clamping in
+batched operations, one pass per group. A single City is an
+engine with one replica; ensemble.Ensemble stacks many.
+"""
+
+import numpy as np
+from energy import AIR_DENSITY, GRAVITY, FleetEnergy
+from fleet import ACC_CONTROL, BCC_CONTROL, IDM_CONTROL, INTEGRATED_CONTROL, LEAD
+
+MODES = ('VEL', 'ACC', 'BCC', 'INTEGRATED', 'IDM')
+VEL, ACC, BCC, INTEGRATED, IDM = range(len(MODES))
+
+MAX_JERK = 5
+# Intelligent Driver Model: acceleration exponent and comfortable deceleration (m/s^2)
+IDM_DELTA = 4
+IDM_DECELERATION = 2.0
+# Gaps below this (m) count as this in the IDM interaction term, so an overlap cannot divide by zero
+IDM_MIN_GAP = 0.1
+
+
+def take(values, idx):
+    return np.take_along_axis(values, idx, axis=-1)
+
+
+def ring_neighbors(pos, road_length):
+    # Front car = next car with a lower position (cars move towards lower pos), back car = next higher
+    order = np.argsort(pos % road_length, axis=-1, kind='stable')
+    front = np.empty_like(order)
+    back = np.empty_like(order)
+    np.put_along_axis(front, order, np.roll(order, 1, axis=-1), axis=-1)
+    np.put_along_axis(back, order, np.roll(order, -1, axis=-1), axis=-1)
+    return front, back
+
+
+def limit_jerk(acc, last_acc, dt, max_jerk=MAX_JERK):
+    jerk = (acc - last_acc) / dt
+    limited = np.where(jerk > max_jerk, last_acc + max_jerk * dt, acc)
+    return np.where(jerk < -max_jerk, last_acc - max_jerk * dt, limited)
+
+
+def clamp(values, low, high):
+    return np.maximum(low, np.minimum(high, values))
+
+
+def acc_law(gap, vel, front_vel, kd, kv, min_dis, reaction_time):
+    rel_v = front_vel - vel
+    desired_gap = min_dis + vel * reaction_time
+    return kd * (gap - desired_gap) + kv * rel_v
+
+
+def bcc_law(front_gap, back_gap, vel, front_vel, back_vel, kd, kv, min_dis, reaction_time, iF=1):
+    desired_gap = min_dis + vel * reaction_time
+    gap_factor = kd * (front_gap - desired_gap) + iF * kd * (desired_gap - back_gap)
+    velocity_factor = kv * (front_vel - vel) + iF * kv * (back_vel - vel)
+    return velocity_factor + gap_factor
+
+
+def idm_law(gap, vel, front_vel, v0, headway_time, min_dis, max_a, b=IDM_DECELERATION):
+    # Treiber's IDM: free-road term minus the interaction term of the desired dynamic gap s*
+    s_star = min_dis + np.maximum(0.0, vel * headway_time + vel * (vel - front_vel) / (2 * np.sqrt(max_a * b)))
+    return max_a * (1 - (vel / v0) ** IDM_DELTA - (s_star / np.maximum(gap, IDM_MIN_GAP)) ** 2)
+
+
+def safe_gap_sum(vel, front_vel, back_vel, length, min_a, min_gap, reaction_time):
+    # X = minimum front gap + own length + minimum rear gap
+    ae = np.abs(min_a)
+    af = ae * 0.7
+    g_front_min = vel * reaction_time + ((front_vel - vel) ** 2) / (2 * ae) + min_gap
+    g_rear_min = back_vel * reaction_time + ((back_vel - vel) ** 2) / (2 * af) + min_gap
+    return g_front_min + length + g_rear_min
+
+
+def integration_factor(front_gap, back_gap, X, vel, front_vel, rear_vel, rear_acc, old_iF):
+    # Same weights, thresholds and hysteresis as City.calculate_integration_factor
+    back_ratio = (X - np.minimum(X, back_gap)) / X
+    raw_iF = back_ratio * 6
+    front_ratio = np.exp(-0.01 * np.power(front_gap - 10, 2))
+    raw_iF = raw_iF + front_ratio * 6
+    total_w = 12
+
+    rear_braking = (back_gap < X) & (rear_acc < 0)
+    with np.errstate(over='ignore'):
+        rear_brake_ratio = np.where(rear_acc > -2, 1.0, np.exp(1.23 * (rear_acc + 2)))
+    total_w = total_w + np.where(rear_braking, 2, 0)
+    raw_iF = raw_iF + np.where(rear_braking, rear_brake_ratio * 2, 0.0)
+
+    rel_vel_rear = rear_vel - vel
+    closing_in = (back_gap < 2 * X) & (rel_vel_rear > 0)
+    raw_iF = raw_iF + np.where(closing_in, np.clip(rel_vel_rear / 5.0, 0, 1) * 2, 0.0)
+    total_w = total_w + np.where(closing_in, 2, 0)
+
+    rel_vel_front = vel - front_vel
+    closing_front = (front_gap < 2 * X) & (rel_vel_front > 0)
+    raw_iF = raw_iF + np.where(closing_front, np.clip(rel_vel_front / 5.0, 0, 1) * 3, 0.0)
+    total_w = total_w + np.where(closing_front, 3, 0)
+
+    normalized_iF = clamp(raw_iF / total_w, 0, 1)
+    alpha = 0.009
+    return (1 - alpha) * old_iF + alpha * normalized_iF
+
+
+def integration_mode(iF):
+    return np.where(iF < 0.1, ACC, np.where(iF > 0.8, BCC, INTEGRATED))
+
+
+def traction_energy(vel, acc, dt, mass, Cr, Cd, frontal_area):
+    # Wheel energy of the FleetEnergy force balance with fixed vehicle constants, in kWh (used by network.py)
+    F_inertia = mass * acc
+    F_roll = Cr * mass * GRAVITY
+    F_drag = 0.5 * Cd * AIR_DENSITY * frontal_area * vel ** 2
+    F_total = F_inertia + F_roll + F_drag
+    return F_total * vel * dt / 3600000
+
+
+def resolve_collisions(pos, vel, length, cor, mass, road_length, min_gap, back, start):
+    """
+    Resolves the overlaps of one ring in a single pass on plain lists (pos and
+    vel are modified in place). The pass walks the ring order backwards from
+    car `start`, whose own front gap is clear, through the back links, so a
+    pileup is always handled from its head: every car pushed behind the car in
+    front of it is checked against the car behind it next, even when the push
+    moved it past that car. Returns the collisions as (front, follower,
+    closing speed, kinetic energy lost) tuples.
+    """
+    collisions = []
+    front = start
+    pushed = False
+    # One lap, plus the cars behind `start` again if the pileup at the end of the lap reached it
+    for checked in range(2 * len(pos)):
+        if checked >= len(pos) and not pushed:
+            break
+        car = back[front]
+        if car == front:
+            break
+        gap = (pos[car] - pos[front]) % road_length
+        # A front car pushed past this one leaves a gap of almost a full lap
+        if gap <= length[front] or (pushed and gap > road_length / 2):
+            v1, m1 = vel[front], mass[front]
+            v2, m2 = vel[car], mass[car]
+            e = cor[front]
+            # Restitution with momentum conserved, so a heavier car changes speed less and no energy is gained
+            momentum = m1 * v1 + m2 * v2
+            vel[front] = (momentum + m2 * e * (v2 - v1)) / (m1 + m2)
+            vel[car] = (momentum + m1 * e * (v1 - v2)) / (m1 + m2)
+            # Prevent overlap: set the follower just behind the front car with an addition of min_gap
+            pos[car] = (pos[front] + length[front] + min_gap) % road_length
+            energy_lost = 0.5 * (mass[front] * (v1 ** 2 - vel[front] ** 2) + mass[car] * (v2 ** 2 - vel[car] ** 2))
+            collisions.append((front, car, v2 - v1, energy_lost))
+            pushed = True
+        else:
+            pushed = False
+        front = car
+    return collisions
+
+
+def ring_overlaps(pos, length, front, road_length):
+    # Cars overlapping the car in front of them, from the ring links (no sort); a lone car has itself in front
+    gaps = (pos - take(pos, front)) % road_length
+    return (gaps <= take(length, front)) & (front != np.arange(pos.shape[-1]))
+
+
+class VectorEngine:
+    """
+    Array-backed replacement for the per-car loops in City.run.
+
+    Positions, velocities, accelerations, lengths and integration factors of
+    every City in `cities` live in (replica x car) arrays, as do the
+    per-car gains of every City's fleet, and the city-wide parameters become
+    (replica x 1) columns, so replicas may use different parameters. All
+    cities must run the same model with the same number of cars.
+    The Car objects of every City are refreshed after each step so painters
+    and plots keep working unchanged.
+    """
+
+    def __init__(self, cities):
+        self.cities = list(cities)
+        if len({len(city.cars) for city in self.cities}) > 1:
+            raise ValueError("All cities of a VectorEngine must have the same number of cars")
+        self.load()
+
+    def load(self):
+        # (Re)read the state of every car from the cities
+        cars = [city.cars for city in self.cities]
+
+        def stack(get, dtype=float):
+            return np.array([[get(c) for c in row] for row in cars], dtype=dtype).reshape(len(cars), -1)
+
+        self.pos = stack(lambda c: c.pos)
+        self.vel = stack(lambda c: c.velocity)
+        self.acc = stack(lambda c: c.acceleration)
+        self.length = stack(lambda c: c.length)
+        self.iF = stack(lambda c: c.integration_factor)
+        self.mode = stack(lambda c: MODES.index(c.mode), np.int8)
+        self.energy = stack(lambda c: c.energy_used)
+        self.recovered = stack(lambda c: c.energy_recovered)
+        self.mass = stack(lambda c: c.mass)
+        # Per-car controller gains from the struct-of-arrays fleet of every City
+        self.kd = np.array([city.fleet.kd for city in self.cities], dtype=float).reshape(len(cars), -1)
+        self.kv = np.array([city.fleet.kv for city in self.cities], dtype=float).reshape(len(cars), -1)
+        self.headway_time = np.array([city.fleet.headway_time for city in self.cities],
+                                     dtype=float).reshape(len(cars), -1)
+        # Controller of every car (City.controllers); each group is stepped in one batched pass
+        self.controllers = np.array([city.controllers for city in self.cities], dtype=np.int8).reshape(len(cars), -1)
+        self.groups = {controller: self.controllers == controller
+                       for controller in (ACC_CONTROL, BCC_CONTROL, INTEGRATED_CONTROL, IDM_CONTROL)}
+        self.followers = self.controllers != LEAD
+        self.fleet_energy = FleetEnergy.from_cars([c for row in cars for c in row], self.pos.shape)
+        self.cor = [[getattr(c, 'CoR', 0.3) for c in row] for row in cars]
+        self.wrap_length = stack(lambda c: c.current_road.length)
+        self.collision_timer = stack(lambda c: getattr(c, 'collision_timer', 0), int)
+        self.index = np.arange(self.pos.shape[1])
+        self.update_neighbors()
+
+    def param(self, name):
+        # City-wide parameter as a scalar (one city) or a (replica x 1) column
+        if len(self.cities) == 1:
+            return getattr(self.cities[0], name)
+        return np.array([[getattr(city, name)] for city in self.cities], dtype=float)
+
+    def road_length(self):
+        lengths = [city.roads[0].length if city.roads else 1000 for city in self.cities]
+        if len(lengths) == 1:
+            return lengths[0]
+        return np.array(lengths, dtype=float)[:, None]
+
+    def update_neighbors(self):
+        # One sort per step, shared by the gap statistics and the next driver decision
+        self.front, self.back = ring_neighbors(self.pos, self.road_length())
+
+    def step(self, dt):
+        """Advances every replica by one step, records it and returns the (replica x car) front gaps."""
+        positions, velocities, gap_rows = self.advance(dt)
+        self.sync_cars()
+        for r, city in enumerate(self.cities):
+            if city.recorder is not None:
+                city.recorder.record(positions[r], velocities[r], self.acc[r], gap_rows[r], self.energy[r], self.iF[r],
+                                     self.mode[r])
+        return gap_rows
+
+    def advance(self, dt):
+        """
+        Advances the arrays only (no Car sync, no recording); returns the positions and
+        velocities to record and the front gaps.
+        """
+        self.driver_decision(dt)
+        positions, velocities = self.move_forward(dt)
+        return positions, velocities, self.front_gaps()
+
+    def driver_decision(self, dt=None):
+        n = self.pos.shape[1]
+        if n == 0:
+            return
+        if dt is None:
+            dt = self.param('dt')
+        kd, kv = self.kd, self.kv
+        min_dis, reaction_time = self.param('min_dis'), self.param('reaction_time')
+        min_a, max_a = self.param('min_a'), self.param('max_a')
+        L = self.road_length()
+        pos, vel, old_acc = self.pos, self.vel, self.acc
+
+        # The lead car (index 0) follows its City's stop flag, velocity profile or v_des
+        new_acc = old_acc.copy()
+        new_acc[:, 0] = [city.lead_acceleration(v, a, dt) for city, v, a in
+                         zip(self.cities, vel[:, 0].tolist(), old_acc[:, 0].tolist())]
+        if n == 1:
+            self.acc = new_acc
+            return
+
+        front, back = self.front, self.back
+        front_pos, front_vel, front_len = take(pos, front), take(vel, front), take(self.length, front)
+        back_pos, back_vel = take(pos, back), take(vel, back)
+        followers, groups = self.followers, self.groups
+
+        gap = (pos - front_pos - front_len) % L
+        acc = acc_law(gap, vel, front_vel, kd, kv, min_dis, reaction_time)
+        self.mode[groups[ACC_CONTROL]] = ACC
+
+        bcc_cars, pair_cars = groups[BCC_CONTROL], groups[INTEGRATED_CONTROL]
+        if bcc_cars.any() or pair_cars.any():
+            front_gap = np.abs((pos - front_pos - front_len) % L)
+            back_gap = np.abs((back_pos - pos - self.length) % L)
+        if bcc_cars.any():
+            bcc_acc = bcc_law(front_gap, back_gap, vel, front_vel, back_vel, kd, kv, min_dis, reaction_time)
+            acc = np.where(bcc_cars, bcc_acc, acc)
+            self.mode[bcc_cars] = BCC
+        if groups[IDM_CONTROL].any():
+            idm_acc = idm_law(gap, vel, front_vel, self.param('v_des'), self.headway_time, min_dis, max_a)
+            acc = np.where(groups[IDM_CONTROL], idm_acc, acc)
+            self.mode[groups[IDM_CONTROL]] = IDM
+        # ACC+BCC last: it reads the accelerations the other groups already have this step
+        if pair_cars.any():
+            for city in self.cities:
+                city.mode = "INTEGRATED"
+            pair_acc = self.integrated_acceleration(front_gap, back_gap, front_vel, back_vel, pair_cars,
+                                                    followers & ~pair_cars, acc, new_acc, dt)
+            acc = np.where(pair_cars, pair_acc, acc)
+
+        acc = limit_jerk(clamp(acc, min_a, max_a), old_acc, dt)
+        self.acc = np.where(followers, acc, new_acc)
+
+    def integrated_acceleration(self, front_gap, back_gap, front_vel, back_vel, pair_cars, known_cars, acc, new_acc,
+                                dt):
+        """
+        ACC+BCC law for every pair car. The per-car loop reads the rear car's
+        acceleration after it has already been updated this step, so the
+        batch is iterated until that chain of dependencies stops changing.
+        known_cars are the followers whose acceleration (in acc) does not
+        depend on the pair cars.
+        """
+        kd, kv = self.kd, self.kv
+        min_dis, reaction_time = self.param('min_dis'), self.param('reaction_time')
+        min_a, max_a = self.param('min_a'), self.param('max_a')
+        vel, old_acc, back = self.vel, self.acc, self.back
+        X = safe_gap_sum(vel, front_vel, back_vel, self.length, min_a, self.param('min_gap'), reaction_time)
+
+        # Rear accelerations of cars already visited in the per-car loop come from this step
+        rear_updated = back < self.index
+        old_rear_acc = take(old_acc, back)
+        known = limit_jerk(clamp(acc, min_a, max_a), old_acc, dt)
+        step_acc = np.where(known_cars, known, new_acc)
+        for _ in range(vel.shape[1]):
+            rear_acc = np.where(rear_updated, take(step_acc, back), old_rear_acc)
+            iF = integration_factor(front_gap, back_gap, X, vel, front_vel, back_vel, rear_acc, self.iF)
+            pair_acc = bcc_law(front_gap, back_gap, vel, front_vel, back_vel, kd, kv, min_dis, reaction_time, iF)
+            limited = limit_jerk(clamp(pair_acc, min_a, max_a), old_acc, dt)
+            updated = np.where(pair_cars, limited, step_acc)
+            if np.array_equal(updated, step_acc):
+                break
+            step_acc = updated
+
+        self.iF = np.where(pair_cars, iF, self.iF)
+        self.mode = np.where(pair_cars, integration_mode(iF), self.mode).astype(np.int8)
+        return pair_acc
+
+    def move_forward(self, dt):
+        # S = ut + 0.5at^2, v = u + at (cars move towards lower positions)
+        displacement = self.vel * dt + 0.5 * self.acc * dt**2
+        pos = self.pos - displacement
+        vel = self.vel + self.acc * dt
+        L = self.wrap_length
+        pos = np.where(pos < 0, pos + L, np.where(pos >= L, pos - L, pos))
+
+        consumed, recovered = self.fleet_energy.step(vel, self.acc, dt)
+        self.energy = self.energy + consumed
+        self.recovered = self.recovered + recovered
+
+        self.pos = pos
+        self.vel = clamp(vel, self.param('min_v'), self.param('max_v'))
+
+        # Fade collision color if timer is active
+        active = self.collision_timer > 0
+        if active.any():
+            self.collision_timer = self.collision_timer - active
+            for r, i in np.argwhere(active & (self.collision_timer == 0)):
+                car = self.cities[r].cars[i]
+                car.color = car.original_color
+
+        # The ring order is repaired first so the collision pass can follow it; resolving
+        # the overlaps keeps that order
+        self.update_neighbors()
+        self.handle_collisions(dt)
+        # Histories are recorded as Car.update leaves them (before clamping and collision handling)
+        return pos, vel
+
+    def handle_collisions(self, dt=None):
+        L = self.road_length()
+        overlapping = ring_overlaps(self.pos, self.length, self.front, L)
+        replicas = np.flatnonzero(overlapping.any(axis=-1))
+        if replicas.size == 0:
+            return
+        self.pos = self.pos.copy()
+        self.vel = self.vel.copy()
+        for r in replicas:
+            city = self.cities[r]
+            pos, vel = self.pos[r].tolist(), self.vel[r].tolist()
+            road_length = city.roads[0].length if city.roads else 1000
+            clear = np.flatnonzero(~overlapping[r])
+            collisions = resolve_collisions(pos, vel, self.length[r].tolist(), self.cor[r], self.mass[r].tolist(),
+                                            road_length, city.min_gap, self.back[r].tolist(),
+                                            int(clear[0]) if clear.size else 0)
+            self.pos[r] = pos
+            self.vel[r] = vel
+            for front, car, closing_speed, energy_lost in collisions:
+                for i in (front, car):
+                    city.cars[i].color = 'orange'
+                    self.collision_timer[r, i] = 40
+                city.log_collision(front, car, closing_speed, energy_lost, dt)
+
+    def front_gaps(self):
+        # Gap from every car to the rear of the car in front of it
+        return (self.pos - take(self.pos, self.front) - take(self.length, self.front)) % self.road_length()
+
+    def sync_cars(self):
+        for r, city in enumerate(self.cities):
+            for car, p, v, a, iF, m, e, er, t in zip(city.cars, self.pos[r].tolist(), self.vel[r].tolist(),
+                                                     self.acc[r].tolist(), self.iF[r].tolist(), self.mode[r].tolist(),
+                                                     self.energy[r].tolist(), self.recovered[r].tolist(),
+                                                     self.collision_timer[r].tolist()):
+                car.pos = p
+                car.velocity = v
+                car.acceleration = a
+                car.integration_factor = iF
+                car.mode = MODES[m]
+                car.energy_used = e
+                car.energy_recovered = er
+                car.collision_timer = t
@@ -0,0 +1,59 @@
+"""
+velocity_profile.py: Contains the VelocityProfile class, a compiled (time, velocity) interpolator.
+"""
+
+import numpy as np
+
+class VelocityProfile:
+    """
+    Piecewise-linear velocity profile compiled into sorted NumPy arrays.
+
+    lookup() keeps a cursor on the last segment used, so stepping forward in
+    time costs O(1); jumps backwards fall back to a binary search. Outside the
+    sampled range the last velocity of the profile is returned, with inside
+    set to False, as the original linear scan did.
+    """
+
+    def __init__(self, samples=()):
+        if isinstance(samples, VelocityProfile):
+            times, velocities = samples.times, samples.velocities
+        else:
+            data = np.asarray(samples, dtype=float).reshape(-1, 2)
+            order = np.argsort(data[:, 0], kind='stable')
+            times = np.ascontiguousarray(data[order, 0])
+            velocities = np.ascontiguousarray(data[order, 1])
+        self.times = times
+        self.velocities = velocities
+        self.cursor = 0
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i):
+        return float(self.times[i]), float(self.velocities[i])
+
+    def segment(self, time):
+        # Index k of the first segment with t[k] <= time <= t[k+1]
+        t = self.times
+        k = self.cursor
+        if k < len(t) - 1 and (t[k] < time or (k == 0 and t[0] <= time)):
+            # Monotonic cursor for forward time
+            last = len(t) - 2
+            while k < last and time > t[k + 1]:
+                k += 1
+        else:
+            k = max(int(np.searchsorted(t, time, side='left')) - 1, 0)
+        self.cursor = k
+        return k
+
+    def lookup(self, time):
+        """Returns (target_velocity, inside) for the given time."""
+        t = self.times
+        if len(t) >= 2 and t[0] <= time <= t[-1]:
+            k = self.segment(time)
+            t1, t2 = t[k], t[k + 1]
+            v1, v2 = self.velocities[k], self.velocities[k + 1]
+            alpha = (time - t1) / (t2 - t1)
+            return float(v1 + alpha * (v2 - v1)), True
+        # If time exceeds profile, maintain last velocity
+        return float(self.velocities[-1]), False